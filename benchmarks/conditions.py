@@ -0,0 +1,77 @@
+"""
+Measure the per-event cost of evaluating a factory condition block, compiled
+once against the previous evaluation (regex cleaning, value substitution and
+`safe_eval` on every event).
+
+    python benchmarks/conditions.py
+"""
+import ast
+import re
+import timeit
+
+from nyuki.utils.evaluate import AUTHORIZED_TYPES, ConditionBlock
+
+
+CONDITIONS = [
+    {'type': 'if', 'condition': "(@status == 'closed') and (@level > 3)"},
+    {'type': 'elif', 'condition': "(@site == 'paris') or (@site == 'lyon')"},
+    {'type': 'elif', 'condition': "(@level >= 2) or (@owner != None)"},
+    {'type': 'else'},
+]
+DATA = {'status': 'open', 'level': 1, 'site': 'nantes', 'owner': None}
+
+
+def clean_condition(condition, data):
+    match = re.findall(
+        r' *(and|or)? *\( *(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) +([=<>!]=?|not in|in|not) +(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) *\) *',
+        condition
+    )
+    if not match:
+        return condition
+
+    def replace(match):
+        value = data.get(match.group('var_name'))
+        placeholder = '{!r}' if isinstance(value, str) else '{}'
+        return placeholder.format(value)
+
+    cleaned = ''
+    for operation in match:
+        ops = [
+            re.sub(r'^@(?P<var_name>\w+)$', replace, operation[1]),
+            operation[2],
+            re.sub(r'^@(?P<var_name>\w+)$', replace, operation[3]),
+        ]
+        cleaned += '{}({})'.format(operation[0], ' '.join(ops))
+    return cleaned
+
+
+def previous_safe_eval(expr):
+    tree = ast.parse(expr, mode='eval').body
+    for node in ast.walk(tree):
+        if not type(node) in AUTHORIZED_TYPES:
+            raise TypeError(node)
+    return bool(eval(expr))
+
+
+def previous(data):
+    for condition in CONDITIONS:
+        if condition['type'] == 'else':
+            return condition
+        if previous_safe_eval(clean_condition(condition['condition'], data)):
+            return condition
+
+
+def main():
+    block = ConditionBlock(CONDITIONS)
+    assert CONDITIONS[block.select(DATA)] is previous(DATA)
+
+    number = 10000
+    for name, func in (
+            ('per-event parsing', lambda: previous(DATA)),
+            ('compiled', lambda: block.select(DATA))):
+        elapsed = timeit.timeit(func, number=number)
+        print('{:<18} {:>8.2f} us/event'.format(name, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
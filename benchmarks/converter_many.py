@@ -0,0 +1,57 @@
+"""
+Compare applying the same factory rules on many records one by one, in
+batch without diffs, and in batch with the columnar mode.
+
+    python benchmarks/converter_many.py
+"""
+import time
+
+from nyuki.utils.transform import Converter
+
+
+CONFIG = {'rules': [
+    {'type': 'lower', 'fieldname': 'name'},
+    {'type': 'upper', 'fieldname': 'code'},
+    {'type': 'set', 'fieldname': 'source', 'value': 'csv'},
+    {'type': 'copy', 'fieldname': 'name', 'copy': 'alias'},
+    {'type': 'lookup', 'fieldname': 'color', 'icase': True,
+     'table': {'red': 'rouge', 'blue': 'bleu', 'green': 'vert'}},
+    {'type': 'arithmetic', 'fieldname': 'total', 'operator': '*',
+     'operand1': '@price', 'operand2': 1.2},
+]}
+COLORS = ['Red', 'blue', 'GREEN', 'black']
+
+
+def records(count):
+    return [
+        {
+            'name': 'Name {}'.format(i),
+            'code': 'c{}'.format(i),
+            'color': COLORS[i % len(COLORS)],
+            'price': i,
+            'payload': {'nested': list(range(20))},
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    count = 20000
+    converter = Converter.from_dict(CONFIG)
+
+    for name, func in (
+            ('apply', lambda data: [converter.apply(r) for r in data]),
+            ('apply_many', lambda data: converter.apply_many(data)),
+            ('no diff', lambda data: converter.apply_many(data, diff=False)),
+            ('columnar', lambda data: converter.apply_many(
+                data, diff=False, columnar=True
+            ))):
+        data = records(count)
+        start = time.perf_counter()
+        func(data)
+        elapsed = time.perf_counter() - start
+        print('{:<12} {:>8.0f} records/s'.format(name, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
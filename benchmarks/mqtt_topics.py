@@ -0,0 +1,53 @@
+"""
+Compare MQTT message dispatch through the subscriptions trie against the
+previous implementation (one compiled regex per subscription).
+
+    python benchmarks/mqtt_topics.py [subscriptions]
+"""
+import re
+import sys
+import timeit
+from uuid import uuid4
+
+from nyuki.bus.topics import TopicTrie
+
+
+def regex_topic(topic):
+    return re.compile(r'^{}$'.format(
+        topic.replace('+', '[^\/]+').replace('#', '.+')
+    ))
+
+
+def callback(topic, data):
+    pass
+
+
+def main(count):
+    topics = ['+/async/{}'.format(str(uuid4())[:8]) for _ in range(count)]
+    topics += ['+/monitoring', 'pumba/#']
+
+    regexes = {topic: regex_topic(topic) for topic in topics}
+    trie = TopicTrie()
+    for topic in topics:
+        trie.add(topic, callback)
+
+    incoming = 'timon/async/{}'.format(topics[count // 2].split('/')[-1])
+
+    def scan():
+        return [t for t, regex in regexes.items() if regex.match(incoming)]
+
+    def lookup():
+        return trie.match(incoming)
+
+    assert len(scan()) == len(lookup()) == 1
+
+    number = 100
+    for name, func in (('regex scan', scan), ('topic trie', lookup)):
+        elapsed = timeit.timeit(func, number=number)
+        print('{:<12} {:>10.2f} us/message ({} subscriptions)'.format(
+            name, elapsed / number * 1e6, len(topics)
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,82 @@
+"""
+Measure the in-memory cost of one publication (store then status update) on
+a full bus persistence buffer, for growing memory sizes, against the
+previous list-based buffer.
+
+    python benchmarks/persistence_memory.py [sizes...]
+"""
+import asyncio
+import sys
+import time
+from uuid import uuid4
+
+from nyuki.bus.persistence import BusPersistence, EventStatus
+
+
+class ListBuffer(object):
+
+    """
+    Previous implementation: list.pop(0) and a linear scan by id.
+    """
+
+    def __init__(self, size):
+        self.list = list()
+        self.size = size
+
+    def store(self, event):
+        while len(self.list) >= self.size:
+            self.list.pop(0)
+        self.list.append(event)
+
+    def update(self, uid, status):
+        for event in self.list:
+            if event['id'] == uid:
+                event['status'] = status.value
+                break
+
+
+def new_event():
+    return {
+        'id': str(uuid4()),
+        'status': EventStatus.PENDING.value,
+        'topic': 'bench',
+        'message': '{}',
+    }
+
+
+async def deque_cost(size, number):
+    persistence = BusPersistence(memory_size=size)
+    for _ in range(size):
+        await persistence.store(new_event())
+    events = [new_event() for _ in range(number)]
+    start = time.perf_counter()
+    for event in events:
+        await persistence.store(event)
+        await persistence.update(event['id'], EventStatus.SENT)
+    return (time.perf_counter() - start) / number
+
+
+def list_cost(size, number):
+    buffer = ListBuffer(size)
+    for _ in range(size):
+        buffer.store(new_event())
+    events = [new_event() for _ in range(number)]
+    start = time.perf_counter()
+    for event in events:
+        buffer.store(event)
+        buffer.update(event['id'], EventStatus.SENT)
+    return (time.perf_counter() - start) / number
+
+
+def main(sizes):
+    loop = asyncio.get_event_loop()
+    number = 1000
+    for size in sizes:
+        indexed = loop.run_until_complete(deque_cost(size, number))
+        scanned = list_cost(size, number)
+        print('memory_size={:<8} list {:>10.2f} us  deque+index {:>6.2f} us'
+              .format(size, scanned * 1e6, indexed * 1e6))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,75 @@
+"""
+Apply a chain of 50 Extract rules on the same field of 1KB messages, with
+and without the literal prefilter shared by consecutive regex rules. Patterns
+starting with their literal are left to the regex engine, the prefilter only
+applies to the ones that do not.
+
+    python benchmarks/regex_chain.py
+"""
+import random
+import string
+import time
+
+from nyuki.utils.transform import Converter, TRACE_NONE
+
+
+PATTERNS = 50
+MESSAGES = 2000
+MESSAGE_SIZE = 1024
+
+
+TEMPLATES = {
+    'literal prefix': r'event{0:02d}=(?P<value{0}>\w+)',
+    'inner literal': r'(?P<value{0}>\w+)=event{0:02d}',
+}
+
+
+def rules(template):
+    return [
+        {
+            'type': 'extract',
+            'fieldname': 'msg',
+            'pattern': template.format(i),
+        }
+        for i in range(PATTERNS)
+    ]
+
+
+def messages():
+    random.seed(0)
+    alphabet = string.ascii_lowercase + ' ='
+    result = list()
+    for _ in range(MESSAGES):
+        # A few known events per message, random text around them
+        events = ' '.join(
+            'abc=event{0:02d}=abc'.format(i)
+            for i in random.sample(range(PATTERNS), 3)
+        )
+        padding = ''.join(
+            random.choice(alphabet)
+            for _ in range(MESSAGE_SIZE - len(events))
+        )
+        cut = random.randrange(len(padding))
+        result.append(padding[:cut] + events + padding[cut:])
+    return result
+
+
+def main():
+    data = messages()
+    for patterns, template in sorted(TEMPLATES.items()):
+        for name, optimize in (('sequential', False), ('prefiltered', True)):
+            converter = Converter.from_dict(
+                {'rules': rules(template)}, optimize=optimize
+            )
+            records = [{'msg': message} for message in data]
+            start = time.perf_counter()
+            for record in records:
+                converter.apply(record, TRACE_NONE)
+            elapsed = time.perf_counter() - start
+            print('{:<15} {:<12} {:>9.1f} us/message'.format(
+                patterns, name, elapsed / MESSAGES * 1e6
+            ))
+
+
+if __name__ == '__main__':
+    main()
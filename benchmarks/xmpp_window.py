@@ -0,0 +1,78 @@
+"""
+Compare XMPP publication throughput with and without a send window, against
+a local stand-in MUC echoing every message back after a fixed latency.
+
+    python benchmarks/xmpp_window.py [events] [latency_ms]
+"""
+import asyncio
+import sys
+import time
+from unittest.mock import Mock
+
+from nyuki.bus.xmpp import XmppBus
+
+
+class EchoMuc(object):
+
+    """
+    Stand-in for the MUC server, echo messages to the bus like prosody does
+    for the sender's own groupchat messages.
+    """
+
+    def __init__(self, bus, latency):
+        self.bus = bus
+        self.latency = latency
+        self.loop = asyncio.get_event_loop()
+
+    def Message(self):
+        muc = self
+
+        class _Message(dict):
+
+            def send(self):
+                muc.loop.call_later(muc.latency, muc.echo, self)
+
+        return _Message()
+
+    def echo(self, msg):
+        event = {
+            'id': msg['id'],
+            'from': Mock(user=self.bus.name, resource=self.bus.name),
+            'body': msg['body'],
+        }
+        asyncio.ensure_future(self.bus._on_event(event))
+
+
+async def run(count, latency, window):
+    nyuki = Mock(loop=asyncio.get_event_loop())
+    bus = XmppBus(nyuki)
+    bus.name = 'bench'
+    bus._muc_domain = 'mucs.localhost'
+    bus._callbacks[bus.name] = None
+    bus._mucs = Mock(rooms={bus._muc_address(bus.name): None})
+    bus._window = asyncio.Semaphore(window) if window else None
+    bus.client = EchoMuc(bus, latency)
+    bus._connected.set()
+
+    start = time.perf_counter()
+    for i in range(count):
+        await bus.publish({'index': i})
+    if bus._in_flight:
+        await asyncio.wait(bus._in_flight)
+    return time.perf_counter() - start
+
+
+def main(count, latency):
+    loop = asyncio.get_event_loop()
+    for window in (None, 1, 16, 128):
+        elapsed = loop.run_until_complete(run(count, latency, window))
+        print('window={:<5} {:>10.0f} events/s ({} events, {}ms echo)'.format(
+            str(window), count / elapsed, count, latency * 1000
+        ))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+    )
@@ -37,6 +37,15 @@ def content_type(content_type):
     return decorated
 
 
+def streamed(func):
+    """
+    Decorator to let a method (post, put...) read the request body itself,
+    as a stream, instead of having it loaded and validated beforehand.
+    """
+    func.STREAMED = True
+    return func
+
+
 class HTTPBreak(Exception):
 
     def __init__(self, status, body=None):
@@ -106,7 +115,9 @@ async def mw_capability(app, capa_handler):
                     )
 
             # Check multipart/form-data is really a post form
-            if 'multipart/form-data' in required_types:
+            # (streamed bodies are read and checked by the handler)
+            streamed = getattr(capa_handler, 'STREAMED', False)
+            if 'multipart/form-data' in required_types and not streamed:
                 try:
                     await request.post()
                 except ValueError as exc:
@@ -126,7 +137,8 @@ async def mw_capability(app, capa_handler):
             reporting.exception(exc)
             raise
 
-        if capa_resp and isinstance(capa_resp, Response):
+        # Including responses streamed by the handler
+        if isinstance(capa_resp, web.StreamResponse):
             return capa_resp
         return Response()
 
@@ -156,6 +168,7 @@ class ResourceClass:
                 async_handler.CONTENT_TYPE = getattr(
                     handler, 'CONTENT_TYPE', self.content_type
                 )
+                async_handler.STREAMED = getattr(handler, 'STREAMED', False)
                 route = resource.add_route(method, async_handler)
                 log.debug('Added route: %s', route)
 
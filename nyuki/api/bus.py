@@ -68,3 +68,17 @@ class ApiBusPublish:
         asyncio.ensure_future(self.nyuki.bus.publish(
             request.get('data', {}), request.get('topic')
         ))
+
+
+@resource('/bus/persistence', versions=['v1'])
+class ApiBusPersistence:
+
+    async def get(self, request):
+        try:
+            self.nyuki._services.get('bus')
+        except KeyError:
+            return Response(status=404)
+        persistence = self.nyuki.bus.persistence
+        if persistence is None:
+            return Response(status=404)
+        return Response(await persistence.status())
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class _Batch(object):
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.events = list()
+        self.futures = list()
+
+
+class PublishQueue(object):
+
+    """
+    Coalesce published events into batches per topic. A batch is handed to
+    the bus' `publish_many` once it holds `size` events or `delay` seconds
+    after its first event, whichever comes first. Batches of the same topic
+    are published in order.
+    """
+
+    def __init__(self, publish_many, size=100, delay=0.05, loop=None):
+        self._publish_many = publish_many
+        self._size = size
+        self._delay = delay
+        self._loop = loop or asyncio.get_event_loop()
+        self._batches = dict()
+        self._flushing = dict()
+
+    def __len__(self):
+        return sum(len(batch.events) for batch in self._batches.values())
+
+    async def put(self, event, topic):
+        """
+        Queue an event, return once its batch has been published.
+        """
+        batch = self._batches.get(topic)
+        if batch is None:
+            handle = self._loop.call_later(self._delay, self._flush, topic)
+            batch = self._batches[topic] = _Batch(handle)
+
+        future = asyncio.Future(loop=self._loop)
+        batch.events.append(event)
+        batch.futures.append(future)
+        if len(batch.events) >= self._size:
+            self._flush(topic)
+        await future
+
+    def _flush(self, topic):
+        batch = self._batches.pop(topic, None)
+        if batch is None:
+            return
+        batch.handle.cancel()
+        previous = self._flushing.get(topic)
+        task = asyncio.ensure_future(self._publish(topic, batch, previous))
+        self._flushing[topic] = task
+
+        def done(future):
+            if self._flushing.get(topic) is future:
+                del self._flushing[topic]
+        task.add_done_callback(done)
+
+    async def _publish(self, topic, batch, previous=None):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        log.debug(
+            "Flushing %d queued event(s) to '%s'", len(batch.events), topic
+        )
+        try:
+            await self._publish_many(batch.events, topic)
+        except Exception as exc:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_result(None)
+
+    async def close(self):
+        """
+        Publish every pending batch.
+        """
+        for topic in list(self._batches.keys()):
+            self._flush(topic)
+        if self._flushing:
+            await asyncio.wait(list(self._flushing.values()))
@@ -0,0 +1,149 @@
+import json
+import logging
+
+from nyuki.utils import serialize_object
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+log = logging.getLogger(__name__)
+
+
+class _RegisteredCodec(type):
+
+    """
+    Register every codec class defining a NAME.
+    """
+
+    _REGISTRY = {}
+
+    def __new__(mcs, name, bases, attrs):
+        cls = type.__new__(mcs, name, bases, attrs)
+        if cls.NAME:
+            mcs._REGISTRY[cls.NAME] = cls
+        return cls
+
+    @classmethod
+    def names(mcs):
+        return list(mcs._REGISTRY.keys())
+
+    @classmethod
+    def get(mcs, name):
+        codec = mcs._REGISTRY.get(name)
+        if not codec:
+            raise ValueError("Unknown bus codec '{}'".format(name))
+        if not codec.available():
+            raise ValueError(
+                "Bus codec '{}' requires the '{}' package".format(
+                    name, codec.REQUIRES
+                )
+            )
+        return codec()
+
+
+class Codec(metaclass=_RegisteredCodec):
+
+    """
+    Serialize bus events into bytes and back. Decoding errors must be
+    raised as ValueError.
+    """
+
+    NAME = None
+    REQUIRES = None
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+
+    NAME = 'json'
+
+    def encode(self, data):
+        return json.dumps(data, default=serialize_object).encode()
+
+    def decode(self, payload):
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        return json.loads(payload)
+
+
+class OrjsonCodec(Codec):
+
+    NAME = 'orjson'
+    REQUIRES = 'orjson'
+
+    @classmethod
+    def available(cls):
+        return orjson is not None
+
+    def encode(self, data):
+        return orjson.dumps(data, default=serialize_object)
+
+    def decode(self, payload):
+        return orjson.loads(payload)
+
+
+class UjsonCodec(Codec):
+
+    """
+    Data that ujson can't serialize (`default` is not supported by all of
+    its versions) is encoded by the json module.
+    """
+
+    NAME = 'ujson'
+    REQUIRES = 'ujson'
+
+    @classmethod
+    def available(cls):
+        return ujson is not None
+
+    def encode(self, data):
+        try:
+            return ujson.dumps(data).encode()
+        except (TypeError, ValueError, OverflowError):
+            return json.dumps(data, default=serialize_object).encode()
+
+    def decode(self, payload):
+        return ujson.loads(payload)
+
+
+class MsgpackCodec(Codec):
+
+    NAME = 'msgpack'
+    REQUIRES = 'msgpack'
+
+    @classmethod
+    def available(cls):
+        return msgpack is not None
+
+    def encode(self, data):
+        return msgpack.packb(data, default=serialize_object, use_bin_type=True)
+
+    def decode(self, payload):
+        try:
+            return msgpack.unpackb(payload, raw=False)
+        except ValueError:
+            raise
+        except Exception as exc:
+            raise ValueError(exc) from exc
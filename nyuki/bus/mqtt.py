@@ -1,8 +1,6 @@
 import asyncio
 import json
 import logging
-import re
-from collections import namedtuple
 from hbmqtt.client import MQTTClient, ConnectException, ClientException
 from hbmqtt.errors import NoDataException
 from hbmqtt.mqtt.constants import QOS_1
@@ -10,16 +8,15 @@ from uuid import uuid4
 
 from nyuki.bus import reporting
 from nyuki.services import Service
-from nyuki.utils import serialize_object
+from .batch import PublishQueue
+from .codec import Codec
 from .persistence import BusPersistence, EventStatus, PersistenceError
+from .topics import TopicTrie
 
 
 log = logging.getLogger(__name__)
 
 
-MQTTCallback = namedtuple('MQTTCallback', ['regex', 'callbacks'])
-
-
 class MqttBus(Service):
 
     """
@@ -37,8 +34,17 @@ class MqttBus(Service):
                 'type': 'object',
                 'required': ['name'],
                 'properties': {
+                    'batch': {
+                        'type': 'object',
+                        'properties': {
+                            'size': {'type': 'integer', 'minimum': 1},
+                            'delay': {'type': 'number', 'minimum': 0}
+                        },
+                        'additionalProperties': False
+                    },
                     'cafile': {'type': 'string', 'minLength': 1},
                     'certfile': {'type': 'string', 'minLength': 1},
+                    'codec': {'type': 'string', 'enum': Codec.names()},
                     'host': {'type': 'string', 'minLength': 1},
                     'keyfile': {'type': 'string', 'minLength': 1},
                     'name': {'type': 'string', 'minLength': 1},
@@ -49,6 +55,44 @@ class MqttBus(Service):
                             'backend': {
                                 'type': 'string',
                                 'minLength': 1
+                            },
+                            'memory_bytes': {
+                                'type': 'integer',
+                                'minimum': 1
+                            },
+                            'spill': {
+                                'type': 'object',
+                                'required': ['path'],
+                                'properties': {
+                                    'path': {
+                                        'type': 'string',
+                                        'minLength': 1
+                                    },
+                                    'max_bytes': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    }
+                                },
+                                'additionalProperties': False
+                            },
+                            'replay': {
+                                'type': 'object',
+                                'properties': {
+                                    'batch_size': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    },
+                                    'rate': {
+                                        'type': ['number', 'null'],
+                                        'minimum': 0,
+                                        'exclusiveMinimum': True
+                                    },
+                                    'concurrency': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    }
+                                },
+                                'additionalProperties': False
                             }
                         }
                     },
@@ -72,7 +116,9 @@ class MqttBus(Service):
         self.client = None
         self._pending = {}
         self.name = None
-        self._subscriptions = {}
+        self._codec = None
+        self._queue = None
+        self._subscriptions = TopicTrie()
 
         # Coroutines
         self.connect_future = None
@@ -80,11 +126,16 @@ class MqttBus(Service):
 
     @property
     def topics(self):
-        return list(self._subscriptions.keys())
+        return self._subscriptions.topics
+
+    @property
+    def persistence(self):
+        return self._persistence
 
     def configure(self, name, scheme='mqtt', host='localhost', port=1883,
                   cafile=None, certfile=None, keyfile=None, persistence={},
-                  service=None, keep_alive=60, ping_delay=5):
+                  service=None, keep_alive=60, ping_delay=5, codec='json',
+                  batch=None):
         if scheme in ['mqtts', 'wss']:
             if not cafile or not certfile or not keyfile:
                 raise ValueError(
@@ -93,6 +144,7 @@ class MqttBus(Service):
 
         self._host = '{}://{}:{}'.format(scheme, host, port)
         self.name = name
+        self._codec = Codec.get(codec)
         self._cafile = cafile
         self.client = MQTTClient(
             config={
@@ -109,6 +161,14 @@ class MqttBus(Service):
         self._persistence = BusPersistence(name=name, **persistence)
         log.info('Bus persistence set to %s', self._persistence.backend)
 
+        # Coalesce publications into batches
+        if batch is not None:
+            self._queue = PublishQueue(
+                self.publish_many, loop=self._loop, **batch
+            )
+        else:
+            self._queue = None
+
     async def start(self):
         def cancelled(future):
             try:
@@ -127,6 +187,9 @@ class MqttBus(Service):
             )
 
     async def stop(self):
+        # Publish the queued batches while still connected
+        if self._queue:
+            await self._queue.close()
         # Clean client
         if self.client is not None:
             for task in self.client.client_tasks:
@@ -151,14 +214,6 @@ class MqttBus(Service):
         """
         reporting.init(self.name, self)
 
-    def _regex_topic(self, topic):
-        """
-        Transform the MQTT pattern into a regex object.
-        """
-        return re.compile(r'^{}$'.format(
-            topic.replace('+', '[^\/]+').replace('#', '.+')
-        ))
-
     async def replay(self, since=None, status=None):
         """
         Replay events since the given datetime (or all if None)
@@ -170,19 +225,26 @@ class MqttBus(Service):
             msg += ' with status {}'.format(status)
         log.info(msg)
 
-        events = await self._persistence.retrieve(since, status)
-        for event in events:
-            # Publish events one by one in the right publish time order
-            await self.publish(json.loads(
-                event['message']),
-                event['topic'],
-                event['id']
+        async def replay_event(event):
+            # Reuse the already encoded payload
+            payload = event['message']
+            if isinstance(payload, str):
+                # Event stored as a JSON string before bus codecs
+                try:
+                    payload = self._codec.encode(json.loads(payload))
+                except ValueError:
+                    log.error("Can't replay invalid event '%s'", event['id'])
+                    return
+            await self._publish_payloads(
+                [payload], event['topic'], [event['id']]
             )
 
+        await self._persistence.replay(replay_event, since, status)
+
     async def subscribe(self, topic, callback):
         """
         Subscribe to a topic and setup the callback.
-        This will pre-compile the regex used for this topic.
+        The topic filter is indexed in the subscriptions trie.
         """
         if not asyncio.iscoroutinefunction(callback):
             raise ValueError('event callback must be a coroutine')
@@ -190,16 +252,10 @@ class MqttBus(Service):
         log.debug('MQTT subscription to %s->%s', topic, callback.__name__)
         await self.client.subscribe([(topic, QOS_1)])
 
-        try:
-            self._subscriptions[topic].callbacks.add(callback)
-        except KeyError:
-            self._subscriptions[topic] = MQTTCallback(
-                regex=self._regex_topic(topic),
-                callbacks={callback},
-            )
+        self._subscriptions.add(topic, callback)
         log.info(
             'Subscribed to %s: %s callback(s)',
-            topic, len(self._subscriptions[topic].callbacks)
+            topic, len(self._subscriptions.callbacks(topic))
         )
 
     async def unsubscribe(self, topic, callback=None):
@@ -209,12 +265,13 @@ class MqttBus(Service):
         if topic not in self._subscriptions:
             return
 
-        if callback in self._subscriptions[topic].callbacks:
+        if callback in self._subscriptions.callbacks(topic):
             log.debug("MQTT unsubscription from %s->%s", topic, callback.__name__)
-            self._subscriptions[topic].callbacks.remove(callback)
+        elif callback is not None:
+            return
 
-        if callback is None or not self._subscriptions[topic]:
-            del self._subscriptions[topic]
+        # Only unsubscribe from the broker once no callback is left
+        if self._subscriptions.remove(topic, callback):
             await self.client.unsubscribe([topic])
             log.info('Unsubscribed from %s', topic)
 
@@ -222,7 +279,7 @@ class MqttBus(Service):
         """
         Resubscribe on reconnection.
         """
-        for topic in self._subscriptions.keys():
+        for topic in self._subscriptions.topics:
             log.debug('Resubscribing to %s', topic)
             await self.client.subscribe([(topic, QOS_1)])
 
@@ -230,35 +287,72 @@ class MqttBus(Service):
         """
         Publish in given topic or default one
         """
-        uid = previous_uid or str(uuid4())
         topic = topic or self.name
+        if self._queue and previous_uid is None:
+            await self._queue.put(data, topic)
+            return
+
         log.info('Publishing an event to %s', topic)
         log.debug('dump: %s', data)
-        data = json.dumps(data, default=serialize_object)
-
-        # Store the event as PENDING if it is new
-        if self._persistence and previous_uid is None:
-            await self._persistence.store({
-                'id': uid,
-                'status': EventStatus.PENDING.value,
-                'topic': topic,
-                'message': data,
-            })
+        await self._publish_payloads(
+            [self._codec.encode(data)],
+            topic,
+            [previous_uid] if previous_uid else None
+        )
+
+    async def publish_many(self, events, topic=None):
+        """
+        Publish a list of events in given topic or default one, with one
+        persistence store and one status update for the whole batch
+        """
+        if not events:
+            return
+        topic = topic or self.name
+        log.info('Publishing %d events to %s', len(events), topic)
+        await self._publish_payloads(
+            [self._codec.encode(data) for data in events], topic
+        )
+
+    async def _publish_payloads(self, payloads, topic, previous_uids=None):
+        """
+        Publish encoded events, the very same bytes being persisted and sent
+        to the broker. Events are new unless their previous uids are given.
+        """
+        uids = previous_uids or [str(uuid4()) for _ in payloads]
+
+        # Store the events as PENDING if they are new
+        if self._persistence and previous_uids is None:
+            await self._persistence.store_many([
+                {
+                    'id': uid,
+                    'status': EventStatus.PENDING.value,
+                    'topic': topic,
+                    'message': payload,
+                }
+                for uid, payload in zip(uids, payloads)
+            ])
             if self._persistence.memory_buffer.is_full:
                 asyncio.ensure_future(self._nyuki.on_buffer_full(
                     self._persistence.memory_buffer.free_slot
                 ))
 
         if self.client._connected_state.is_set():
-            # Implies QOS_0
-            await self.client.publish(topic, data.encode())
+            # Implies QOS_0: no acknowledgement is awaited, the writes are
+            # pipelined on the connection
+            for payload in payloads:
+                await self.client.publish(topic, payload)
             status = EventStatus.SENT
-            log.info('Event successfully sent to topic %s', topic)
+            log.info(
+                '%d event(s) successfully sent to topic %s',
+                len(payloads), topic
+            )
         else:
             status = EventStatus.FAILED
 
         if self._persistence:
-            await self._persistence.update(previous_uid or uid, status)
+            await self._persistence.update_many(
+                [(uid, status) for uid in uids]
+            )
 
     async def _run(self):
         """
@@ -311,9 +405,20 @@ class MqttBus(Service):
             if topic == self.name:
                 continue
 
-            for mqtt_callback in self._subscriptions.values():
-                if mqtt_callback.regex.match(topic):
-                    data = json.loads(message.data.decode())
-                    log.debug("Event from topic '%s': %s", topic, data)
-                    for callback in mqtt_callback.callbacks:
-                        asyncio.ensure_future(callback(topic, data))
+            matches = self._subscriptions.match(topic)
+            if not matches:
+                continue
+
+            # Decode once for all the matching subscriptions
+            try:
+                data = self._codec.decode(message.data)
+            except ValueError as exc:
+                log.warning(
+                    "Could not decode event from topic '%s': %s", topic, exc
+                )
+                continue
+
+            log.debug("Event from topic '%s': %s", topic, data)
+            for callbacks in matches:
+                for callback in callbacks:
+                    asyncio.ensure_future(callback(topic, data))
@@ -1,18 +1,116 @@
-class PersistenceBackend(object):
+import importlib
+import logging
+import pkgutil
+
+
+log = logging.getLogger(__name__)
+
+
+class _RegisteredBackend(type):
+
+    """
+    Register every backend class defining a NAME. Backends are looked up in
+    the `*_backend.py` modules of this package.
+    """
+
+    _REGISTRY = {}
+    _discovered = False
+
+    def __new__(mcs, name, bases, attrs):
+        cls = type.__new__(mcs, name, bases, attrs)
+        if cls.NAME:
+            mcs._REGISTRY[cls.NAME] = cls
+        return cls
+
+    @classmethod
+    def discover(mcs):
+        package = __name__.rpartition('.')[0]
+        path = importlib.import_module(package).__path__
+        for _, module, _ in pkgutil.iter_modules(path):
+            if not module.endswith('_backend'):
+                continue
+            try:
+                importlib.import_module('{}.{}'.format(package, module))
+            except ImportError as exc:
+                log.debug(
+                    "Persistence backend '%s' unavailable: %s", module, exc
+                )
+        mcs._discovered = True
+
+    @classmethod
+    def names(mcs):
+        if not mcs._discovered:
+            mcs.discover()
+        return list(mcs._REGISTRY.keys())
+
+    @classmethod
+    def get(mcs, name):
+        if name not in mcs._REGISTRY and not mcs._discovered:
+            mcs.discover()
+        backend = mcs._REGISTRY.get(name)
+        if not backend:
+            raise ValueError("Unknown persistence backend '{}'".format(name))
+        return backend
+
+
+class PersistenceBackend(metaclass=_RegisteredBackend):
 
     """
     Base backend object for persistence, a persistence backend should
-    overrides the required methods (store, retrieve).
+    overrides the required methods (store, update, retrieve). Batch methods
+    (store_many, update_many) default to one call per event.
+    Backends are selected after their NAME.
     """
 
+    NAME = None
+
     async def init(self):
         pass
 
+    async def close(self):
+        pass
+
     async def ping(self):
+        """
+        Return the connection state, must not block on the network
+        """
         return True
 
     async def store(self, event):
         raise NotImplementedError
 
+    async def store_many(self, events):
+        """
+        Store a list of events, storing an event that already exists
+        (same 'id') must not duplicate it
+        """
+        for event in events:
+            await self.store(event)
+
+    async def update(self, uid, status):
+        raise NotImplementedError
+
+    async def update_many(self, updates):
+        """
+        Update the status of events from a list of (uid, status)
+        """
+        for uid, status in updates:
+            await self.update(uid, status)
+
     async def retrieve(self, since, status):
         raise NotImplementedError
+
+    async def retrieve_batch(self, since=None, status=None, after=None,
+                             limit=1000):
+        """
+        Return at most `limit` events following the `after` event (last one
+        of the previous batch), in the same order as `retrieve`
+        """
+        events = await self.retrieve(since, status)
+        start = 0
+        if after is not None:
+            for index, event in enumerate(events):
+                if event['id'] == after['id']:
+                    start = index + 1
+                    break
+        return events[start:start + limit]
@@ -1,12 +1,18 @@
+import asyncio
 import logging
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import AutoReconnect, OperationFailure
+from pymongo import ASCENDING, UpdateMany
+from pymongo.errors import (
+    BulkWriteError, ConnectionFailure, OperationFailure
+)
 
 from nyuki.bus.persistence.backend import PersistenceBackend
 
 
 log = logging.getLogger(__name__)
 
+DUPLICATE_KEY = 11000
+
 
 class MongoNotConnectedError(Exception):
     pass
@@ -14,9 +20,20 @@ class MongoNotConnectedError(Exception):
 
 class MongoBackend(PersistenceBackend):
 
+    """
+    The connection state is monitored in the background, operations fail
+    fast while the server is known to be unreachable.
+    """
+
+    NAME = 'mongo'
+    HEALTH_INTERVAL = 5
+    HEALTH_TIMEOUT = 2
+
     def __init__(self, name, host='localhost', ttl=3600, **kwargs):
         self.name = name
         self.client = None
+        self._connected = False
+        self._monitor = None
         self.db = None
         self.host = host
         self.ttl = ttl
@@ -29,20 +46,82 @@ class MongoBackend(PersistenceBackend):
     def __str__(self):
         return "<MongoBackend with host '{}'>".format(self.host)
 
+    @property
+    def connected(self):
+        return self._connected
+
     async def ping(self):
+        return self._connected
+
+    async def _ping(self):
         try:
-            await self.client.admin.command('ping')
-        except AutoReconnect:
-            return False
+            await asyncio.wait_for(
+                self.client.admin.command('ping'), self.HEALTH_TIMEOUT
+            )
+        except (ConnectionFailure, asyncio.TimeoutError):
+            connected = False
         else:
-            return True
+            connected = True
+
+        if connected != self._connected:
+            if connected:
+                log.info('Connected to mongo at %s', self.host)
+            else:
+                log.warning('Connection to mongo at %s lost', self.host)
+        self._connected = connected
+        return connected
+
+    async def _check_health(self):
+        """
+        Periodically ping the server to keep the connection state up to date
+        """
+        while True:
+            await asyncio.sleep(self.HEALTH_INTERVAL)
+            try:
+                await self._ping()
+            except Exception:
+                log.exception('Unexpected error while pinging mongo')
+                self._connected = False
+
+    def _check_connected(self):
+        if not self._connected:
+            raise MongoNotConnectedError
+
+    def _disconnected(self, exc):
+        """
+        Driver connection errors mark the backend as disconnected until the
+        next successful health check
+        """
+        log.warning('Lost connection to mongo: %s', exc)
+        self._connected = False
+        return MongoNotConnectedError(str(exc))
 
     async def init(self):
         # Get collection for this nyuki
         self.client = AsyncIOMotorClient(self.host, **self._options)
         self.db = self.client['bus_persistence']
         self._collection = self.db[self.name]
+        if self._monitor is None:
+            self._monitor = asyncio.ensure_future(self._check_health())
+        if await self._ping():
+            await self._ensure_indexes()
+
+    async def close(self):
+        if self._monitor:
+            self._monitor.cancel()
+            try:
+                await self._monitor
+            except asyncio.CancelledError:
+                pass
+            self._monitor = None
+        if self.client:
+            self.client.close()
+        self._connected = False
+
+    async def _ensure_indexes(self):
         await self._index_ttl()
+        await self._index_id()
+        self._indexed = True
 
     async def _index_ttl(self):
         # Set a TTL to the documents in this collection
@@ -58,30 +137,76 @@ class MongoBackend(PersistenceBackend):
             await self._collection.drop_index('created_at_1')
             await index()
 
-        self._indexed = True
+    async def _index_id(self):
+        # Event ids are unique, storing an event twice must not duplicate it
+        try:
+            await self._collection.create_index('id', unique=True)
+        except OperationFailure as exc:
+            log.warning('Could not set a unique index on event ids: %s', exc)
 
     async def store(self, event):
-        if not await self.ping():
-            raise MongoNotConnectedError
+        self._check_connected()
 
-        if not self._indexed:
-            await self._index_ttl()
+        try:
+            if not self._indexed:
+                await self._ensure_indexes()
+            await self._collection.insert(event)
+        except ConnectionFailure as exc:
+            raise self._disconnected(exc) from exc
 
-        await self._collection.insert(event)
+    async def store_many(self, events):
+        self._check_connected()
+
+        try:
+            if not self._indexed:
+                await self._ensure_indexes()
+            # Unordered bulk insert, already stored events (retried batch) are
+            # rejected as duplicates without stopping the others
+            await self._collection.insert_many(events, ordered=False)
+        except BulkWriteError as exc:
+            errors = [
+                error for error in exc.details.get('writeErrors', [])
+                if error.get('code') != DUPLICATE_KEY
+            ]
+            if errors or exc.details.get('writeConcernErrors'):
+                raise
+            log.debug(
+                '%d event(s) were already stored',
+                len(exc.details['writeErrors'])
+            )
+        except ConnectionFailure as exc:
+            raise self._disconnected(exc) from exc
 
     async def update(self, uid, status):
-        if not await self.ping():
-            raise MongoNotConnectedError
+        self._check_connected()
 
-        await self._collection.update(
-            {'id': uid},
-            {'$set': {'status': status.value}}
-        )
+        try:
+            await self._collection.update(
+                {'id': uid},
+                {'$set': {'status': status.value}}
+            )
+        except ConnectionFailure as exc:
+            raise self._disconnected(exc) from exc
 
-    async def retrieve(self, since=None, status=None):
-        if not await self.ping():
-            raise MongoNotConnectedError
+    async def update_many(self, updates):
+        self._check_connected()
+
+        # One update request per status, keeping the last status of an event
+        by_status = dict()
+        for uid, status in dict(updates).items():
+            by_status.setdefault(status.value, list()).append(uid)
+        if not by_status:
+            return
 
+        try:
+            await self._collection.bulk_write([
+                UpdateMany({'id': {'$in': uids}}, {'$set': {'status': status}})
+                for status, uids in by_status.items()
+            ], ordered=False)
+        except ConnectionFailure as exc:
+            raise self._disconnected(exc) from exc
+
+    def _query(self, since=None, status=None):
         query = {}
 
         if since:
@@ -93,7 +218,40 @@ class MongoBackend(PersistenceBackend):
             else:
                 query['status'] = status.value
 
-        cursor = self._collection.find(query)
+        return query
+
+    async def retrieve(self, since=None, status=None):
+        self._check_connected()
+
+        cursor = self._collection.find(self._query(since, status))
         cursor.sort('created_at')
 
-        return await cursor.to_list(None)
+        try:
+            return await cursor.to_list(None)
+        except ConnectionFailure as exc:
+            raise self._disconnected(exc) from exc
+
+    async def retrieve_batch(self, since=None, status=None, after=None,
+                             limit=1000):
+        self._check_connected()
+
+        # Keyset pagination on (created_at, _id), no cursor is kept open
+        # between batches
+        query = self._query(since, status)
+        if after is not None:
+            query['$or'] = [
+                {'created_at': {'$gt': after['created_at']}},
+                {
+                    'created_at': after['created_at'],
+                    '_id': {'$gt': after['_id']},
+                },
+            ]
+
+        cursor = self._collection.find(query)
+        cursor.sort([('created_at', ASCENDING), ('_id', ASCENDING)])
+        cursor.limit(limit)
+
+        try:
+            return await cursor.to_list(limit)
+        except ConnectionFailure as exc:
+            raise self._disconnected(exc) from exc
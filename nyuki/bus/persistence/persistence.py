@@ -1,11 +1,14 @@
 import asyncio
+from collections import deque
+from itertools import chain
 from datetime import datetime
 import logging
+from operator import itemgetter
 
 from nyuki.bus import reporting
 from nyuki.bus.persistence.backend import PersistenceBackend
 from nyuki.bus.persistence.events import EventStatus
-from nyuki.bus.persistence.mongo_backend import MongoBackend
+from nyuki.bus.persistence.spill import SpillFile
 
 
 log = logging.getLogger(__name__)
@@ -17,48 +20,135 @@ class PersistenceError(Exception):
 
 class FIFOSizedQueue(object):
 
-    def __init__(self, size):
-        self._list = list()
+    """
+    Bounded FIFO evicting its oldest items when full, either by item count
+    or by total weight (e.g. bytes). Evicted items are handed to `on_evict`
+    if set, dropped otherwise. Items can be indexed by a key (e.g. an event
+    id) for direct access.
+    """
+
+    def __init__(self, size, key=None, max_weight=None, weight=None,
+                 on_evict=None):
+        self._items = deque()
+        self._index = dict()
+        self._key = key
         self._size = size
+        self._max_weight = max_weight
+        self._weight = weight or (lambda item: 0)
+        self._total_weight = 0
+        self._on_evict = on_evict
+        self._full = False
+        self.dropped = 0
         self._free_slot = asyncio.Event()
         self._free_slot.set()
 
     def __len__(self):
-        return len(self._list)
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._index
 
     @property
     def size(self):
         return self._size
 
+    @property
+    def weight(self):
+        return self._total_weight
+
     @property
     def list(self):
-        return self._list
+        return self._items
 
     @property
     def is_full(self):
-        return len(self._list) >= self._size
+        return self._full
 
     @property
     def free_slot(self):
         return self._free_slot
 
-    def put(self, item):
-        while self.is_full:
-            log.debug('queue full (%d), poping first item', len(self._list))
-            self._list.pop(0)
-        self._list.append(item)
-        if self.is_full:
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    def _overflows(self, extra=0):
+        if len(self._items) >= self._size:
+            return True
+        return self._max_weight is not None and \
+            self._total_weight + extra > self._max_weight
+
+    def _update_full(self, full):
+        self._full = full or self._overflows()
+        if self._full:
             self._free_slot.clear()
+        else:
+            self._free_slot.set()
+
+    def put(self, item):
+        weight = self._weight(item)
+        evicted = False
+        while self._items and self._overflows(weight):
+            log.debug('queue full (%d), poping first item', len(self._items))
+            self._evict(self._pop())
+            evicted = True
+        self._items.append(item)
+        self._total_weight += weight
+        if self._key is not None:
+            self._index[self._key(item)] = item
+        self._update_full(evicted)
+
+    def _pop(self):
+        item = self._items.popleft()
+        self._total_weight -= self._weight(item)
+        self._unindex(item)
+        return item
+
+    def _evict(self, item):
+        if self._on_evict is not None:
+            self._on_evict(item)
+        else:
+            self.dropped += 1
 
     def pop(self):
-        item = self._list.pop(0)
-        self._free_slot.set()
+        item = self._pop()
+        self._update_full(False)
         return item
 
     def empty(self):
-        while self._list:
+        while self._items:
             yield self.pop()
 
+    def requeue(self, items):
+        """
+        Put back previously popped items in front of the queue, the oldest
+        ones are evicted if there is not enough room.
+        """
+        items = deque(items)
+        weight = sum(self._weight(item) for item in items)
+        evicted = False
+        while items and (
+                len(self._items) + len(items) > self._size or (
+                    self._max_weight is not None and
+                    self._total_weight + weight > self._max_weight)):
+            item = items.popleft()
+            weight -= self._weight(item)
+            self._evict(item)
+            evicted = True
+        self._items.extendleft(reversed(items))
+        self._total_weight += weight
+        if self._key is not None:
+            for item in items:
+                self._index.setdefault(self._key(item), item)
+        self._update_full(evicted)
+
+    def _unindex(self, item):
+        if self._key is None:
+            return
+        key = self._key(item)
+        # Do not drop the entry of a newer item stored with the same key
+        if self._index.get(key) is item:
+            del self._index[key]
+
 
 class BusPersistence(object):
 
@@ -68,25 +158,46 @@ class BusPersistence(object):
     """
 
     FEED_DELAY = 5
-
-    def __init__(self, backend=None, memory_size=None, loop=None, **kwargs):
+    FEED_CHUNK = 1000
+    REPLAY = {
+        'batch_size': 1000,
+        'rate': None,
+        'concurrency': 1,
+    }
+
+    def __init__(self, backend=None, memory_size=None, memory_bytes=None,
+                 spill=None, replay=None, loop=None, **kwargs):
         """
-        TODO: mongo is the only one yet, we should parse available modules
-              named `*_backend.py` and select after the given backend.
+        The backend is selected after its name among the `*_backend.py`
+        modules of this package (e.g. 'mongo', 'sqlite').
+        The in-memory buffer is bounded by event count (`memory_size`) and
+        optionally by bytes (`memory_bytes`). Evicted events are spilled
+        into a file if `spill` is set ({'path', 'max_bytes'}), dropped
+        otherwise.
         """
         self._loop = loop or asyncio.get_event_loop()
-        self._last_events = FIFOSizedQueue(memory_size or 10000)
+        self._spill = SpillFile(**spill) if spill else None
+        # Status changes of spilled events
+        self._spill_status = dict()
+        self._last_events = FIFOSizedQueue(
+            memory_size or 10000,
+            key=itemgetter('id'),
+            max_weight=memory_bytes,
+            weight=_event_size,
+            on_evict=self._spill.append if self._spill is not None else None
+        )
         self.backend = None
         self._feed_future = None
+        # Events being written into the backend, and their status changes
+        self._flushing = dict()
+        self._late_updates = dict()
+        self._replay = dict(self.REPLAY, **(replay or {}))
 
         if not backend:
             log.info('No persistence backend selected, in-memory only')
             return
 
-        if backend != 'mongo':
-            raise ValueError("'mongo' is the only available backend")
-
-        self.backend = MongoBackend(**kwargs)
+        self.backend = PersistenceBackend.get(backend)(**kwargs)
         if not isinstance(self.backend, PersistenceBackend):
             raise PersistenceError('Wrong backend selected: {}'.format(backend))
         self._feed_future = asyncio.ensure_future(self._feed_backend())
@@ -99,6 +210,10 @@ class BusPersistence(object):
         if self._feed_future:
             self._feed_future.cancel()
             await self._feed_future
+        if self.backend:
+            await self.backend.close()
+        if self._spill is not None:
+            self._spill.close()
 
     async def _feed_backend(self):
         """
@@ -113,22 +228,72 @@ class BusPersistence(object):
                 await self._empty_last_events()
                 break
 
-            if not self._last_events.list:
+            if not self._last_events.list and not self._spill:
                 continue
 
             await self._empty_last_events()
 
     async def _empty_last_events(self):
-        if await self.backend.ping():
-            if self._last_events.list:
-                log.info('Dumping all event into backend')
+        if not await self.backend.ping():
+            log.warning('No connection to backend to empty in-memory events')
+            return
+
+        if self._last_events.list or self._spill:
+            log.info('Dumping all event into backend')
+
+        # Spilled events are the oldest ones
+        if not await self._empty_spill():
+            return
+
+        while self._last_events.list:
+            count = min(self.FEED_CHUNK, len(self._last_events))
+            chunk = [self._last_events.pop() for _ in range(count)]
+            self._flushing = {event['id']: event for event in chunk}
             try:
-                for event in self._last_events.empty():
-                    await self.backend.store(event)
+                await self.backend.store_many(chunk)
             except Exception as exc:
+                # Events already carry their latest status, stored ones won't
+                # be duplicated when retried
                 reporting.exception(exc)
-        else:
-            log.warning('No connection to backend to empty in-memory events')
+                self._last_events.requeue(chunk)
+                self._flushing = dict()
+                self._late_updates = dict()
+                break
+
+            updates = list(self._late_updates.items())
+            self._flushing = dict()
+            self._late_updates = dict()
+            if updates:
+                await self._update_backend(updates)
+
+    async def _empty_spill(self):
+        """
+        Store spilled events into the backend, return False on failure
+        """
+        while self._spill:
+            chunk, position = self._spill.peek(self.FEED_CHUNK)
+            applied = dict()
+            for event in chunk:
+                status = self._spill_status.get(event['id'])
+                if status is not None:
+                    event['status'] = status.value
+                    applied[event['id']] = status
+            try:
+                await self.backend.store_many(chunk)
+            except Exception as exc:
+                reporting.exception(exc)
+                return False
+
+            self._spill.discard(position)
+            # Status changes received while storing
+            updates = list()
+            for event in chunk:
+                status = self._spill_status.pop(event['id'], None)
+                if status is not None and status != applied.get(event['id']):
+                    updates.append((event['id'], status))
+            if updates:
+                await self._update_backend(updates)
+        return True
 
     async def init(self):
         """
@@ -142,14 +307,34 @@ class BusPersistence(object):
 
     async def ping(self):
         """
-        Connection check
+        Connection check, from the backend's last known state
         """
         if self.backend:
-            try:
-                return await asyncio.wait_for(self.backend.ping(), 2.0)
-            except asyncio.TimeoutError:
-                log.error('Timeout pinging backend')
-                return False
+            return await self.backend.ping()
+
+    async def status(self):
+        """
+        Persistence state summary
+        """
+        memory = self._last_events
+        return {
+            'backend': str(self.backend) if self.backend else None,
+            'connected': await self.ping(),
+            'memory': {
+                'size': memory.size,
+                'count': len(memory),
+                'bytes': memory.weight,
+            },
+            'spill': {
+                'path': self._spill.path,
+                'count': len(self._spill),
+                'bytes': self._spill.bytes,
+                'spilled': self._spill.spilled,
+            } if self._spill is not None else None,
+            'dropped': memory.dropped + (
+                self._spill.dropped if self._spill is not None else 0
+            ),
+        }
 
     async def store(self, event):
         """
@@ -166,49 +351,88 @@ class BusPersistence(object):
         event['created_at'] = datetime.utcnow()
         self._last_events.put(event)
 
+    async def store_many(self, events):
+        """
+        Store a batch of bus events at once (see `store`), sharing the same
+        'created_at' value.
+        """
+        log.debug('%d new events stored', len(events))
+        now = datetime.utcnow()
+        for event in events:
+            event['created_at'] = now
+            self._last_events.put(event)
+
     async def update(self, uid, status):
         """
         Update the status of a stored event
         """
-        log.debug("Updating status of event '%s' to '%s'", uid, status)
-        for event in self._last_events.list:
-            if event['id'] == uid:
+        await self.update_many([(uid, status)])
+
+    async def update_many(self, updates):
+        """
+        Update the status of stored events from a list of (uid, status)
+        """
+        missing = list()
+        for uid, status in updates:
+            log.debug("Updating status of event '%s' to '%s'", uid, status)
+            event = self._last_events.get(uid)
+            if event is None:
+                event = self._flushing.get(uid)
+                if event is not None:
+                    # Being stored, update the backend once it is done
+                    self._late_updates[uid] = status
+            if event is not None:
                 event['status'] = status.value
-                return
+            elif self._spill and uid in self._spill:
+                self._set_spill_status(uid, status)
+            else:
+                missing.append((uid, status))
+
+        if not missing:
+            return
 
-        log.debug('event not found in memory, checking backend')
+        log.debug(
+            '%d event(s) not found in memory, checking backend', len(missing)
+        )
 
         if self.backend:
-            async def _ensure_status():
-                while True:
-                    try:
-                        return await self.backend.update(uid, status)
-                    except Exception as exc:
-                        reporting.exception(exc)
-                    log.error('Backend not available, retrying update in 5')
-                    await asyncio.sleep(5)
-            asyncio.ensure_future(_ensure_status())
+            asyncio.ensure_future(self._update_backend(missing))
+
+    def _set_spill_status(self, uid, status):
+        self._spill_status[uid] = status
+        # Forget the status of events dropped from the spill file
+        if len(self._spill_status) > 2 * len(self._spill) + 1000:
+            self._spill_status = {
+                uid: status for uid, status in self._spill_status.items()
+                if uid in self._spill
+            }
+
+    def _spilled_events(self, since=None, status=None):
+        """
+        Iterate over spilled events with their latest status
+        """
+        if self._spill is None:
+            return
+        for event in self._spill.iterate():
+            status_change = self._spill_status.get(event['id'])
+            if status_change is not None:
+                event['status'] = status_change.value
+            if _match(event, since, status):
+                yield event
+
+    async def _update_backend(self, updates):
+        while True:
+            try:
+                return await self.backend.update_many(updates)
+            except Exception as exc:
+                reporting.exception(exc)
+            log.error('Backend not available, retrying update in 5')
+            await asyncio.sleep(5)
 
     async def retrieve(self, since=None, status=None):
         """
         Return the list of events stored since the given datetime
         """
-        # Retrieve in-memory
-        def check_params(item):
-            since_check = True
-            status_check = True
-
-            if since:
-                since_check = item['created_at'] >= since
-
-            if status:
-                if isinstance(status, list):
-                    status_check = EventStatus[item['status']] in status
-                else:
-                    status_check = item['status'] == status.value
-
-            return since_check and status_check
-
         in_backend = list()
 
         if self.backend:
@@ -225,5 +449,151 @@ class BusPersistence(object):
 
             in_backend = await _ensure_backend()
 
-        in_memory = list(filter(check_params, self._last_events.list))
-        return in_backend + in_memory
+        # Retrieve spilled and in-memory
+        in_memory = [
+            event for event in self._last_events.list
+            if _match(event, since, status)
+        ]
+        return in_backend + list(self._spilled_events(since, status)) + \
+            in_memory
+
+    def iterate(self, since=None, status=None, batch_size=None):
+        """
+        Asynchronously iterate over the events stored since the given
+        datetime, backend events being fetched by batches
+        """
+        return EventStream(
+            self, since, status, batch_size or self._replay['batch_size']
+        )
+
+    async def replay(self, publish, since=None, status=None):
+        """
+        Call the coroutine `publish(event)` for each stored event, limiting
+        the number of concurrent publications and their rate (events/s)
+        """
+        concurrency = self._replay['concurrency']
+        rate = self._replay['rate']
+        interval = 1 / rate if rate else 0
+        window = asyncio.Semaphore(concurrency)
+        pending = set()
+        next_at = self._loop.time()
+
+        def done(task):
+            pending.discard(task)
+            window.release()
+            if not task.cancelled() and task.exception():
+                reporting.exception(task.exception())
+
+        count = 0
+        async for event in self.iterate(since, status):
+            if interval:
+                delay = next_at - self._loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_at = max(next_at, self._loop.time()) + interval
+            await window.acquire()
+            task = asyncio.ensure_future(publish(event))
+            pending.add(task)
+            task.add_done_callback(done)
+            count += 1
+
+        if pending:
+            await asyncio.wait(pending)
+        log.info('%d event(s) replayed', count)
+
+
+def _byte_len(value):
+    if isinstance(value, str):
+        return len(value.encode())
+    return len(value)
+
+
+def _event_size(event):
+    return _byte_len(event.get('message') or b'') + \
+        _byte_len(event['id']) + _byte_len(event.get('topic') or b'')
+
+
+def _match(event, since=None, status=None):
+    if since and event['created_at'] < since:
+        return False
+    if status:
+        if isinstance(status, list):
+            return EventStatus[event['status']] in status
+        return event['status'] == status.value
+    return True
+
+
+class EventStream(object):
+
+    """
+    Async iterator over stored events, backend ones first (fetched by
+    batches), then the spilled and in-memory ones. Only one batch is held at
+    a time.
+    """
+
+    RETRY_DELAY = 5
+
+    def __init__(self, persistence, since, status, batch_size):
+        self._backend = persistence.backend
+        self._spill = persistence._spill
+        self._spilled = persistence._spilled_events(since, status)
+        self._since = since
+        self._status = status
+        self._batch_size = batch_size
+        self._batch = deque()
+        self._last = None
+        # Snapshot of the in-memory events, events flushed into the backend
+        # meanwhile must not be replayed twice
+        self._memory = deque(
+            event for event in chain(
+                persistence._flushing.values(),
+                persistence.memory_buffer.list
+            )
+            if _match(event, since, status)
+        )
+        self._memory_ids = {event['id'] for event in self._memory}
+        self._exhausted = self._backend is None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self._batch or not self._exhausted:
+            while self._batch:
+                event = self._batch.popleft()
+                if event['id'] in self._memory_ids:
+                    continue
+                if self._spill is not None and event['id'] in self._spill:
+                    continue
+                return event
+            if not self._exhausted:
+                await self._fetch()
+
+        for event in self._spilled:
+            return event
+
+        if self._memory:
+            return self._memory.popleft()
+        raise StopAsyncIteration
+
+    async def _fetch(self):
+        while True:
+            try:
+                batch = await self._backend.retrieve_batch(
+                    self._since, self._status, self._last, self._batch_size
+                )
+            except Exception as exc:
+                reporting.exception(exc)
+            else:
+                break
+            log.error(
+                'Backend not available, retrying retrieve in %d',
+                self.RETRY_DELAY
+            )
+            await asyncio.sleep(self.RETRY_DELAY)
+
+        if len(batch) < self._batch_size:
+            self._exhausted = True
+        if batch:
+            self._last = batch[-1]
+            self._batch.extend(batch)
@@ -0,0 +1,201 @@
+from collections import deque
+from itertools import islice
+import logging
+import os
+import pickle
+import struct
+
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>I')
+# Do not rewrite the file for less than this amount of reclaimable bytes
+COMPACT_MIN = 1024 * 1024
+
+
+class SpillFile(object):
+
+    """
+    Append-only file holding the events evicted from the in-memory buffer,
+    oldest first. It is bounded by `max_bytes`: the oldest events are
+    dropped (ring-like) once it is reached. Consumed space at the head of the
+    file is reclaimed by rewriting the live records once it gets large.
+    A `persistent` file is kept on close and its records are recovered
+    when it is opened again.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, persistent=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        # (uid, record size) of live records, from the head of the file
+        self._records = deque()
+        self._ids = set()
+        self._start = 0
+        self._end = 0
+        self._bytes = 0
+        # Number of records removed from the head since the beginning
+        self._removed = 0
+        self.spilled = 0
+        self.dropped = 0
+        if persistent and os.path.exists(self.path):
+            self._file = open(self.path, 'r+b')
+            self._recover()
+        else:
+            # Truncate any previous content, events are not recovered
+            self._file = open(self.path, 'w+b')
+
+    def _recover(self):
+        """
+        Index the records of an existing file, a record partially written
+        at its end is truncated
+        """
+        offset = 0
+        while True:
+            self._file.seek(offset)
+            header = self._file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            size, = HEADER.unpack(header)
+            try:
+                event = pickle.loads(self._file.read(size))
+            except Exception:
+                log.warning('Truncating spill file %s at %d', self.path, offset)
+                break
+            self._records.append((event['id'], HEADER.size + size))
+            self._ids.add(event['id'])
+            offset += HEADER.size + size
+        self._file.truncate(offset)
+        self._end = self._bytes = offset
+        if self._records:
+            log.info(
+                '%d record(s) recovered from %s', len(self._records), self.path
+            )
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, uid):
+        return uid in self._ids
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def append(self, event):
+        data = pickle.dumps(event, pickle.HIGHEST_PROTOCOL)
+        self._file.seek(self._end)
+        self._file.write(HEADER.pack(len(data)))
+        self._file.write(data)
+        size = HEADER.size + len(data)
+        self._end += size
+        self._bytes += size
+        self._records.append((event['id'], size))
+        self._ids.add(event['id'])
+        self.spilled += 1
+
+        while self._bytes > self.max_bytes and len(self._records) > 1:
+            self._remove_head(1)
+            self.dropped += 1
+
+    def _remove_head(self, count):
+        for _ in range(count):
+            uid, size = self._records.popleft()
+            self._ids.discard(uid)
+            self._start += size
+            self._bytes -= size
+            self._removed += 1
+        if not self._records:
+            self.clear()
+        elif self._start > max(self._bytes, COMPACT_MIN):
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the live records at the beginning of a new file
+        """
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'wb') as tmp:
+            self._file.seek(self._start)
+            remaining = self._bytes
+            while remaining:
+                chunk = self._file.read(min(remaining, 1024 * 1024))
+                tmp.write(chunk)
+                remaining -= len(chunk)
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'r+b')
+        self._start = 0
+        self._end = self._bytes
+
+    def _read(self, offset, count):
+        events = list()
+        for _ in range(count):
+            self._file.seek(offset)
+            size, = HEADER.unpack(self._file.read(HEADER.size))
+            events.append(pickle.loads(self._file.read(size)))
+            offset += HEADER.size + size
+        return events, offset
+
+    def peek(self, count):
+        """
+        Return the `count` oldest events and a position token to discard
+        them once processed
+        """
+        count = min(count, len(self._records))
+        events, _ = self._read(self._start, count)
+        return events, self._removed + count
+
+    def discard(self, position):
+        """
+        Remove the events returned by `peek`, unless they were dropped
+        meanwhile
+        """
+        count = min(position - self._removed, len(self._records))
+        if count > 0:
+            self._remove_head(count)
+
+    def iterate(self, chunk=1000):
+        """
+        Iterate over the events currently spilled, `chunk` at a time
+        """
+        # Absolute record indexes, records can be removed meanwhile
+        index = self._removed
+        end = self._removed + len(self._records)
+        offset = self._start
+        removed = self._removed
+        while True:
+            if self._removed != removed:
+                # Head records removed (and file maybe compacted)
+                index = max(index, self._removed)
+                removed = self._removed
+                offset = self._start + sum(
+                    size for _, size in islice(self._records, index - removed)
+                )
+            if index >= end:
+                break
+            count = min(chunk, end - index)
+            events, offset = self._read(offset, count)
+            index += count
+            yield from events
+
+    def clear(self):
+        self._removed += len(self._records)
+        self._records.clear()
+        self._ids.clear()
+        self._file.seek(0)
+        self._file.truncate()
+        self._start = self._end = self._bytes = 0
+
+    def close(self):
+        if self.persistent:
+            # Only keep the live records
+            if self._start:
+                self._compact()
+            self._file.close()
+            return
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
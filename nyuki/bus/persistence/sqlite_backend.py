@@ -0,0 +1,229 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+
+from nyuki.bus.persistence.backend import PersistenceBackend
+
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _to_us(date):
+    return (date - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+class SqliteBackend(PersistenceBackend):
+
+    """
+    Local persistence in a SQLite database (WAL journal), for nyukis with no
+    network storage. Queries run in a dedicated thread, writes are grouped
+    into a single transaction (and fsync) every `commit_delay` seconds.
+    """
+
+    NAME = 'sqlite'
+    PURGE_INTERVAL = 60
+
+    def __init__(self, name, path='bus_persistence.sqlite3', ttl=3600,
+                 commit_delay=0.05, loop=None):
+        self.name = name
+        self.path = path
+        self.ttl = ttl
+        self.commit_delay = commit_delay
+        self._loop = loop or asyncio.get_event_loop()
+        self._table = '"{}"'.format(name.replace('"', '""'))
+        self._executor = None
+        self._conn = None
+        self._writes = list()
+        self._commit_handle = None
+        self._purge_future = None
+
+    def __str__(self):
+        return "<SqliteBackend with path '{}'>".format(self.path)
+
+    def _run(self, func, *args):
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    async def init(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        await self._run(self._connect)
+        self._purge_future = asyncio.ensure_future(self._purge())
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # One fsync per grouped commit
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            'id TEXT PRIMARY KEY, '
+            'status TEXT NOT NULL, '
+            'topic TEXT, '
+            'message BLOB, '
+            'created_at INTEGER NOT NULL)'.format(self._table)
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS "{}_created_at" ON {} '
+            '(created_at)'.format(self.name.replace('"', '""'), self._table)
+        )
+
+    async def ping(self):
+        return self._conn is not None
+
+    async def close(self):
+        if self._purge_future:
+            self._purge_future.cancel()
+            try:
+                await self._purge_future
+            except asyncio.CancelledError:
+                pass
+            self._purge_future = None
+        if self._executor is None:
+            return
+        await self._commit()
+        await self._run(self._conn.close)
+        self._conn = None
+        self._executor.shutdown()
+        self._executor = None
+
+    async def _purge(self):
+        """
+        Periodically remove events older than the TTL
+        """
+        while True:
+            limit = datetime.utcnow() - timedelta(seconds=self.ttl)
+            try:
+                await self._write(
+                    'DELETE FROM {} WHERE created_at < ?'.format(self._table),
+                    [(_to_us(limit),)]
+                )
+            except sqlite3.Error as exc:
+                log.error('Could not purge old events: %s', exc)
+            await asyncio.sleep(self.PURGE_INTERVAL)
+
+    def _write(self, query, rows):
+        """
+        Queue a write query, committed with the other ones in a single
+        transaction. Return a future resolved once committed.
+        """
+        future = asyncio.Future(loop=self._loop)
+        self._writes.append((query, rows, future))
+        if self._commit_handle is None:
+            self._commit_handle = self._loop.call_later(
+                self.commit_delay,
+                lambda: asyncio.ensure_future(self._commit())
+            )
+        return future
+
+    async def _commit(self):
+        if self._commit_handle:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        writes, self._writes = self._writes, list()
+        if not writes:
+            return
+
+        try:
+            await self._run(self._execute_writes, writes)
+        except Exception as exc:
+            for _, _, future in writes:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for _, _, future in writes:
+                if not future.done():
+                    future.set_result(None)
+
+    def _execute_writes(self, writes):
+        self._conn.execute('BEGIN')
+        try:
+            for query, rows, _ in writes:
+                self._conn.executemany(query, rows)
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    async def store(self, event):
+        await self.store_many([event])
+
+    async def store_many(self, events):
+        # Already stored events (retried batch) are ignored
+        await self._write(
+            'INSERT OR IGNORE INTO {} (id, status, topic, message, created_at)'
+            ' VALUES (?, ?, ?, ?, ?)'.format(self._table),
+            [
+                (
+                    event['id'], event['status'], event.get('topic'),
+                    event.get('message'), _to_us(event['created_at'])
+                )
+                for event in events
+            ]
+        )
+
+    async def update(self, uid, status):
+        await self.update_many([(uid, status)])
+
+    async def update_many(self, updates):
+        await self._write(
+            'UPDATE {} SET status = ? WHERE id = ?'.format(self._table),
+            [(status.value, uid) for uid, status in updates]
+        )
+
+    def _select(self, since=None, status=None, after=None, limit=None):
+        query = 'SELECT rowid, id, status, topic, message, created_at ' \
+                'FROM {}'.format(self._table)
+        where = list()
+        params = list()
+
+        if since:
+            where.append('created_at >= ?')
+            params.append(_to_us(since))
+
+        if status:
+            if not isinstance(status, list):
+                status = [status]
+            where.append('status IN ({})'.format(','.join('?' * len(status))))
+            params.extend(es.value for es in status)
+
+        if after is not None:
+            where.append('(created_at > ? OR (created_at = ? AND rowid > ?))')
+            created_at = _to_us(after['created_at'])
+            params.extend((created_at, created_at, after['_id']))
+
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY created_at, rowid'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        return [
+            {
+                '_id': rowid,
+                'id': uid,
+                'status': status,
+                'topic': topic,
+                'message': message,
+                'created_at': _from_us(created_at),
+            }
+            for rowid, uid, status, topic, message, created_at
+            in self._conn.execute(query, params)
+        ]
+
+    async def retrieve(self, since=None, status=None):
+        # Read pending writes as well
+        await self._commit()
+        return await self._run(self._select, since, status)
+
+    async def retrieve_batch(self, since=None, status=None, after=None,
+                             limit=1000):
+        await self._commit()
+        return await self._run(self._select, since, status, after, limit)
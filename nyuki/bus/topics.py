@@ -0,0 +1,126 @@
+class _TopicNode(object):
+
+    __slots__ = ('children', 'callbacks', 'topic')
+
+    def __init__(self):
+        self.children = {}
+        # Set only if a subscription ends on this node
+        self.callbacks = None
+        self.topic = None
+
+
+class TopicTrie(object):
+
+    """
+    Store MQTT topic filters in a trie indexed by topic levels ('/'), with
+    '+' (single level) and '#' (multi level) wildcard nodes. Matching a topic
+    only walks the nodes of its own levels, whatever the number of filters.
+    """
+
+    SEPARATOR = '/'
+    SINGLE_LEVEL = '+'
+    MULTI_LEVEL = '#'
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._filters = {}
+
+    def __contains__(self, topic):
+        return topic in self._filters
+
+    def __len__(self):
+        return len(self._filters)
+
+    @property
+    def topics(self):
+        return list(self._filters.keys())
+
+    def callbacks(self, topic):
+        """
+        Return the callbacks registered for this exact topic filter.
+        """
+        return self._filters[topic].callbacks
+
+    def add(self, topic, callback):
+        """
+        Register a callback for the given topic filter.
+        """
+        node = self._filters.get(topic)
+        if node is None:
+            node = self._root
+            for level in topic.split(self.SEPARATOR):
+                try:
+                    node = node.children[level]
+                except KeyError:
+                    node.children[level] = node = _TopicNode()
+            node.callbacks = set()
+            node.topic = topic
+            self._filters[topic] = node
+        node.callbacks.add(callback)
+
+    def remove(self, topic, callback=None):
+        """
+        Remove a callback (or all of them if None) from a topic filter.
+        The filter is dropped once it has no callback left, return True
+        in that case.
+        """
+        node = self._filters.get(topic)
+        if node is None:
+            return False
+
+        if callback is not None:
+            node.callbacks.discard(callback)
+            if node.callbacks:
+                return False
+
+        del self._filters[topic]
+        node.callbacks = None
+        node.topic = None
+
+        # Prune the branch from the leaf as long as nodes are unused
+        path = [self._root]
+        levels = topic.split(self.SEPARATOR)
+        for level in levels:
+            path.append(path[-1].children[level])
+        for level, parent, child in zip(
+                reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if child.children or child.callbacks is not None:
+                break
+            del parent.children[level]
+        return True
+
+    def match(self, topic):
+        """
+        Return the list of callback sets of all filters matching this topic.
+        As stated by MQTT, wildcards never match a topic starting with '$'.
+        """
+        levels = topic.split(self.SEPARATOR)
+        depth = len(levels)
+        matches = []
+        stack = [(self._root, 0)]
+
+        while stack:
+            node, index = stack.pop()
+            children = node.children
+            wildcards = index > 0 or not topic.startswith('$')
+
+            if wildcards:
+                # 'a/#' matches 'a' as well as any of its sub-levels
+                multi = children.get(self.MULTI_LEVEL)
+                if multi is not None and multi.callbacks is not None:
+                    matches.append(multi.callbacks)
+
+            if index == depth:
+                if node.callbacks is not None:
+                    matches.append(node.callbacks)
+                continue
+
+            child = children.get(levels[index])
+            if child is not None:
+                stack.append((child, index + 1))
+            if wildcards:
+                child = children.get(self.SINGLE_LEVEL)
+                if child is not None:
+                    stack.append((child, index + 1))
+
+        return matches
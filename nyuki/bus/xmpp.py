@@ -9,6 +9,7 @@ from nyuki.bus import reporting
 from nyuki.services import Service
 from nyuki.utils import serialize_object
 
+from .batch import PublishQueue
 from .persistence import BusPersistence, EventStatus, PersistenceError
 
 
@@ -85,6 +86,14 @@ class XmppBus(Service):
                 "type": "object",
                 "required": ["jid", "password"],
                 "properties": {
+                    "batch": {
+                        "type": "object",
+                        "properties": {
+                            "size": {"type": "integer", "minimum": 1},
+                            "delay": {"type": "number", "minimum": 0}
+                        },
+                        "additionalProperties": False
+                    },
                     "certificate": {"type": "string", "minLength": 1},
                     "host": {"type": "string", "minLength": 1},
                     "jid": {"type": "string", "minLength": 1},
@@ -96,11 +105,50 @@ class XmppBus(Service):
                             "backend": {
                                 "type": "string",
                                 "minLength": 1
+                            },
+                            "memory_bytes": {
+                                "type": "integer",
+                                "minimum": 1
+                            },
+                            "spill": {
+                                "type": "object",
+                                "required": ["path"],
+                                "properties": {
+                                    "path": {
+                                        "type": "string",
+                                        "minLength": 1
+                                    },
+                                    "max_bytes": {
+                                        "type": "integer",
+                                        "minimum": 1
+                                    }
+                                },
+                                "additionalProperties": False
+                            },
+                            "replay": {
+                                "type": "object",
+                                "properties": {
+                                    "batch_size": {
+                                        "type": "integer",
+                                        "minimum": 1
+                                    },
+                                    "rate": {
+                                        "type": ["number", "null"],
+                                        "minimum": 0,
+                                        "exclusiveMinimum": True
+                                    },
+                                    "concurrency": {
+                                        "type": "integer",
+                                        "minimum": 1
+                                    }
+                                },
+                                "additionalProperties": False
                             }
                         }
                     },
                     "port": {"type": "integer"},
-                    "service": {"type": "string", "minLength": 1}
+                    "service": {"type": "string", "minLength": 1},
+                    "window": {"type": "integer", "minimum": 1}
                 },
                 "additionalProperties": False
             }
@@ -119,6 +167,9 @@ class XmppBus(Service):
         self._connected = asyncio.Event()
         self._persistence = None
         self._publish_futures = dict()
+        self._queue = None
+        self._window = None
+        self._in_flight = set()
 
         # MUCs
         self.name = None
@@ -132,6 +183,10 @@ class XmppBus(Service):
             return []
         return [topic.split('@')[0] for topic in self._mucs.rooms.keys()]
 
+    @property
+    def persistence(self):
+        return self._persistence
+
     async def start(self, timeout=0):
         self.client.connect()
         if timeout:
@@ -147,7 +202,8 @@ class XmppBus(Service):
 
     def configure(self, jid, password, host='localhost', port=5222,
                   muc_domain='mucs.localhost', certificate=None,
-                  persistence={}, service=None):
+                  persistence={}, service=None, batch=None,
+                  window=None):
         # XMPP client and main handlers
         self.client = _XmppClient(
             jid, password, host, port, certificate=certificate
@@ -175,6 +231,21 @@ class XmppBus(Service):
         self._persistence = BusPersistence(name=self.name, **persistence)
         log.info('Bus persistence set to %s', self._persistence.backend)
 
+        # Coalesce publications into batches
+        if batch is not None:
+            self._queue = PublishQueue(
+                self.publish_many, loop=self._loop, **batch
+            )
+        else:
+            self._queue = None
+
+        # Bound the number of unacknowledged messages instead of waiting for
+        # each echo before returning from `publish()`
+        if window is not None:
+            self._window = asyncio.Semaphore(window)
+        else:
+            self._window = None
+
     async def stop(self):
         if not self.client:
             return
@@ -183,6 +254,11 @@ class XmppBus(Service):
             log.warning('XMPP client is already disconnected')
             return
 
+        if self._queue:
+            await self._queue.close()
+        if self._in_flight:
+            await asyncio.wait(self._in_flight)
+
         self.reconnect = False
         self.client.disconnect(wait=2)
 
@@ -343,15 +419,15 @@ class XmppBus(Service):
             log.info('Waiting %d seconds', wait)
             await asyncio.sleep(wait)
 
-        events = await self._persistence.retrieve(since, status)
-        for event in events:
-            # Publish events one by one in the right publish time order
+        async def replay_event(event):
             await self.publish(
                 json.loads(event['message']),
                 topic=event['topic'],
                 previous_uid=event['id']
             )
 
+        await self._persistence.replay(replay_event, since, status)
+
     async def publish(self, event, topic=None, previous_uid=None):
         """
         Send an event in the nyuki's own MUC so that other nyukis that joined
@@ -359,6 +435,29 @@ class XmppBus(Service):
         """
         if not isinstance(event, dict):
             raise TypeError('Message must be a dict')
+        if self._queue and previous_uid is None:
+            await self._queue.put(event, topic)
+            return
+        await self._publish(
+            [event], topic, [previous_uid] if previous_uid else None
+        )
+
+    async def publish_many(self, events, topic=None):
+        """
+        Send a list of events at once, with one persistence store and one
+        status update for the whole batch. Messages are all sent before
+        waiting for their acknowledgements.
+        """
+        for event in events:
+            if not isinstance(event, dict):
+                raise TypeError('Message must be a dict')
+        if events:
+            await self._publish(events, topic)
+
+    async def _publish(self, events, topic=None, previous_uids=None):
+        """
+        Publish events, they are new unless their previous uids are given.
+        """
         if self._muc_domain is None:
             log.error('No subscription to any muc')
             return
@@ -369,63 +468,147 @@ class XmppBus(Service):
             # Automatically subscribe if required
             await self.subscribe(topic)
 
-        msg = self.client.Message()
-        msg['id'] = uid = previous_uid or str(uuid4())
-        msg['type'] = 'groupchat'
-        msg['to'] = self._muc_address(topic or self.name)
-        msg['body'] = json.dumps(event, default=serialize_object)
-
-        self._publish_futures[uid] = asyncio.Future()
-        status = EventStatus.PENDING
-
-        # Store the event as PENDING if it is new
-        if self._persistence and previous_uid is None:
-            await self._persistence.store({
-                'id': uid,
-                'status': status.value,
-                'topic': topic or self.name,
-                'message': msg['body'],
-            })
+        uids = previous_uids or [str(uuid4()) for _ in events]
+        messages = list()
+        for event, uid in zip(events, uids):
+            msg = self.client.Message()
+            msg['id'] = uid
+            msg['type'] = 'groupchat'
+            msg['to'] = self._muc_address(topic or self.name)
+            msg['body'] = json.dumps(event, default=serialize_object)
+            messages.append(msg)
+            self._publish_futures[uid] = asyncio.Future()
+
+        # Store the events as PENDING if they are new
+        if self._persistence and previous_uids is None:
+            await self._persistence.store_many([
+                {
+                    'id': uid,
+                    'status': EventStatus.PENDING.value,
+                    'topic': topic or self.name,
+                    'message': msg['body'],
+                }
+                for uid, msg in zip(uids, messages)
+            ])
             in_memory = self._persistence.memory_buffer
             if in_memory.is_full:
                 asyncio.ensure_future(self._nyuki.on_buffer_full(
                     in_memory.free_slot
                 ))
 
+        if not self._connected.is_set():
+            for uid in uids:
+                del self._publish_futures[uid]
+            if self._persistence:
+                await self._persistence.update_many(
+                    [(uid, EventStatus.FAILED) for uid in uids]
+                )
+            return
+
         # Publish in MUC
-        if self._connected.is_set():
-            log.debug(">> publishing to '{}': {}".format(topic, event))
-            log.info('Publishing an event to %s', msg['to'])
-            status = None
-            while True:
+        log.debug(">> publishing to '{}': {}".format(topic, events))
+        log.info(
+            'Publishing %d event(s) to %s',
+            len(messages), self._muc_address(topic or self.name)
+        )
+        if self._window is None:
+            try:
+                statuses = await asyncio.gather(*[
+                    self._send(msg, uid) for msg, uid in zip(messages, uids)
+                ])
+            finally:
+                for uid in uids:
+                    del self._publish_futures[uid]
+            # Once we have a result, update the stored events
+            if self._persistence:
+                await self._persistence.update_many(
+                    list(zip(uids, statuses))
+                )
+            return
+
+        # Return as soon as every message has been sent, acknowledgements
+        # (and retries) are handled in the background
+        sent = 0
+        try:
+            for msg, uid in zip(messages, uids):
+                await self._window.acquire()
                 msg.send()
-                try:
-                    await asyncio.wait_for(self._publish_futures[uid], 10.0)
-                except asyncio.TimeoutError:
-                    log.warning('Publication timed out, disconnecting slixmpp')
-                    status = EventStatus.FAILED
-                    # Crash connection and try to reconnect
-                    self.reconnect = True
-                    self.client.abort()
-                    break
-                except asyncio.CancelledError:
-                    log.warning('Publication cancelled due to disconnection')
-                    status = EventStatus.FAILED
-                    break
-                except PublishError:
-                    status = EventStatus.FAILED
-                    self._publish_futures[uid] = asyncio.Future()
-                else:
-                    log.info("Event successfully sent to MUC '%s'", msg['to'])
-                    status = EventStatus.SENT
-                    break
-        else:
-            status = EventStatus.FAILED
+                task = asyncio.ensure_future(self._acknowledge(msg, uid))
+                self._in_flight.add(task)
+                task.add_done_callback(self._on_delivered)
+                sent += 1
+        finally:
+            # Interrupted while waiting for a slot, the remaining events
+            # will never be acknowledged
+            unsent = uids[sent:]
+            for uid in unsent:
+                del self._publish_futures[uid]
+            if unsent and self._persistence:
+                await self._persistence.update_many(
+                    [(uid, EventStatus.FAILED) for uid in unsent]
+                )
+
+    def _on_delivered(self, task):
+        self._in_flight.discard(task)
+        self._window.release()
+        if not task.cancelled() and task.exception() is not None:
+            log.error(
+                'Could not acknowledge a publication',
+                exc_info=task.exception()
+            )
 
-        del self._publish_futures[uid]
+    async def _acknowledge(self, msg, uid):
+        """
+        Wait for the echo of a sent message and update its stored status
+        """
+        try:
+            status = await self._wait_echo(msg, uid)
+        finally:
+            del self._publish_futures[uid]
         # Once we have a result, update the stored event
         if self._persistence:
-            await self._persistence.update(previous_uid or uid, status)
+            await self._persistence.update(uid, status)
+
+    async def _send(self, msg, uid):
+        """
+        Send a message in its MUC and wait for its own echo, return the
+        resulting event status
+        """
+        msg.send()
+        return await self._wait_echo(msg, uid)
+
+    async def _wait_echo(self, msg, uid):
+        """
+        Wait for the echo of a sent message, sending it again if needed
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._publish_futures[uid], 10.0)
+            except asyncio.TimeoutError:
+                self._abort()
+                return EventStatus.FAILED
+            except asyncio.CancelledError:
+                log.warning('Publication cancelled due to disconnection')
+                return EventStatus.FAILED
+            except PublishError:
+                self._publish_futures[uid] = asyncio.Future()
+                msg.send()
+            else:
+                log.info("Event successfully sent to MUC '%s'", msg['to'])
+                return EventStatus.SENT
+
+    def _abort(self):
+        """
+        Crash the connection and try to reconnect, once for all the
+        publications timing out together
+        """
+        if not self._connected.is_set():
+            # Already disconnecting
+            return
+        log.warning('Publication timed out, disconnecting slixmpp')
+        self._connected.clear()
+        self.reconnect = True
+        self.client.abort()
 
     async def _resubscribe(self):
         """
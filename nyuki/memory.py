@@ -22,6 +22,145 @@ def memsafe(coro):
     return wrapper
 
 
+class WriteBehind:
+
+    """
+    Coalesce the writes of redis hashes during `window` seconds, then flush
+    them all in a single MULTI/EXEC transaction. Written keys get a TTL and
+    can be indexed in a redis set.
+    """
+
+    def __init__(self, memory, window=0.1, expire=86400):
+        self._memory = memory
+        self.window = window
+        self.expire = expire
+        # Key -> pending write
+        self._pending = {}
+        self._handle = None
+
+    def _schedule(self):
+        if self._handle is None:
+            self._handle = self._memory.loop.call_later(
+                self.window, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    def hset(self, key, fields, replace=False, index=None):
+        """
+        Set the given hash fields (a dict), dropping all the existing ones
+        first if `replace` is True. `index` is a (set key, member) tuple.
+        """
+        pending = self._pending.get(key)
+        if pending is None or replace or pending['delete']:
+            pending = self._pending[key] = {
+                'delete': False,
+                'replace': replace or (pending or {}).get('delete', False),
+                'fields': {},
+                'index': index,
+            }
+        pending['fields'].update(fields)
+        self._schedule()
+
+    def delete(self, key, index=None):
+        """
+        Delete a hash, and remove it from its index if any.
+        """
+        self._pending[key] = {'delete': True, 'index': index}
+        self._schedule()
+
+    async def flush(self):
+        """
+        Write all the pending changes
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not self._pending:
+            return
+        if not self._memory.available:
+            self._schedule()
+            return
+        pending, self._pending = self._pending, {}
+
+        log.debug('Flushing %d shared memory write(s)', len(pending))
+        try:
+            failed = await self._execute(pending)
+        except asyncio.CancelledError:
+            self._requeue(pending)
+            raise
+        except SocketError:
+            log.error("Connection with Redis has been lost. Retrying...")
+            failed = pending
+        except Exception as exc:
+            log.exception(exc)
+            failed = pending
+        if failed:
+            self._requeue(failed)
+            self._schedule()
+
+    async def _execute(self, pending):
+        """
+        Send the pending writes in a MULTI/EXEC transaction, return the ones
+        having a command that failed (retried once, then dropped).
+        """
+        transaction = self._memory.store.multi_exec()
+        # Written key of each command
+        keys = list()
+        for key, write in pending.items():
+            index = write['index']
+            if write['delete']:
+                transaction.delete(key)
+                keys.append(key)
+                if index is not None:
+                    transaction.srem(index[0], index[1])
+                    keys.append(key)
+                continue
+            if write['replace']:
+                transaction.delete(key)
+                keys.append(key)
+            if write['fields']:
+                transaction.hmset_dict(key, write['fields'])
+                keys.append(key)
+            transaction.expire(key, self.expire)
+            keys.append(key)
+            if index is not None:
+                transaction.sadd(index[0], index[1])
+                transaction.expire(index[0], self.expire)
+                keys.extend((key, key))
+
+        results = await transaction.execute(return_exceptions=True)
+        failed = dict()
+        for key, result in zip(keys, results):
+            if not isinstance(result, Exception) or key in failed:
+                continue
+            write = pending[key]
+            if write.get('retried'):
+                log.error("Dropping shared memory write '%s': %s", key, result)
+                continue
+            log.warning("Shared memory write '%s' failed: %s", key, result)
+            write['retried'] = True
+            failed[key] = write
+        return failed
+
+    def _requeue(self, failed):
+        """
+        Put back writes that failed, under the ones made since
+        """
+        for key, write in failed.items():
+            newer = self._pending.get(key)
+            if newer is None:
+                self._pending[key] = write
+            elif newer['delete'] or newer['replace']:
+                # Overrides anything written before
+                continue
+            elif write['delete']:
+                newer['replace'] = True
+            else:
+                write['fields'].update(newer['fields'])
+                newer['fields'] = write['fields']
+                newer['replace'] = write['replace']
+                newer['index'] = newer['index'] or write['index']
+
+
 class Memory(Service):
 
     def __init__(self, nyuki):
@@ -29,6 +168,7 @@ class Memory(Service):
         self.config = {}
         self.service = nyuki.config['service']
         self.loop = nyuki.loop or asyncio.get_event_loop()
+        self.write_behind = WriteBehind(self)
 
     @property
     def available(self):
@@ -42,6 +182,8 @@ class Memory(Service):
 
     def configure(self, *args, **kwargs):
         self.config = kwargs
+        # Seconds during which writes are coalesced
+        self.write_behind.window = kwargs.get('write_window', 0.1)
 
     async def start(self, *args, **kwargs):
         """
@@ -67,4 +209,4 @@ class Memory(Service):
             log.exception(exc)
 
     async def stop(self, *args, **kwargs):
-        pass
+        await self.write_behind.flush()
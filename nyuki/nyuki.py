@@ -8,7 +8,9 @@ from jsonschema import validate
 from signal import SIGHUP, SIGINT, SIGTERM
 
 from .api import Api
-from .api.bus import ApiBusReplay, ApiBusTopics, ApiBusPublish
+from .api.bus import (
+    ApiBusReplay, ApiBusTopics, ApiBusPublish, ApiBusPersistence
+)
 from .api.config import ApiConfiguration, ApiSwagger
 from .bus import XmppBus, MqttBus, reporting
 from .commands import get_command_kwargs
@@ -50,6 +52,7 @@ class Nyuki:
     }
     # API endpoints
     HTTP_RESOURCES = [
+        ApiBusPersistence,
         ApiBusPublish,
         ApiBusReplay,
         ApiBusTopics,
@@ -1,6 +1,6 @@
 import re
 import ast
-from collections import defaultdict
+from functools import lru_cache
 import logging
 
 
@@ -11,16 +11,18 @@ EXPRESSIONS = [
     # Types of values
     ast.Dict,
     ast.List,
-    ast.NameConstant,
-    ast.Num,
     ast.Set,
-    ast.Str,
     ast.Tuple,
     # Types of operations
     ast.Compare,
     ast.BoolOp,
     ast.UnaryOp
 ]
+# Literal nodes, depending on the python version
+EXPRESSIONS += [
+    getattr(ast, name) for name in ('Constant', 'NameConstant', 'Num', 'Str')
+    if hasattr(ast, name)
+]
 
 OPERATORS = [
     ast.And,
@@ -41,16 +43,71 @@ CONTEXTS = [ast.Load]
 AUTHORIZED_TYPES = EXPRESSIONS + OPERATORS + CONTEXTS
 
 
+# /!\ This regex forbids the use of ' and " in a string
+# See https://regex101.com/r/hUueag/7
+CONDITION_REGEX = re.compile(
+    r' *(and|or)? *\( *(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) +([=<>!]=?|not in|in|not) +(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) *\) *'
+)
+VARIABLE_REGEX = re.compile(r'^@(\w+)$')
+
+
+def _check_tree(tree, expr, names=()):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in names:
+            continue
+        if not type(node) in AUTHORIZED_TYPES:
+            raise TypeError("forbidden type {} found in {}".format(node, expr))
+
+
 def safe_eval(expr):
     """
     Ensures an expression only defines authorized operations (no call to
     functions, no variable assignement...) and evaluates it.
     """
-    tree = ast.parse(expr, mode='eval').body
-    for node in ast.walk(tree):
-        if not type(node) in AUTHORIZED_TYPES:
-            raise TypeError("forbidden type {} found in {}".format(node, expr))
-    return bool(eval(expr))
+    tree = ast.parse(expr, mode='eval')
+    _check_tree(tree.body, expr)
+    return bool(eval(compile(tree, '<condition>', 'eval')))
+
+
+@lru_cache(maxsize=1024)
+def compile_condition(condition):
+    """
+    Compile a condition string into a function evaluating it against a data
+    dict, `@variable_name` operands being read from the dict at runtime.
+    """
+    match = CONDITION_REGEX.findall(condition)
+    variables = dict()
+
+    def operand(value):
+        var = VARIABLE_REGEX.match(value)
+        if var is None:
+            return value
+        name = '_v{}'.format(len(variables))
+        variables[name] = var.group(1)
+        return name
+
+    if not match:
+        expr = condition
+    else:
+        # Reconstruct a cleaned string from the operation parts.
+        expr = ''
+        for andor, left, op, right in match:
+            expr += '{}({} {} {})'.format(
+                andor, operand(left), op, operand(right)
+            )
+
+    tree = ast.parse(expr, mode='eval')
+    _check_tree(tree.body, condition, variables)
+    code = compile(tree, '<condition>', 'eval')
+    variables = tuple(variables.items())
+    no_builtins = {'__builtins__': {}}
+
+    def evaluate(data):
+        return bool(eval(code, no_builtins, {
+            name: data.get(key) for name, key in variables
+        }))
+
+    return evaluate
 
 
 class ConditionBlock:
@@ -74,39 +131,23 @@ class ConditionBlock:
                 raise TypeError("last condition must be 'elif' or 'else',"
                                 " got '{}'".format(conditions[-1]))
         self._conditions = conditions
+        self._evaluators = [
+            self._compile(condition) for condition in conditions
+        ]
 
-    def _clean_condition(self, condition, data):
+    @staticmethod
+    def _compile(condition):
         """
-        Format the condition string (as eval-compliant code).
-        nb: variable replacement should be `@variable_name` formatted.
+        Compile a condition once, an invalid one raises when evaluated.
         """
-        # /!\ This regex forbids the use of ' and " in a string
-        # See https://regex101.com/r/hUueag/7
-        match = re.findall(
-            r' *(and|or)? *\( *(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) +([=<>!]=?|not in|in|not) +(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) *\) *',
-            condition
-        )
-        if not match:
-            return condition
-
-        def replace(match):
-            key = match.group('var_name')
-            value = data.get(key)
-            placeholder = '{!r}' if isinstance(value, str) else '{}'
-            return placeholder.format(value)
-
-        # Reconstruct a cleaned string from the operation parts.
-        cleaned = ''
-        for operation in match:
-            # Get 'and' or 'or' operation
-            andor = operation[0]
-            # Restructure condition string, striping any trailing space
-            ops = []
-            ops.append(re.sub(r'^@(?P<var_name>\w+)$', replace, operation[1]))
-            ops.append(operation[2])
-            ops.append(re.sub(r'^@(?P<var_name>\w+)$', replace, operation[3]))
-            cleaned += '{}({})'.format(andor, ' '.join(ops))
-        return cleaned
+        if condition['type'] == 'else':
+            return None
+        try:
+            return compile_condition(condition['condition'])
+        except (KeyError, SyntaxError, TypeError, ValueError) as exc:
+            def invalid(data, exc=exc):
+                raise exc
+            return invalid
 
     def condition_validated(self, condition, data):
         """
@@ -115,22 +156,24 @@ class ConditionBlock:
         """
         raise NotImplementedError
 
-    def apply(self, data):
+    def select(self, data):
         """
-        Iterate through the conditions and stop at first validated condition.
+        Iterate through the conditions and return the index of the first
+        validated condition (None if none is).
         """
-        for condition in self._conditions:
-            # If type 'else', set given next tasks and leave
-            if condition['type'] == 'else':
-                self.condition_validated(condition['rules'], data)
-                return
-            # Else find the condition and evaluate it
-            cleaned = self._clean_condition(condition['condition'], data)
-            log.debug('arithmetics: trying %s', cleaned)
-            if safe_eval(cleaned):
+        for index, evaluate in enumerate(self._evaluators):
+            # If type 'else', select it and leave
+            if evaluate is None or evaluate(data):
                 log.debug(
-                    'arithmetics: validated condition "%s" as "%s"',
-                    condition, cleaned
+                    'arithmetics: validated condition "%s"',
+                    self._conditions[index]
                 )
-                self.condition_validated(condition['rules'], data)
-                return
+                return index
+
+    def apply(self, data):
+        """
+        Stop at first validated condition and apply its rules.
+        """
+        index = self.select(data)
+        if index is not None:
+            self.condition_validated(self._conditions[index]['rules'], data)
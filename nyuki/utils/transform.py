@@ -1,18 +1,46 @@
+import hashlib
+import json
 import logging
 import operator
 import re
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from copy import deepcopy
+from functools import wraps
+from itertools import repeat
 
 from .evaluate import ConditionBlock
 
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
 
 log = logging.getLogger(__name__)
 
+# Missing field in a column
+_MISSING = object()
+
+# Field placeholder in rule operands, e.g. '@fieldname'
+PLACEHOLDER_REGEX = re.compile(r'^@[\w-]+$')
+
+# Trace levels of the changes made by the rules: nothing (only the errors
+# flag), the touched keys, or the full diff with old and new values
+TRACE_NONE = 'none'
+TRACE_SUMMARY = 'summary'
+TRACE_FULL = 'full'
+TRACE_LEVELS = (TRACE_NONE, TRACE_SUMMARY, TRACE_FULL)
 
-class TraceableDict(dict):
+
+class TraceableDict(MutableMapping):
 
     """
-    Python dict-based class that tracks any changes.
+    Copy-on-write overlay of a dict that tracks any changes.
+    Writes are journaled (only touched keys are recorded, the wrapped dict
+    is left untouched) until `commit()` applies them in place.
+    Without `values`, changes only hold the action and the key.
     Format:
         {"action": "add", "key": <key>, "value": <new-value>},
         {"action": "remove", "key": <key>, "value": <old-value>},
@@ -20,50 +48,80 @@ class TraceableDict(dict):
                                            "new_value": <new-value>},
     """
 
-    def __init__(self, dict2):
-        super().__init__(deepcopy(dict2))
-        self._changes = []
+    _REMOVED = object()
 
-    def __setitem__(self, key, value):
+    def __init__(self, dict2, values=True):
+        self._data = dict2
+        self._journal = {}
+        self._changes = []
+        self._values = values
+
+    def __getitem__(self, key):
+        if key in self._journal:
+            value = self._journal[key]
+            if value is self._REMOVED:
+                raise KeyError(key)
+            return value
+        return self._data[key]
+
+    def __contains__(self, key):
+        if key in self._journal:
+            return self._journal[key] is not self._REMOVED
+        return key in self._data
+
+    def __iter__(self):
+        for key in self._data:
+            if key in self:
+                yield key
+        for key, value in self._journal.items():
+            if key not in self._data and value is not self._REMOVED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _track(self, key, value):
         if key not in self:
-            self._changes.append({
-                'action': 'add',
-                'key': key,
-                'value': deepcopy(value)
-            })
+            change = {'action': 'add', 'key': key}
+            if self._values:
+                change['value'] = deepcopy(value)
         elif self[key] != value:
-            self._changes.append({
-                'action': 'update',
-                'key': key,
-                'old_value': deepcopy(self[key]),
-                'new_value': deepcopy(value)
-            })
-        super().__setitem__(key, value)
+            change = {'action': 'update', 'key': key}
+            if self._values:
+                change['old_value'] = deepcopy(self[key])
+                change['new_value'] = deepcopy(value)
+        else:
+            return
+        self._changes.append(change)
+
+    def __setitem__(self, key, value):
+        self._track(key, value)
+        self._journal[key] = value
 
     def __delitem__(self, key):
-        self._changes.append({
-            'action': 'remove',
-            'key': key,
-            'value': deepcopy(self[key])
-        })
-        super().__delitem__(key)
+        change = {'action': 'remove', 'key': key}
+        if self._values:
+            change['value'] = deepcopy(self[key])
+        elif key not in self:
+            raise KeyError(key)
+        self._changes.append(change)
+        self._journal[key] = self._REMOVED
 
     def update(self, dict2=None, **kwargs):
-        for key in dict2:
-            if key not in self:
-                self._changes.append({
-                    'action': 'add',
-                    'key': key,
-                    'value': deepcopy(dict2[key])
-                })
-            elif self[key] != dict2[key]:
-                self._changes.append({
-                    'action': 'update',
-                    'key': key,
-                    'old_value': deepcopy(self[key]),
-                    'new_value': deepcopy(dict2[key])
-                })
-        super().update(dict2, **kwargs)
+        for items in (dict2 or {}, kwargs):
+            for key in items:
+                self[key] = items[key]
+
+    def commit(self):
+        """
+        Apply the journaled changes to the wrapped dict.
+        """
+        for key, value in self._journal.items():
+            if value is self._REMOVED:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+        self._journal.clear()
 
     @property
     def changes(self):
@@ -97,15 +155,33 @@ class Converter(object):
     A sequence of `_Rule` objects intended to be applied on a dict.
     """
 
-    def __init__(self, rules=None):
+    def __init__(self, rules=None, optimize=True):
         self._rules = rules or []
+        if optimize:
+            self._link_prefilters()
+
+    def _link_prefilters(self):
+        """
+        Give consecutive regex rules on the same field a shared literal
+        prefilter: a pattern is only run if the literals it requires are in
+        the string, and each literal is looked up once for the whole chain.
+        """
+        previous = None
+        for rule in self._rules:
+            if not isinstance(rule, _RegexpRule):
+                previous = None
+                continue
+            if previous is None or previous.fieldname != rule.fieldname:
+                prefilter = _LiteralPrefilter()
+            rule.prefilter = prefilter
+            previous = rule
 
     @property
     def rules(self):
         return self._rules
 
     @classmethod
-    def from_dict(cls, config):
+    def from_dict(cls, config, optimize=True):
         """
         Create a `Converter` object from dict 'config'. The dict must look like
         the following:
@@ -124,19 +200,152 @@ class Converter(object):
             rtype = params.pop('type')
             rule_cls = _RegisteredRule.get(rtype)
             rules.append(rule_cls(**params))
-        return cls(rules=rules)
+        return cls(rules=rules, optimize=optimize)
+
+    def apply(self, data, trace=TRACE_FULL):
+        """
+        Apply the rules on data, reporting the changes according to the
+        `trace` level (`TRACE_NONE` does not track anything).
+        """
+        if trace == TRACE_NONE:
+            return {'errors': self.apply_in_place(data)}
 
-    def apply(self, data):
         rules = []
         errors = False
         for rule in self.rules:
-            diff = rule.apply(data)
+            diff = rule.apply(data, trace)
             rules.append(diff)
             if diff is not None and 'error' in diff:
                 errors = True
 
         return {'rules': rules, 'errors': errors}
 
+    def apply_many(self, records, diff=True, columnar=False):
+        """
+        Apply the rules on each record (in-place update) of a list or an
+        iterator of dicts. Without `diff`, changes are not tracked at all.
+        With `columnar` (and no diff), each rule is applied on a whole field
+        column at once, rule after rule, instead of record after record.
+        {
+            "records": [<record>, ...],
+            "diffs": [{"rules": [...], "errors": <bool>}, ...] or None,
+            "errors": <bool>
+        }
+        """
+        records = list(records)
+        if diff:
+            diffs = [self.apply(record) for record in records]
+            return {
+                'records': records,
+                'diffs': diffs,
+                'errors': any(result['errors'] for result in diffs),
+            }
+
+        if columnar:
+            errors = self.apply_columns(records)
+        else:
+            errors = False
+            for record in records:
+                errors |= self.apply_in_place(record)
+        return {'records': records, 'diffs': None, 'errors': errors}
+
+    def apply_in_place(self, data):
+        """
+        Apply the rules without tracking changes, return True on errors.
+        """
+        errors = False
+        for rule in self.rules:
+            errors |= rule.apply_in_place(data)
+        return errors
+
+    def apply_columns(self, records):
+        errors = False
+        for rule in self.rules:
+            errors |= rule.apply_column(records)
+        return errors
+
+
+class ConverterCache(object):
+
+    """
+    LRU cache of `Converter` objects keyed by a hash of their (resolved)
+    rules configuration, so that rules are instantiated and their regexes
+    compiled once. Entries can be invalidated from the IDs of the regexes
+    or lookup tables they were built from.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._converters = OrderedDict()
+        # Dependency ID -> set of cache keys
+        self._dependents = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._converters)
+
+    @staticmethod
+    def key(config, versions=None):
+        dump = json.dumps(
+            [config['rules'], sorted((versions or {}).items())],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha1(dump.encode()).hexdigest()
+
+    def get(self, config, depends=None, build=None):
+        """
+        Return the converter for this rules configuration, built only if not
+        already cached. `depends` lists the IDs it was resolved from, or maps
+        them to a version that is part of the key. `build` creates the
+        converter on a miss (defaults to `Converter.from_dict(config)`).
+        """
+        versions = depends if isinstance(depends, dict) else None
+        key = self.key(config, versions)
+        try:
+            converter, _ = self._converters[key]
+        except KeyError:
+            pass
+        else:
+            self._converters.move_to_end(key)
+            self.hits += 1
+            return converter
+
+        self.misses += 1
+        if build is None:
+            converter = Converter.from_dict(config)
+        else:
+            converter = build()
+        depends = frozenset(depends or ())
+        self._converters[key] = (converter, depends)
+        for uid in depends:
+            self._dependents.setdefault(uid, set()).add(key)
+        while len(self._converters) > self.maxsize:
+            self._remove(next(iter(self._converters)))
+        return converter
+
+    def _remove(self, key):
+        _, depends = self._converters.pop(key)
+        for uid in depends:
+            keys = self._dependents.get(uid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[uid]
+
+    def invalidate(self, uid=None):
+        """
+        Remove the converters depending on the regex or lookup `uid`, or all
+        of them if None.
+        """
+        if uid is None:
+            self._converters.clear()
+            self._dependents.clear()
+            return
+        for key in self._dependents.pop(uid, ()):
+            if key in self._converters:
+                self._remove(key)
+
 
 class FactoryConditionBlock(ConditionBlock, metaclass=_RegisteredRule):
 
@@ -144,18 +353,45 @@ class FactoryConditionBlock(ConditionBlock, metaclass=_RegisteredRule):
 
     def __init__(self, conditions):
         super().__init__(conditions)
-        self._changes = {'type': self.TYPENAME, 'conditions': []}
+        # Rules of each condition are instantiated once
+        self._converters = [
+            Converter.from_dict({'rules': condition.get('rules', [])})
+            for condition in conditions
+        ]
 
-    def condition_validated(self, rules, data):
+    def apply(self, data, trace=TRACE_FULL):
         """
-        Apply rules on data upon validating a condition.
+        Apply the rules of the first validated condition on data.
         """
-        diff = Converter.from_dict({'rules': rules}).apply(data)
-        self._changes['conditions'] = diff['rules']
-
-    def apply(self, data):
-        super().apply(data)
-        return self._changes
+        changes = {'type': self.TYPENAME, 'conditions': []}
+        index = self.select(data)
+        if index is not None:
+            changes['conditions'] = self._converters[index].apply(
+                data, trace
+            )['rules']
+        return changes
+
+    def apply_in_place(self, data):
+        index = self.select(data)
+        if index is None:
+            return False
+        return self._converters[index].apply_in_place(data)
+
+    def apply_column(self, records):
+        """
+        Split the records by validated condition and apply each group its
+        rules column by column.
+        """
+        groups = [list() for _ in self._converters]
+        for record in records:
+            index = self.select(record)
+            if index is not None:
+                groups[index].append(record)
+        errors = False
+        for converter, group in zip(self._converters, groups):
+            if group:
+                errors |= converter.apply_columns(group)
+        return errors
 
 
 class _Rule(metaclass=_RegisteredRule):
@@ -187,9 +423,10 @@ class _Rule(metaclass=_RegisteredRule):
         Decorator for `Rule.apply(<data>)` methods that return a JSON-formatted
         diff of the changes made by the method itself.
         """
-        def wrapper(self, data):
+        @wraps(func)
+        def wrapper(self, data, trace=TRACE_FULL):
             # Handle data through a traceable dict
-            tracker = TraceableDict(data)
+            tracker = TraceableDict(data, values=trace == TRACE_FULL)
             try:
                 func(self, tracker)
             except RegexpRuleError as exc:
@@ -207,20 +444,133 @@ class _Rule(metaclass=_RegisteredRule):
                     'type': self.TYPENAME, 'changes': tracker.changes,
                     'error': 'union_rule_error', 'error_details': str(exc)
                 }
-            # We want to keep the object reference
-            data.clear()
-            data.update(tracker)
+            # Changes are only applied if the rule succeeded
+            tracker.commit()
             return {'type': self.TYPENAME, 'changes': tracker.changes}
 
         return wrapper
 
-    def apply(self, data):
+    def apply(self, data, trace=TRACE_FULL):
         """
         Execute an operation on one field of the dict `data` and returns an
-        diff.
+        diff (only the touched keys with `TRACE_SUMMARY`).
         """
         raise NotImplementedError
 
+    def apply_in_place(self, data):
+        """
+        Execute the operation directly on `data`, without tracking changes.
+        Return True if the rule failed.
+        """
+        try:
+            # Undecorated `apply`
+            type(self).apply.__wrapped__(self, data)
+        except (RegexpRuleError, ArithmeticRuleError, UnionRuleError) as exc:
+            log.debug('%s rule error: %s', self.TYPENAME, exc)
+            return True
+        return False
+
+    def apply_column(self, records):
+        """
+        Execute the operation on a list of records, return True if it failed
+        on any of them. To be overridden by rules that can process a whole
+        column at once.
+        """
+        errors = False
+        for record in records:
+            errors |= self.apply_in_place(record)
+        return errors
+
+    def _column(self, records, fieldname=None):
+        """
+        Return the records having the field, along with the field values.
+        """
+        fieldname = fieldname or self.fieldname
+        rows = [record for record in records if fieldname in record]
+        return rows, [record[fieldname] for record in rows]
+
+
+def _starts_with_literal(items):
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            return True
+        if op == sre_constants.SUBPATTERN:
+            return _starts_with_literal(av[-1])
+        return False
+    return False
+
+
+def _required_literals(regexp):
+    """
+    Return the literal substrings any match of `regexp` must contain (the
+    three longest ones), found from its parsed form.
+    """
+    if not isinstance(regexp.pattern, str) or \
+            regexp.flags & (re.IGNORECASE | re.LOCALE):
+        return ()
+
+    literals = list()
+
+    def walk(items):
+        run = list()
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                run.append(chr(av))
+                continue
+            if run:
+                literals.append(''.join(run))
+                run = list()
+            if op == sre_constants.SUBPATTERN:
+                # Scoped flags, e.g. (?i:...), are not handled
+                if len(av) == 4 and av[1] & re.IGNORECASE:
+                    continue
+                walk(av[-1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                if av[0] >= 1:
+                    walk(av[2])
+        if run:
+            literals.append(''.join(run))
+
+    parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    if _starts_with_literal(parsed):
+        # The regex engine already searches for the literal prefix quickly
+        return ()
+    walk(parsed)
+    literals = sorted(OrderedDict.fromkeys(literals), key=len, reverse=True)
+    return tuple(literals[:3])
+
+
+class _LiteralPrefilter(object):
+
+    """
+    Tell whether a string may match a pattern from the literals the pattern
+    requires. The presence of each literal is cached for the last string,
+    shared by a chain of regex rules scanning the same field.
+    """
+
+    def __init__(self):
+        self._string = None
+        self._found = dict()
+
+    def may_match(self, string, literals, pos_args=()):
+        if not literals or not isinstance(string, str):
+            return True
+        if pos_args:
+            return all(
+                string.find(literal, *pos_args) != -1 for literal in literals
+            )
+        if string is not self._string:
+            self._string = string
+            self._found = dict()
+        for literal in literals:
+            try:
+                found = self._found[literal]
+            except KeyError:
+                found = self._found[literal] = literal in string
+            if not found:
+                return False
+        return True
+
 
 class _RegexpRule(_Rule):
 
@@ -235,6 +585,13 @@ class _RegexpRule(_Rule):
 
     def _configure(self, pattern, flags=0):
         self.regexp = re.compile(pattern, flags=flags)
+        self.literals = _required_literals(self.regexp)
+        # Set by the converter
+        self.prefilter = None
+
+    def _may_match(self, string, pos_args=()):
+        return self.prefilter is None or \
+            self.prefilter.may_match(string, self.literals, pos_args)
 
     def _run_regexp(self, string):
         raise NotImplementedError
@@ -271,6 +628,8 @@ class Extract(_RegexpRule):
     def _run_regexp(self, string):
         if not self.regexp.groupindex:
             raise RegexpRuleError("regex is invalid, ensure a group is captured")
+        if not self._may_match(string, self._pos_args):
+            return {}
         args = (string,) + self._pos_args
         match = self.regexp.search(*args)
         if match is not None:
@@ -292,6 +651,8 @@ class Sub(_RegexpRule):
         self.repl, self.count = repl, count
 
     def _run_regexp(self, string):
+        if not self._may_match(string):
+            return {self.fieldname: string}
         res = self.regexp.sub(self.repl, string, count=self.count)
         return {self.fieldname: res}
 
@@ -309,6 +670,11 @@ class Set(_Rule):
     def apply(self, data):
         data[self.fieldname] = self.value
 
+    def apply_column(self, records):
+        for record in records:
+            record[self.fieldname] = self.value
+        return False
+
 
 class Copy(_Rule):
 
@@ -326,6 +692,12 @@ class Copy(_Rule):
         except KeyError:
             log.debug('Copy : unknown field %s, ignoring', self.fieldname)
 
+    def apply_column(self, records):
+        rows, values = self._column(records)
+        for record, value in zip(rows, values):
+            record[self.copy] = value
+        return False
+
 
 class Unset(_Rule):
 
@@ -344,6 +716,31 @@ class Unset(_Rule):
             log.debug('Unset : unknown field %s, ignoring', self.fieldname)
 
 
+class LookupTable(object):
+
+    """
+    Lookup table built once and shared by all the `Lookup` rules using it,
+    its case-insensitive index being built on first use only.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._icase = None
+
+    def __len__(self):
+        return len(self.table)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        return cls({pair['value']: pair['replace'] for pair in pairs})
+
+    @property
+    def icase(self):
+        if self._icase is None:
+            self._icase = {k.lower(): v for k, v in self.table.items()}
+        return self._icase
+
+
 class Lookup(_Rule):
 
     """
@@ -352,10 +749,13 @@ class Lookup(_Rule):
     """
 
     def _configure(self, table=None, icase=False):
-        self.table = table or dict()
         self.icase = icase
+        if isinstance(table, LookupTable):
+            self.table = table.icase if icase else table.table
+            return
+        self.table = table or dict()
         if icase:
-            self.table = {k.lower(): v for k, v in table.items()}
+            self.table = {k.lower(): v for k, v in self.table.items()}
 
     @_Rule.track_changes
     def apply(self, data):
@@ -373,6 +773,17 @@ class Lookup(_Rule):
             log.debug("Lookup: fieldname '%s' not in data, ignoring", err)
             return
 
+    def apply_column(self, records):
+        rows, values = self._column(records)
+        values = map(str, values)
+        if self.icase:
+            values = map(str.lower, values)
+        table = self.table
+        for record, value in zip(rows, values):
+            if value in table:
+                record[self.fieldname] = table[value]
+        return False
+
 
 class Lower(_Rule):
 
@@ -393,6 +804,15 @@ class Lower(_Rule):
         except AttributeError as err:
             log.debug("Upper: fieldname '%s' invalid, ignoring", err)
 
+    def apply_column(self, records):
+        rows, values = self._column(records)
+        for record, value in zip(rows, values):
+            try:
+                record[self.fieldname] = value.lower()
+            except AttributeError:
+                pass
+        return False
+
 
 class Upper(_Rule):
 
@@ -413,6 +833,41 @@ class Upper(_Rule):
         except AttributeError as err:
             log.debug("Upper: fieldname '%s' invalid, ignoring", err)
 
+    def apply_column(self, records):
+        rows, values = self._column(records)
+        for record, value in zip(rows, values):
+            try:
+                record[self.fieldname] = value.upper()
+            except AttributeError:
+                pass
+        return False
+
+
+def _placeholder(operand):
+    """
+    Return the field name of a `@fieldname` operand, None for a value.
+    """
+    if isinstance(operand, str) and PLACEHOLDER_REGEX.match(operand):
+        return operand[1:]
+    return None
+
+
+def _operand_getter(operand):
+    """
+    Return a function reading the operand from the data, decided once.
+    """
+    field = _placeholder(operand)
+    if field is not None:
+        return operator.itemgetter(field)
+    return lambda data: operand
+
+
+def _operand_column(records, operand):
+    field = _placeholder(operand)
+    if field is None:
+        return repeat(operand)
+    return [record.get(field, _MISSING) for record in records]
+
 
 class ArithmeticRuleError(Exception):
     pass
@@ -452,15 +907,11 @@ class Arithmetic(_Rule):
     def _configure(self, operator, operand1, operand2):
         self.op, self.types = self.OPS[operator]
         self.operands = (operand1, operand2)
+        self._getters = tuple(_operand_getter(op) for op in self.operands)
 
     def _compute_operands(self, data):
-        operands = tuple()
         # We replace placeholders with the actual data
-        for op in self.operands:
-            if isinstance(op, str) and re.match(r'^@[\w-]+$', op):
-                op = data[op.split('@')[1]]
-            operands += (op,)
-        return operands
+        return tuple(getter(data) for getter in self._getters)
 
     @_Rule.track_changes
     def apply(self, data):
@@ -492,6 +943,28 @@ class Arithmetic(_Rule):
 
         data[self.fieldname] = result
 
+    def apply_column(self, records):
+        errors = False
+        columns = [_operand_column(records, op) for op in self.operands]
+        for record, operand1, operand2 in zip(records, *columns):
+            if operand1 is _MISSING or operand2 is _MISSING:
+                errors = True
+                continue
+            type1 = type(operand1)
+            if type1 not in self.types or \
+                    type(operand2) not in self.types[type1]:
+                errors = True
+                continue
+            try:
+                result = self.op(operand1, operand2)
+            except TypeError as exc:
+                log.debug(exc)
+                continue
+            if isinstance(result, float):
+                result = round(result, 3)
+            record[self.fieldname] = result
+        return errors
+
 
 class UnionRuleError(Exception):
     pass
@@ -505,21 +978,42 @@ class Union(_Rule):
 
     def _configure(self, operand1, operand2):
         self.operands = (operand1, operand2)
+        self._getters = tuple(_operand_getter(op) for op in self.operands)
 
     def _compute_operands(self, data):
-        computed = tuple()
-        for op in self.operands:
-            if isinstance(op, str) and re.match(r'^@[\w-]+$', op):
-                computed += (data[op.split('@')[1]],)
-            else:
-                computed += (op,)
-        return computed
+        return tuple(getter(data) for getter in self._getters)
+
+    @staticmethod
+    def _merge_lists(a, b):
+        """
+        Append the items of `b` not in `a`, in order. Hashable items are
+        looked up in a set, unhashable ones are compared one by one.
+        """
+        hashable = set()
+        unhashable = list()
+        for item in a:
+            try:
+                hashable.add(item)
+            except TypeError:
+                unhashable.append(item)
+
+        merged = list(a)
+        for item in b:
+            try:
+                if item in hashable:
+                    continue
+            except TypeError:
+                pass
+            if unhashable and item in unhashable:
+                continue
+            merged.append(item)
+        return merged
 
     def _union(self, a, b):
         if isinstance(a, dict) and isinstance(b, dict):
             return {**a, **b}
         elif isinstance(a, list) and isinstance(b, list):
-            return a + [item for item in b if item not in a]
+            return self._merge_lists(a, b)
         raise UnionRuleError('union available for two dicts or lists')
 
     @_Rule.track_changes
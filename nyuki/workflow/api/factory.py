@@ -1,14 +1,15 @@
+import codecs
 import csv
 import re
 import logging
 from uuid import uuid4
 from io import StringIO
 from re import error as re_error
-from aiohttp.web import FileField
+from aiohttp.web import StreamResponse
 from pymongo.errors import AutoReconnect
 
-from nyuki.workflow.tasks import FACTORY_SCHEMAS
-from nyuki.api import Response, resource, content_type
+from nyuki.workflow.tasks import FACTORY_SCHEMAS, FactoryTask
+from nyuki.api import Response, resource, content_type, streamed
 
 
 log = logging.getLogger(__name__)
@@ -76,6 +77,7 @@ class ApiFactoryRegexes:
         except AutoReconnect:
             return Response(status=503)
         await self.nyuki.storage.regexes.delete()
+        FactoryTask.CONVERTERS.invalidate()
         return Response(rules)
 
 
@@ -118,6 +120,7 @@ class ApiFactoryRegex:
                 'error_code': 'invalid_regex'
             })
         await self.nyuki.storage.regexes.insert(regex)
+        FactoryTask.CONVERTERS.invalidate(regex_id)
         return Response(regex)
 
     async def delete(self, request, regex_id):
@@ -132,6 +135,7 @@ class ApiFactoryRegex:
             return Response(status=404)
 
         await self.nyuki.storage.regexes.delete(regex_id)
+        FactoryTask.CONVERTERS.invalidate(regex_id)
         return Response(regex)
 
 
@@ -161,6 +165,120 @@ def new_lookup(title, table, lookup_id=None):
 
 
 CSV_FIELDNAMES = ['value', 'replace']
+# Bytes read from the uploaded file at once
+CSV_READ_SIZE = 65536
+# Characters needed to guess the dialect and the header
+CSV_SAMPLE_SIZE = 1024
+# Bytes needed to choose the encoding (a utf-8 character spans up to 4)
+CSV_ENCODING_SAMPLE_SIZE = 4
+
+
+class CSVStreamParser:
+
+    """
+    Parse a CSV file fed by chunks of bytes, returning the complete rows
+    found so far. The dialect and header are guessed from the first
+    `CSV_SAMPLE_SIZE` characters.
+    The encoding is chosen on the first non-ASCII byte (an ASCII prefix reads
+    the same either way): utf-8 if the bytes from there on in the current
+    chunk are valid, latin-1 otherwise. A utf-8 file holding invalid bytes
+    further on raises a UnicodeDecodeError.
+    """
+
+    def __init__(self):
+        self.encoding = None
+        self._decoder = None
+        self._raw = b''
+        self._buffer = ''
+        self.dialect = None
+        self._has_header = False
+
+    def _detect_encoding(self, data, final):
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(data, final)
+        except UnicodeDecodeError:
+            log.info('CSV file is not utf-8, decoding as latin-1')
+            self.encoding = 'latin-1'
+        else:
+            self.encoding = 'utf-8'
+        self._decoder = codecs.getincrementaldecoder(self.encoding)()
+
+    def _decode(self, data, final=False):
+        if self.encoding is not None:
+            return self._decoder.decode(data, final)
+
+        data, self._raw = self._raw + data, b''
+        try:
+            return data.decode('ascii')
+        except UnicodeDecodeError as exc:
+            text, data = data[:exc.start].decode('ascii'), data[exc.start:]
+        if len(data) < CSV_ENCODING_SAMPLE_SIZE and not final:
+            # Wait for the whole first non-ASCII character
+            self._raw = data
+            return text
+        self._detect_encoding(data, final)
+        return text + self._decoder.decode(data, final)
+
+    def _sniff(self):
+        sniffer = csv.Sniffer()
+        sample = self._buffer[:CSV_SAMPLE_SIZE]
+        # Could not determine delimiter, raises csv.Error
+        self.dialect = sniffer.sniff(sample)
+        self._has_header = sniffer.has_header(sample)
+        log.info(
+            "CSV file validated with delimiter: '%s'", self.dialect.delimiter
+        )
+
+    def _parse(self, text):
+        reader = csv.DictReader(
+            StringIO(text), fieldnames=CSV_FIELDNAMES, dialect=self.dialect
+        )
+        # Ignore header if there is one
+        if self._has_header:
+            self._has_header = False
+            header = next(reader, None)
+            log.info('CSV header found: %s', header)
+        return list(reader)
+
+    def _cut(self):
+        """
+        Return the buffered text up to its last line break not enclosed in
+        quotes, keeping the rest (an incomplete row) in the buffer.
+        """
+        quotechar = self.dialect.quotechar
+        end = self._buffer.rfind('\n')
+        if not quotechar or self.dialect.quoting == csv.QUOTE_NONE:
+            text, self._buffer = self._buffer[:end + 1], self._buffer[end + 1:]
+            return text
+
+        quotes = self._buffer.count(quotechar)
+        while end >= 0:
+            if (quotes - self._buffer.count(quotechar, end)) % 2 == 0:
+                break
+            end = self._buffer.rfind('\n', 0, end)
+        text, self._buffer = self._buffer[:end + 1], self._buffer[end + 1:]
+        return text
+
+    def feed(self, data):
+        """
+        Return the rows completed by this chunk of bytes
+        """
+        self._buffer += self._decode(data)
+        if self.dialect is None:
+            if len(self._buffer) < CSV_SAMPLE_SIZE:
+                return []
+            self._sniff()
+        return self._parse(self._cut())
+
+    def close(self):
+        """
+        Return the remaining rows
+        """
+        self._buffer += self._decode(b'', final=True)
+        if self.dialect is None:
+            self._sniff()
+        text, self._buffer = self._buffer, ''
+        return self._parse(text)
 
 
 @resource('/workflow/lookups', versions=['v1'])
@@ -176,57 +294,89 @@ class ApiFactoryLookups:
             return Response(status=503)
         return Response(lookups)
 
+    async def _read_csv(self, part, writer):
+        """
+        Parse the CSV part by chunks, writing its rows as they come
+        """
+        parser = CSVStreamParser()
+        while True:
+            data = await part.read_chunk(CSV_READ_SIZE)
+            if not data:
+                break
+            rows = parser.feed(data)
+            if rows:
+                await writer.write(rows)
+        await writer.write(parser.close())
+
     @content_type('multipart/form-data')
+    @streamed
     async def post(self, request):
         """
-        Get a CSV file and parse it into a new lookup table.
+        Get a CSV file and parse it into a new lookup table, streaming the
+        rows to the storage. Return the lookup without its table.
         """
-        data = await request.post()
-        if 'csv' not in data or not isinstance(data['csv'], FileField):
+        try:
+            reader = await request.multipart()
+        except (AssertionError, ValueError) as exc:
+            log.debug(exc)
             return Response(status=400, body={
-                'error': "'csv' field must be a CSV file"
+                'error': 'multipart/form-data must be a form'
             })
 
-        # From bytes to string (aiohttp handles everything in bytes)
-        csv_field = data['csv']
-        lookup_name = data.get('title') or csv_field.filename.replace('.csv', '')
-        csv_string = csv_field.file.read()
-
-        # Try utf-8 or latin-1 encoding
+        lookup = {'id': str(uuid4())}
+        writer = self.nyuki.storage.lookups.writer(lookup)
+        title = filename = None
         try:
-            iocsv = StringIO(csv_string.decode())
-        except UnicodeDecodeError:
-            iocsv = StringIO(csv_string.decode('latin-1'))
-
-        # Find headers and dialect using a Sniffer
-        sniffer = csv.Sniffer()
-        sample = iocsv.read(1024)
-        iocsv.seek(0)
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name == 'title':
+                    title = await part.text()
+                elif part.name == 'csv' and part.filename and not filename:
+                    filename = part.filename
+                    await self._read_csv(part, writer)
+                else:
+                    await part.release()
+
+            if filename is None:
+                await writer.abort()
+                return Response(status=400, body={
+                    'error': "'csv' field must be a CSV file"
+                })
 
-        try:
-            dialect = sniffer.sniff(sample)
+            # The title may come after the file in the form
+            lookup['title'] = title or filename.replace('.csv', '')
+            await writer.close()
         except csv.Error as exc:
             # Could not determine delimiter
             log.error(exc)
+            await writer.abort()
             return Response(status=400, body={
                 'error': str(exc),
                 'code': 'CSV_PARSE_ERROR'
             })
-
-        log.info("CSV file validated with delimiter: '%s'", dialect.delimiter)
-        reader = csv.DictReader(iocsv, fieldnames=CSV_FIELDNAMES, dialect=dialect)
-        # Ignore header if there is one
-        if sniffer.has_header(sample):
-            header = reader.__next__()
-            log.info('CSV header found: %s', header)
-        table = list(reader)
-
-        lookup = new_lookup(lookup_name, table)
-        try:
-            await self.nyuki.storage.lookups.insert(lookup)
+        except UnicodeDecodeError as exc:
+            # Mixed encodings
+            log.error(exc)
+            await writer.abort()
+            return Response(status=400, body={
+                'error': 'CSV file is not valid utf-8: {}'.format(exc.reason),
+                'code': 'CSV_ENCODING_ERROR'
+            })
         except AutoReconnect:
+            try:
+                await writer.abort()
+            except AutoReconnect:
+                log.warning(
+                    "Could not remove the chunks of lookup '%s'", lookup['id']
+                )
             return Response(status=503)
-        return Response(lookup)
+        except Exception:
+            await writer.abort()
+            raise
+
+        return Response(dict(lookup, size=writer.size))
 
     async def put(self, request):
         """
@@ -260,6 +410,7 @@ class ApiFactoryLookups:
         except AutoReconnect:
             return Response(status=503)
         await self.nyuki.storage.lookups.delete()
+        FactoryTask.CONVERTERS.invalidate()
         return Response(lookups)
 
 
@@ -296,6 +447,7 @@ class ApiFactoryLookup:
             lookup_id=lookup_id
         )
         await self.nyuki.storage.lookups.insert(lookup)
+        FactoryTask.CONVERTERS.invalidate(lookup_id)
         return Response(lookup)
 
     async def delete(self, request, lookup_id):
@@ -310,6 +462,7 @@ class ApiFactoryLookup:
             return Response(status=404)
 
         await self.nyuki.storage.lookups.delete(lookup_id)
+        FactoryTask.CONVERTERS.invalidate(lookup_id)
         return Response(lookup)
 
 
@@ -321,7 +474,7 @@ class ApiFactoryLookupCSV:
         Return the lookup table for id `lookup_id`
         """
         try:
-            lookup = await self.nyuki.storage.lookups.get(lookup_id)
+            lookup = await self.nyuki.storage.lookups.get(lookup_id, table=False)
         except AutoReconnect:
             return Response(status=503)
         if not lookup:
@@ -333,28 +486,49 @@ class ApiFactoryLookupCSV:
 
         encoding = request.GET.get('encoding', 'UTF-8')
 
-        # Write CSV
-        with StringIO() as iocsv:
-            writer = csv.DictWriter(
-                iocsv, fieldnames=CSV_FIELDNAMES, delimiter=','
-            )
-            writer.writeheader()
-            for pair in lookup['table']:
-                writer.writerow(pair)
-            iocsv.seek(0)
-
-            headers = {
-                'Content-Disposition': 'attachment; filename={}'.format(filename),
-                'Content-Type': 'text/csv; charset={}'.format(encoding)
-            }
+        def to_csv(rows, header=False):
+            with StringIO() as iocsv:
+                writer = csv.DictWriter(
+                    iocsv, fieldnames=CSV_FIELDNAMES, delimiter=','
+                )
+                if header:
+                    writer.writeheader()
+                for pair in rows:
+                    writer.writerow(pair)
+                return iocsv.getvalue().encode(encoding)
+
+        # Encode the first chunk before sending any header, so that an
+        # encoding error can still be returned as such
+        chunks = self.nyuki.storage.lookups.iterate_rows(lookup)
+        try:
+            first = to_csv(await chunks.__anext__(), header=True)
+        except StopAsyncIteration:
+            first = to_csv([], header=True)
+            chunks = None
+        except UnicodeEncodeError as exc:
+            return Response(status=406, body={
+                'error': str(exc),
+                'code': 'UNICODE_ENCODING_ERROR'
+            })
+        except AutoReconnect:
+            return Response(status=503)
 
+        response = StreamResponse(headers={
+            'Content-Disposition': 'attachment; filename={}'.format(filename),
+            'Content-Type': 'text/csv; charset={}'.format(encoding)
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        response.write(first)
+        if chunks is not None:
             try:
-                return Response(
-                    text=iocsv.read(),
-                    headers=headers
-                )
+                async for rows in chunks:
+                    response.write(to_csv(rows))
+                    await response.drain()
             except UnicodeEncodeError as exc:
-                return Response(status=406, body={
-                    'error': str(exc),
-                    'code': 'UNICODE_ENCODING_ERROR'
-                })
+                # Headers are already sent, the file is truncated
+                log.error(
+                    'CSV export of lookup %s aborted: %s', lookup_id, exc
+                )
+        await response.write_eof()
+        return response
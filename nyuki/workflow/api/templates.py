@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import time
+from copy import deepcopy
 from pymongo import DESCENDING
 from pymongo.errors import AutoReconnect, DuplicateKeyError
 from tukio.workflow import TemplateGraphError, WorkflowTemplate
@@ -26,11 +28,23 @@ class TemplateCollection:
     These records will be used to ensure a persistence of created workflows
     in case the nyuki get into trouble.
     Templates are retrieved and loaded at startup.
+    The latest published version of each template is also cached along
+    with its metadata, to trigger workflows without querying mongo.
     """
 
+    # Entries are reloaded after this delay, in case a change notification
+    # from another nyuki was missed
+    CACHE_TTL = 60
+
     def __init__(self, templates_collection, metadata_collection):
         self._templates = templates_collection
         self._metadata = metadata_collection
+        # (template id, version) -> (expiry time, template with metadata)
+        self._cache = dict()
+        # Template id -> latest published version
+        self._latest = dict()
+        # Called with a template id when it changed, to notify other nyukis
+        self.on_change = None
         # Indexes (ASCENDING by default)
         asyncio.ensure_future(self._metadata.create_index('id', unique=True))
         asyncio.ensure_future(self._templates.create_index(
@@ -41,6 +55,56 @@ class TemplateCollection:
             [('id', DESCENDING), ('draft', DESCENDING)]
         ))
 
+    def _cache_template(self, template):
+        key = (template['id'], template['version'])
+        self._cache[key] = (time.monotonic() + self.CACHE_TTL, template)
+        self._latest[template['id']] = template['version']
+
+    async def load(self):
+        """
+        Fill the cache with the latest version of all templates
+        """
+        self._cache.clear()
+        self._latest.clear()
+        for template in await self.get_all(full=True, latest=True):
+            self._cache_template(template)
+        log.info('Cached %d workflow template(s)', len(self._cache))
+
+    async def get_published(self, tid):
+        """
+        Return a copy of the latest published version of a template with
+        its metadata (or None), from the cache
+        """
+        version = self._latest.get(tid)
+        try:
+            expiry, template = self._cache[(tid, version)]
+        except KeyError:
+            pass
+        else:
+            if expiry > time.monotonic():
+                return deepcopy(template)
+
+        templates = await self.get(tid, draft=False, with_metadata=True)
+        if not templates:
+            self.invalidate(tid, notify=False)
+            return None
+        self._cache_template(templates[0])
+        return deepcopy(templates[0])
+
+    def invalidate(self, tid=None, notify=True):
+        """
+        Drop a template (or all templates) from the cache
+        """
+        if tid is None:
+            self._cache.clear()
+            self._latest.clear()
+        else:
+            self._latest.pop(tid, None)
+            for key in [key for key in self._cache if key[0] == tid]:
+                del self._cache[key]
+        if notify and self.on_change is not None:
+            self.on_change(tid)
+
     async def get_metadata(self, tid=None):
         """
         Return metadata
@@ -141,6 +205,7 @@ class TemplateCollection:
             await self._templates.insert(template.copy())
         except DuplicateKeyError as exc:
             raise DuplicateTemplateError from exc
+        self.invalidate(template['id'])
 
     async def insert_draft(self, template):
         """
@@ -171,6 +236,7 @@ class TemplateCollection:
 
         log.info('Update metadata for query: %s', query)
         await self._metadata.update(query, metadata, upsert=True)
+        self.invalidate(metadata['id'])
 
         return metadata
 
@@ -180,6 +246,7 @@ class TemplateCollection:
         """
         query = {'id': tid, 'draft': True}
         await self._templates.update(query, {'$set': {'draft': False}})
+        self.invalidate(tid)
 
     async def delete(self, tid, version=None, draft=None):
         """
@@ -197,6 +264,8 @@ class TemplateCollection:
         left = await self._templates.find({'id': tid}).count()
         if not left:
             await self._metadata.remove({'id': tid})
+        if draft is not True:
+            self.invalidate(tid)
 
 
 @resource('/workflow/tasks', versions=['v1'])
@@ -7,9 +7,11 @@ from datetime import datetime
 from aiohttp.web import FileField
 from tukio import get_broker, EXEC_TOPIC
 from tukio.utils import FutureState
-from tukio.workflow import WorkflowTemplate, WorkflowExecState
+from tukio.workflow import (
+    TemplateGraphError, WorkflowTemplate, WorkflowExecState
+)
 from pymongo import DESCENDING, ASCENDING
-from pymongo.errors import AutoReconnect, DuplicateKeyError
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError
 
 from nyuki.utils import from_isoformat
 from nyuki.api import Response, resource, content_type
@@ -18,6 +20,8 @@ from nyuki.workflow.tasks.utils.uri import URI, InvalidWorkflowUri
 
 log = logging.getLogger(__name__)
 
+DUPLICATE_KEY = 11000
+
 
 class Ordering(Enum):
 
@@ -109,9 +113,40 @@ class InstanceCollection:
             await self._instances.insert(workflow)
         except DuplicateKeyError:
             # If it's a duplicate, we don't want to lose it
-            workflow['exec']['duplicate'] = workflow['exec']['id']
-            workflow['exec']['id'] = str(uuid4())
-            await self._instances.insert(workflow)
+            await self._instances.insert(self._as_duplicate(workflow))
+
+    @staticmethod
+    def _as_duplicate(workflow):
+        workflow['exec']['duplicate'] = workflow['exec']['id']
+        workflow['exec']['id'] = str(uuid4())
+        return workflow
+
+    async def insert_many(self, workflows, retry=False):
+        """
+        Insert finished workflow reports into the workflow history at once.
+        Duplicates are handled as in `insert`, unless this is a `retry` of
+        a batch that may have been partially inserted.
+        """
+        # Mongo sets the '_id' of the inserted dicts, and duplicates get a
+        # new exec id
+        workflows = [
+            dict(workflow, exec=dict(workflow['exec']))
+            for workflow in workflows
+        ]
+        try:
+            await self._instances.insert_many(workflows, ordered=False)
+        except BulkWriteError as exc:
+            errors = exc.details.get('writeErrors', [])
+            if exc.details.get('writeConcernErrors') or any(
+                    error.get('code') != DUPLICATE_KEY for error in errors):
+                raise
+            if retry:
+                log.debug('%d workflow(s) were already stored', len(errors))
+                return
+            await self._instances.insert_many([
+                self._as_duplicate(workflows[error['index']])
+                for error in errors
+            ], ordered=False)
 
 
 class _WorkflowResource:
@@ -141,6 +176,26 @@ class _WorkflowResource:
 
         broker.register(exec_handler, topic=EXEC_TOPIC)
 
+    async def rescue(self, report, **kwargs):
+        """
+        Resume a suspended/crashed instance from its last known execution
+        report, raise a ValueError if it can't be.
+        """
+        if 'id' not in report or 'exec' not in report:
+            raise ValueError("Report keys 'id' and 'exec' are mandatory")
+        if report['exec']['id'] in self.nyuki.running_workflows:
+            raise ValueError('This workflow is already being rescued')
+
+        wf_tmpl = WorkflowTemplate.from_dict(report)
+        wflow = await self.nyuki.engine.rescue(wf_tmpl, report)
+        if wflow is None:
+            raise ValueError(
+                'Could not start any workflow from this template'
+            )
+
+        # Keep full instance+template in nyuki's memory
+        return self.nyuki.new_workflow(report, wflow, **kwargs)
+
 
 @resource('/workflow/instances', ['v1'], 'application/json')
 class ApiWorkflows(_WorkflowResource):
@@ -179,21 +234,27 @@ class ApiWorkflows(_WorkflowResource):
         if exec:
             # Suspended/crashed instance
             # The request's payload is the last known execution report
-            templates = [request]
-            if exec['id'] in self.nyuki.running_workflows:
-                return Response(status=400, body={
-                    'error': 'This workflow is already being rescued'
-                })
-        else:
-            # Fetch the template from the storage
             try:
-                templates = await self.nyuki.storage.templates.get(
-                    request['id'],
-                    draft=draft,
-                    with_metadata=True
+                wfinst = await self.rescue(
+                    request,
+                    track=exec_track.split(',') if exec_track else [],
+                    requester=requester
                 )
-            except AutoReconnect:
-                return Response(status=503)
+            except ValueError as exc:
+                return Response(status=400, body={'error': str(exc)})
+            if async_topic is not None:
+                self.register_async_handler(async_topic, wfinst.instance)
+            return Response(wfinst.report())
+
+        # Fetch the template from the storage
+        try:
+            templates = await self.nyuki.storage.templates.get(
+                request['id'],
+                draft=draft,
+                with_metadata=True
+            )
+        except AutoReconnect:
+            return Response(status=503)
 
         if not templates:
             return Response(status=404, body={
@@ -201,9 +262,7 @@ class ApiWorkflows(_WorkflowResource):
             })
 
         wf_tmpl = WorkflowTemplate.from_dict(templates[0])
-        if exec:
-            wflow = await self.nyuki.engine.rescue(wf_tmpl, request)
-        elif draft:
+        if draft:
             wflow = await self.nyuki.engine.run_once(wf_tmpl, data)
         else:
             wflow = await self.nyuki.engine.trigger(wf_tmpl.uid, data)
@@ -239,6 +298,57 @@ class ApiWorkflows(_WorkflowResource):
         return Response(wfinst.report())
 
 
+@resource('/workflow/rescue', ['v1'], 'application/json')
+class ApiWorkflowsRescue(_WorkflowResource):
+
+    async def put(self, request):
+        """
+        Rescue a list of suspended/crashed instances from their last known
+        execution reports, as sent by `failure_handler`:
+        {
+            "rescued": ["exec_id", ...],
+            "errors": {"exec_id": "error"}
+        }
+        """
+        reports = await request.json()
+        if not isinstance(reports, list):
+            return Response(status=400, body={
+                'error': 'A list of execution reports is expected'
+            })
+
+        rescued = []
+        errors = {}
+        for report in reports:
+            try:
+                exec_id = report['exec']['id']
+            except (KeyError, TypeError):
+                log.error('Invalid execution report to rescue: %s', report)
+                continue
+            # A failing report must not prevent the others from being
+            # rescued, nor make the started ones be sent elsewhere
+            try:
+                await self.rescue(report, track=[])
+            except (ValueError, TemplateGraphError) as exc:
+                errors[exec_id] = str(exc)
+            except Exception as exc:
+                log.exception(exc)
+                errors[exec_id] = str(exc) or type(exc).__name__
+            else:
+                rescued.append(exec_id)
+
+        return Response({'rescued': rescued, 'errors': errors})
+
+
+@resource('/workflow/metrics/history', versions=['v1'])
+class ApiWorkflowsHistoryMetrics:
+
+    async def get(self, request):
+        """
+        Return the history writer's queue depth and flush latency
+        """
+        return Response(self.nyuki.history.status())
+
+
 @resource('/workflow/instances/{iid}', versions=['v1'])
 class ApiWorkflow(_WorkflowResource):
 
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from pymongo.errors import ConnectionFailure
+
+from nyuki.bus.persistence.spill import SpillFile
+from nyuki.services import Service
+
+
+log = logging.getLogger(__name__)
+
+# Queued by `stop` for the worker to write what it holds and exit
+STOP = object()
+
+
+class HistoryWriter(Service):
+
+    """
+    Write the finished workflow reports into the history by batches, from a
+    bounded queue (`write` waits while it is full). Batches that can't be
+    written are spilled into a local file and retried from there. A
+    configured spill file is kept on stop and replayed on the next start,
+    the default one is private to the process and removed on stop.
+    """
+
+    def __init__(self, nyuki):
+        self._nyuki = nyuki
+        self.batch_size = 100
+        # Seconds to wait for a batch to fill up
+        self.flush_interval = 1
+        # Seconds between two attempts to write the spilled reports
+        self.retry_interval = 10
+        self._queue = asyncio.Queue(1000)
+        self._spill = None
+        self._worker = None
+        self._retry = None
+        # Set once the worker took the STOP marker from the queue
+        self._stopped = False
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self._latency = {'last': None, 'max': None, 'total': 0}
+
+    def configure(self, queue_size=1000, batch_size=100, flush_interval=1,
+                  retry_interval=10, spill=None):
+        self._queue = asyncio.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        if spill:
+            # Kept across restarts, replicas running on the same host must
+            # be given their own path
+            self._spill = SpillFile(persistent=True, **spill)
+            return
+        self._spill = SpillFile(os.path.join(
+            tempfile.gettempdir(), 'nyuki-history-{}-{}.spill'.format(
+                self._nyuki.config.get('service', 'workflow'), os.getpid()
+            )
+        ))
+
+    async def start(self):
+        # Reports spilled before the last stop are written first, new ones
+        # are spilled behind them meanwhile
+        if self._spill:
+            self._retry = asyncio.ensure_future(self._empty_spill(wait=False))
+        self._stopped = False
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._worker is not None and not self._worker.done():
+            # Let the worker write the batch it holds
+            await self._queue.put(STOP)
+            await self._worker
+        if self._retry is not None:
+            self._retry.cancel()
+        # Reports queued after the stop request
+        batch = []
+        while not self._queue.empty():
+            report = self._queue.get_nowait()
+            if report is not STOP:
+                batch.append(report)
+        if self._spill is None:
+            if batch and not await self._flush(batch):
+                log.error('%d workflow report(s) lost', len(batch))
+            return
+
+        if batch and (self._spill or not await self._flush(batch)):
+            self._spill_batch(batch, retry=False)
+        if self._spill and not self._spill.persistent:
+            # Last attempt, the file is removed on close
+            await self._write_spill()
+        if self._spill and self._spill.persistent:
+            log.warning(
+                '%d workflow report(s) kept in %s for the next start',
+                len(self._spill), self._spill.path
+            )
+        elif self._spill:
+            log.error('%d workflow report(s) lost', len(self._spill))
+            self.dropped += len(self._spill)
+        self._spill.close()
+
+    async def write(self, report):
+        """
+        Queue a finished workflow report, waiting if the queue is full
+        """
+        await self._queue.put(report)
+
+    async def _run(self):
+        while not self._stopped:
+            batch = []
+            try:
+                await self._write_batch(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Keep writing, `write` would block forever otherwise
+                log.exception(exc)
+                log.error(
+                    'Could not write a workflow history batch, '
+                    '%d workflow report(s) dropped', len(batch)
+                )
+                self.dropped += len(batch)
+
+    async def _write_batch(self, batch=None):
+        """
+        Wait for queued reports and write them as one batch (collected into
+        `batch` if given), return False once stopped
+        """
+        batch = batch if batch is not None else []
+        first = await self._queue.get()
+        if first is STOP:
+            self._stopped = True
+            return False
+        batch.append(first)
+        if self._queue.qsize() + 1 < self.batch_size:
+            # Let a batch fill up
+            await asyncio.sleep(self.flush_interval)
+        running = True
+        while len(batch) < self.batch_size and not self._queue.empty():
+            report = self._queue.get_nowait()
+            if report is STOP:
+                self._stopped = True
+                running = False
+                break
+            batch.append(report)
+
+        # Reports are spilled as long as the history is failing
+        if self._spill or not await self._flush(batch):
+            self._spill_batch(batch, retry=running)
+        return running
+
+    async def _flush(self, batch, retry=False):
+        """
+        Write a batch into the history, return False if it must be retried
+        """
+        storage = self._nyuki.storage
+        if storage is None:
+            return False
+
+        start = time.monotonic()
+        try:
+            await storage.instances.insert_many(batch, retry=retry)
+        except ConnectionFailure as exc:
+            log.warning('Could not write workflow history: %s', exc)
+            return False
+        except Exception as exc:
+            log.exception(exc)
+            log.error('%d workflow report(s) dropped', len(batch))
+            self.dropped += len(batch)
+            return True
+
+        latency = time.monotonic() - start
+        self._latency['last'] = latency
+        self._latency['max'] = max(self._latency['max'] or 0, latency)
+        self._latency['total'] += latency
+        self.flushes += 1
+        self.written += len(batch)
+        return True
+
+    def _spill_batch(self, batch, retry=True):
+        for report in batch:
+            self._spill.append({'id': report['exec']['id'], 'report': report})
+        log.info('%d workflow report(s) spilled', len(batch))
+        if retry and (self._retry is None or self._retry.done()):
+            self._retry = asyncio.ensure_future(self._empty_spill())
+
+    async def _write_spill(self):
+        """
+        Write the spilled reports into the history, return False on failure
+        """
+        while self._spill:
+            chunk, position = self._spill.peek(self.batch_size)
+            reports = [record['report'] for record in chunk]
+            if not await self._flush(reports, retry=True):
+                return False
+            self._spill.discard(position)
+        return True
+
+    async def _empty_spill(self, wait=True):
+        """
+        Retry writing the spilled reports, until none is left
+        """
+        while self._spill:
+            if wait:
+                await asyncio.sleep(self.retry_interval)
+            wait = True
+            await self._write_spill()
+        log.info('Spilled workflow reports written')
+
+    def status(self):
+        """
+        Queue depth, flush latency (seconds) and spill state
+        """
+        flushes = self.flushes
+        average = self._latency['total'] / flushes if flushes else None
+        return {
+            'queue': {
+                'size': self._queue.maxsize,
+                'count': self._queue.qsize(),
+            },
+            'written': self.written,
+            'dropped': self.dropped + (
+                self._spill.dropped if self._spill is not None else 0
+            ),
+            'flushes': flushes,
+            'latency': {
+                'last': self._latency['last'],
+                'max': self._latency['max'],
+                'average': average,
+            },
+            'spill': {
+                'path': self._spill.path,
+                'count': len(self._spill),
+                'bytes': self._spill.bytes,
+                'spilled': self._spill.spilled,
+            } if self._spill is not None else None,
+        }
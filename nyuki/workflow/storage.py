@@ -1,7 +1,13 @@
 import asyncio
+import hashlib
+import json
 import logging
+import re
+import time
+from uuid import uuid4
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from nyuki.utils.transform import LookupTable
 from .api.templates import TemplateCollection
 from .api.workflows import InstanceCollection
 
@@ -11,10 +17,103 @@ log = logging.getLogger(__name__)
 
 class _DataProcessingCollection:
 
-    def __init__(self, data_collection):
+    """
+    Regexes or lookup tables, along with an in-process cache of their
+    runtime form (built by `prepare`) used by the factory tasks.
+    """
+
+    # Entries are reloaded after this delay, in case another nyuki changed it
+    CACHE_TTL = 60
+
+    def __init__(self, data_collection, prepare=None):
         self._rules = data_collection
+        self._prepare = prepare or (lambda rule: rule)
+        # Rule id -> (expiry time, digest, prepared rule)
+        self._cache = dict()
+        self._next_eviction = 0
         asyncio.ensure_future(self._rules.create_index('id', unique=True))
 
+    @staticmethod
+    def _digest(rule):
+        dump = json.dumps(rule, sort_keys=True, default=str)
+        return hashlib.sha1(dump.encode()).hexdigest()
+
+    def _cache_rule(self, rule):
+        entry = (self._digest(rule), self._prepare(rule))
+        self._cache[rule['id']] = (time.monotonic() + self.CACHE_TTL,) + entry
+        return entry
+
+    async def _fetch(self, rule_id):
+        return await self.get(rule_id)
+
+    async def _fetch_all(self):
+        return await self.get_all()
+
+    async def _current_digest(self, rule_id):
+        """
+        Return the digest of the stored rule if it can be known without
+        fetching the whole rule, else None
+        """
+        return None
+
+    async def load(self):
+        """
+        Fill the cache with all the rules
+        """
+        self._cache.clear()
+        for rule in await self._fetch_all():
+            try:
+                self._cache_rule(rule)
+            except re.error as exc:
+                # Invalid stored pattern, only break the tasks using it
+                log.error("Could not compile rule '%s': %s", rule['id'], exc)
+        log.info(
+            "Cached %d rule(s) from collection '%s'",
+            len(self._cache), self._rules.name
+        )
+
+    async def resolve(self, rule_id):
+        """
+        Return a (digest, prepared rule) tuple for given id (or None), from
+        the cache. The digest changes with the rule content.
+        """
+        self._evict_unused()
+        try:
+            expiry, digest, prepared = self._cache[rule_id]
+        except KeyError:
+            pass
+        else:
+            if expiry > time.monotonic():
+                return digest, prepared
+            if digest == await self._current_digest(rule_id):
+                # Unchanged, keep the prepared rule
+                self._cache[rule_id] = (
+                    time.monotonic() + self.CACHE_TTL, digest, prepared
+                )
+                return digest, prepared
+            self._cache.pop(rule_id, None)
+
+        rule = await self._fetch(rule_id)
+        if rule is None:
+            return None
+        return self._cache_rule(rule)
+
+    def _evict_unused(self):
+        """
+        Drop the entries that were not resolved again within a TTL after
+        expiring
+        """
+        now = time.monotonic()
+        if now < self._next_eviction:
+            return
+        self._next_eviction = now + self.CACHE_TTL
+        unused = [
+            rule_id for rule_id, (expiry, _, _) in self._cache.items()
+            if expiry + self.CACHE_TTL < now
+        ]
+        for rule_id in unused:
+            del self._cache[rule_id]
+
     async def get_all(self):
         """
         Return a list of all rules
@@ -48,6 +147,7 @@ class _DataProcessingCollection:
         )
         log.debug('upserting data: %s', data)
         await self._rules.update(query, data, upsert=True)
+        self._cache.pop(data['id'], None)
 
     async def delete(self, rule_id=None):
         """
@@ -57,6 +157,220 @@ class _DataProcessingCollection:
         log.info("Removing rule(s) from collection '%s'", self._rules.name)
         log.debug('delete query: %s', query)
         await self._rules.remove(query)
+        if rule_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(rule_id, None)
+
+
+class _LookupWriter:
+
+    """
+    Write the rows of a lookup table by chunks, as they come. The lookup
+    document references the new chunks once `close()` is called.
+    """
+
+    def __init__(self, collection, lookup):
+        self._collection = collection
+        self.lookup = lookup
+        self._version = str(uuid4())
+        self._sha1 = hashlib.sha1()
+        self._rows = list()
+        self._index = 0
+        self.size = 0
+
+    async def _write_chunk(self, rows):
+        self._sha1.update(
+            json.dumps(rows, sort_keys=True, default=str).encode()
+        )
+        await self._collection._chunks.insert_many([{
+            'lookup_id': self.lookup['id'],
+            'version': self._version,
+            'index': self._index,
+            'rows': rows,
+        }])
+        self._index += 1
+
+    async def write(self, rows):
+        chunk_size = self._collection.CHUNK_SIZE
+        self._rows.extend(rows)
+        self.size += len(rows)
+        while len(self._rows) >= chunk_size:
+            rows = self._rows[:chunk_size]
+            del self._rows[:chunk_size]
+            await self._write_chunk(rows)
+
+    async def close(self):
+        if self._rows:
+            await self._write_chunk(self._rows)
+            self._rows = list()
+        lookup = dict(self.lookup)
+        lookup.update({
+            'digest': self._sha1.hexdigest(),
+            'version': self._version,
+            'chunks': self._index,
+        })
+        await self._collection._insert_lookup(lookup)
+
+    async def abort(self):
+        await self._collection._chunks.remove({
+            'lookup_id': self.lookup['id'], 'version': self._version
+        })
+
+
+class _LookupCollection(_DataProcessingCollection):
+
+    """
+    Lookup tables, their rows being stored by chunks in a second collection
+    (a single document is limited to 16MB). Chunks are written under a new
+    version, referenced by the lookup document once complete, so that
+    readers never get a partially written table.
+    """
+
+    CHUNK_SIZE = 10000
+    PRIVATE_FIELDS = ('digest', 'version', 'chunks')
+
+    def __init__(self, data_collection, chunks_collection):
+        super().__init__(data_collection, _build_lookup)
+        self._chunks = chunks_collection
+        asyncio.ensure_future(self._chunks.create_index(
+            [('lookup_id', 1), ('version', 1), ('index', 1)]
+        ))
+
+    def _digest(self, rule):
+        return rule.get('digest') or super()._digest(rule)
+
+    def _public(self, lookup):
+        return {
+            key: value for key, value in lookup.items()
+            if key not in self.PRIVATE_FIELDS
+        }
+
+    def iterate_rows(self, lookup):
+        """
+        Return an async iterator over the rows of a lookup, chunk by chunk
+        """
+        return _LookupRows(self._chunks, lookup)
+
+    async def _with_table(self, lookup):
+        table = list()
+        async for rows in self.iterate_rows(lookup):
+            table.extend(rows)
+        lookup['table'] = table
+        return lookup
+
+    async def _fetch(self, rule_id):
+        lookup = await super().get(rule_id)
+        if lookup is None:
+            return None
+        return await self._with_table(lookup)
+
+    async def _fetch_all(self):
+        lookups = []
+        for lookup in await super().get_all():
+            lookups.append(await self._with_table(lookup))
+        return lookups
+
+    async def load(self):
+        """
+        Tables are only read and built on their first `resolve`, not to hold
+        unused ones in memory
+        """
+        self._cache.clear()
+
+    async def _current_digest(self, rule_id):
+        cursor = self._rules.find({'id': rule_id}, {'_id': 0, 'digest': 1})
+        await cursor.fetch_next
+        lookup = cursor.next_object()
+        return lookup.get('digest') if lookup else None
+
+    async def get_all(self):
+        """
+        Return a list of all lookup tables
+        """
+        return [self._public(lookup) for lookup in await self._fetch_all()]
+
+    async def get(self, rule_id, table=True):
+        """
+        Return the lookup table for given id or None, only its description
+        (and private fields needed by `iterate_rows`) without `table`
+        """
+        if not table:
+            return await super().get(rule_id)
+        lookup = await self._fetch(rule_id)
+        return self._public(lookup) if lookup else None
+
+    def writer(self, lookup):
+        """
+        Return a writer inserting the rows of `lookup` by chunks
+        """
+        return _LookupWriter(self, lookup)
+
+    async def insert(self, data):
+        """
+        Insert a lookup table, its rows being written by chunks
+        """
+        lookup = {key: value for key, value in data.items() if key != 'table'}
+        writer = self.writer(lookup)
+        try:
+            await writer.write(data['table'])
+            await writer.close()
+        except Exception:
+            await writer.abort()
+            raise
+
+    async def _insert_lookup(self, lookup):
+        await super().insert(lookup)
+        # Chunks of the previous versions
+        await self._chunks.remove({
+            'lookup_id': lookup['id'], 'version': {'$ne': lookup['version']}
+        })
+
+    async def delete(self, rule_id=None):
+        """
+        Delete a lookup table from its id or all of them
+        """
+        await super().delete(rule_id)
+        query = {'lookup_id': rule_id} if rule_id is not None else None
+        await self._chunks.remove(query)
+
+
+class _LookupRows:
+
+    """
+    Async iterator over the chunks of rows of a lookup table
+    """
+
+    def __init__(self, chunks, lookup):
+        self._lookup = lookup
+        self._cursor = None
+        if 'table' not in lookup:
+            self._cursor = chunks.find(
+                {'lookup_id': lookup['id'], 'version': lookup['version']},
+                {'_id': 0, 'rows': 1}
+            ).sort('index')
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._cursor is None:
+            # Lookups inserted before chunking hold their table
+            if self._lookup is None:
+                raise StopAsyncIteration
+            table, self._lookup = self._lookup['table'], None
+            return table
+        if not await self._cursor.fetch_next:
+            raise StopAsyncIteration
+        return self._cursor.next_object()['rows']
+
+
+def _compile_regex(regex):
+    return re.compile(regex['pattern'])
+
+
+def _build_lookup(lookup):
+    return LookupTable.from_pairs(lookup['table'])
 
 
 class _TriggerCollection:
@@ -110,6 +424,8 @@ class MongoStorage:
         # Collections
         self.templates = TemplateCollection(db['templates'], db['metadata'])
         self.instances = InstanceCollection(db['instances'])
-        self.regexes = _DataProcessingCollection(db['regexes'])
-        self.lookups = _DataProcessingCollection(db['lookups'])
+        self.regexes = _DataProcessingCollection(
+            db['regexes'], _compile_regex
+        )
+        self.lookups = _LookupCollection(db['lookups'], db['lookup_chunks'])
         self.triggers = _TriggerCollection(db['triggers'])
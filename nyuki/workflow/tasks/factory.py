@@ -1,12 +1,11 @@
 import asyncio
 import logging
-from aiohttp import ClientSession
-from copy import deepcopy
 from tukio.task import register
 from tukio.task.holder import TaskHolder
 
-from nyuki.utils import Converter
-from nyuki.utils.transform import Arithmetic
+from nyuki.utils.transform import (
+    Arithmetic, Converter, ConverterCache, TRACE_FULL, TRACE_LEVELS
+)
 from nyuki.workflow.tasks.utils import runtime, generate_factory_schema
 
 
@@ -119,73 +118,89 @@ FACTORY_SCHEMAS = {
 @register('factory', 'execute')
 class FactoryTask(TaskHolder):
 
-    SCHEMA = generate_factory_schema(**FACTORY_SCHEMAS)
+    SCHEMA = generate_factory_schema({
+        'type': 'object',
+        'properties': {
+            'trace': {
+                'type': 'string',
+                'enum': list(TRACE_LEVELS),
+                'description': 'details of the changes reported'
+            }
+        }
+    }, **FACTORY_SCHEMAS)
+    # Converters shared by all factory tasks, built once per configuration
+    CONVERTERS = ConverterCache()
 
     def __init__(self, config):
         super().__init__(config)
         self._diff = None
-        self.api_url = 'http://localhost:{}/v1/workflow'.format(
-            runtime.config['api']['port']
-        )
 
     def report(self):
         return self._diff
 
-    async def get_regex(self, session, rule):
+    async def get_regex(self, rule, depends):
         """
-        Query the nyuki to get the actual regexes from their IDs
+        Get the actual regex from its ID, through the storage cache
         """
-        url = '{}/regexes/{}'.format(self.api_url, rule['regex_id'])
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(
-                    'Could not find regex with id {}'.format(
-                        rule['regex_id']
-                    )
-                )
-            data = await resp.json()
-            rule['pattern'] = data['pattern']
-            del rule['regex_id']
-
-    async def get_lookup(self, session, rule):
+        resolved = await runtime.storage.regexes.resolve(rule['regex_id'])
+        if resolved is None:
+            raise RuntimeError(
+                'Could not find regex with id {}'.format(rule['regex_id'])
+            )
+        depends[rule['regex_id']], regex = resolved
+        rule = rule.copy()
+        rule['pattern'] = regex.pattern
+        del rule['regex_id']
+        return rule
+
+    async def get_lookup(self, rule, depends):
         """
-        Query the nyuki to get the actual lookup tables from their IDs
+        Get the actual lookup table from its ID, through the storage cache
         """
-        url = '{}/lookups/{}'.format(self.api_url, rule['lookup_id'])
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(
-                    'Could not find lookup table with id {}'.format(
-                        rule['lookup_id']
-                    )
+        resolved = await runtime.storage.lookups.resolve(rule['lookup_id'])
+        if resolved is None:
+            raise RuntimeError(
+                'Could not find lookup table with id {}'.format(
+                    rule['lookup_id']
                 )
-            data = await resp.json()
-            rule['table'] = {
-                field['value']: field['replace']
-                for field in data['table']
-            }
-            del rule['lookup_id']
+            )
+        depends[rule['lookup_id']], table = resolved
+        rule = rule.copy()
+        rule['table'] = table
+        del rule['lookup_id']
+        return rule
 
     async def get_factory_rules(self, config):
         """
         Iterate through the task's configuration to swap from their IDs to
-        their database equivalent within the nyuki
+        their database equivalent within the nyuki, return the new config and
+        the IDs mapped to their content digest
         """
-        async with ClientSession() as session:
-            for rule in config['rules']:
-                if rule['type'] in ['extract', 'sub']:
-                    await self.get_regex(session, rule)
-                elif rule['type'] == 'lookup':
-                    await self.get_lookup(session, rule)
+        rules = list()
+        depends = dict()
+        for rule in config['rules']:
+            if rule['type'] in ['extract', 'sub']:
+                rule = await self.get_regex(rule, depends)
+            elif rule['type'] == 'lookup':
+                rule = await self.get_lookup(rule, depends)
+            rules.append(rule)
+        return {**config, 'rules': rules}, depends
 
     async def execute(self, event):
         data = event.data
-        runtime_config = deepcopy(self.config)
-        await self.get_factory_rules(runtime_config)
+        runtime_config, depends = await self.get_factory_rules(self.config)
 
         log.debug('Full factory config: %s', runtime_config)
-        converter = Converter.from_dict(runtime_config)
-        self._diff = converter.apply(data)
+        # Keyed by the task config and the version of the regexes/lookups,
+        # hashing large resolved lookup tables for each event is avoided
+        converter = self.CONVERTERS.get(
+            self.config, depends,
+            build=lambda: Converter.from_dict(runtime_config)
+        )
+        # Only the requested level of details is built and dispatched
+        self._diff = converter.apply(
+            data, self.config.get('trace', TRACE_FULL)
+        )
 
         task = asyncio.Task.current_task()
         task.dispatch_progress(self._diff)
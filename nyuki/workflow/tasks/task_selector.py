@@ -18,22 +18,24 @@ class TaskConditionBlock(ConditionBlock):
     set next workflow tasks.
     """
 
-    def __init__(self, conditions, workflow):
-        super().__init__(conditions)
-        self._workflow = workflow
-        self._selected = None
-
     def condition_validated(self, rules, data):
         """
         Set next workflow tasks upon validating a condition.
         """
         if rules:
-            self._workflow.set_next_tasks(rules[0]['tasks'])
-            self._selected = rules[0]['tasks']
+            Workflow.current_workflow().set_next_tasks(rules[0]['tasks'])
 
-    def apply(self, data):
-        super().apply(data)
-        return self._selected
+    def selected_tasks(self, data):
+        """
+        Return the next workflow tasks of the first validated condition
+        (None if none is).
+        """
+        index = self.select(data)
+        if index is None:
+            return None
+        rules = self._conditions[index].get('rules')
+        if rules:
+            return rules[0]['tasks']
 
 
 @register('task_selector', 'execute')
@@ -58,19 +60,26 @@ class TaskSelector(TaskHolder):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._selected = None
+        # Conditions are compiled once for all executions
+        self._blocks = [
+            TaskConditionBlock(block['conditions'])
+            if block['type'] == 'condition-block' else block
+            for block in self.config['rules']
+        ]
 
     async def execute(self, event):
         data = event.data
         workflow = Workflow.current_workflow()
         self._selected = None
-        for block in self.config['rules']:
-            if block['type'] == 'task-selector':
-                workflow.set_next_tasks(block['tasks'])
-                self._selected = block['tasks']
-            elif block['type'] == 'condition-block':
-                selected = TaskConditionBlock(block['conditions'], workflow).apply(data)
+        for block in self._blocks:
+            if isinstance(block, TaskConditionBlock):
+                selected = block.selected_tasks(data)
                 if selected is not None:
+                    workflow.set_next_tasks(selected)
                     self._selected = selected
+            elif block['type'] == 'task-selector':
+                workflow.set_next_tasks(block['tasks'])
+                self._selected = block['tasks']
 
         task = asyncio.Task.current_task()
         task.dispatch_progress({'tasks': self._selected})
@@ -18,6 +18,7 @@ class RuntimeContext(object):
     def __init__(self):
         self._config = dict()
         self._bus = None
+        self._storage = None
 
     @property
     def config(self):
@@ -35,5 +36,13 @@ class RuntimeContext(object):
     def bus(self, value):
         self._bus = value
 
+    @property
+    def storage(self):
+        return self._storage
+
+    @storage.setter
+    def storage(self, value):
+        self._storage = value
+
 
 sys.modules[__name__] = RuntimeContext.instance()
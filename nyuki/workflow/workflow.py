@@ -3,7 +3,7 @@ import asyncio
 import logging
 import pickle
 import aiohttp
-from random import shuffle
+from collections import OrderedDict
 from datetime import datetime
 from tukio import Engine, TaskRegistry, get_broker, EXEC_TOPIC
 from tukio.workflow import (
@@ -24,13 +24,15 @@ from .api.templates import (
     ApiTasks, ApiTemplates, ApiTemplate, ApiTemplateVersion, ApiTemplateDraft
 )
 from .api.workflows import (
-    ApiWorkflow, ApiWorkflows, ApiWorkflowsHistory, ApiWorkflowHistory,
-    ApiWorkflowTriggers, ApiWorkflowTrigger
+    ApiWorkflow, ApiWorkflows, ApiWorkflowsRescue, ApiWorkflowsHistory,
+    ApiWorkflowHistory, ApiWorkflowsHistoryMetrics, ApiWorkflowTriggers,
+    ApiWorkflowTrigger
 )
 from .api.vars import (
     ApiVars, ApiVarsVersion, ApiVarsDraft
 )
 
+from .history import HistoryWriter
 from .storage import MongoStorage
 from .tasks import *
 from .tasks.utils import runtime
@@ -67,6 +69,17 @@ def sanitize_workflow_exec(obj):
     return obj
 
 
+def _copy_report(obj):
+    """
+    Copy the dicts and lists of a report, any other value is shared.
+    """
+    if isinstance(obj, dict):
+        return {key: _copy_report(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_copy_report(item) for item in obj]
+    return obj
+
+
 class WorkflowInstance(WebsocketResource):
 
     """
@@ -75,6 +88,8 @@ class WorkflowInstance(WebsocketResource):
     """
 
     ALLOWED_EXEC_KEYS = ['requester', 'track']
+    # The full report is shared again after this many task updates
+    SHARED_COMPACTION = 100
 
     def __init__(self, template, instance, **kwargs):
         super().__init__('/exec/{}'.format(instance.uid))
@@ -85,6 +100,18 @@ class WorkflowInstance(WebsocketResource):
             for key in kwargs
             if key in self.ALLOWED_EXEC_KEYS
         }
+        # Merged report parts, tasks being updated one by one from the
+        # exec events (None means a full rebuild is needed)
+        self._exec_report = None
+        self._tasks = None
+        self._running_tasks = {}
+        # Cached report and its pickled form, reset on each change
+        self._report = None
+        self._dump = None
+        # Tasks updated since the last shared memory write (None means the
+        # full report must be written)
+        self._shared = None
+        self._shared_updates = 0
 
     @property
     def template(self):
@@ -104,25 +131,125 @@ class WorkflowInstance(WebsocketResource):
         """
         return self.report()
 
-    def report(self):
+    def _merge_report(self):
         """
         Merge a workflow exec instance report and its template.
         """
-        template = self._template.copy()
         inst = self._instance.report()
-        tasks = {task['id']: task for task in template['tasks']}
-
+        tasks = OrderedDict(
+            (task['id'], task) for task in self._template['tasks']
+        )
         inst['exec'].update(self._exec)
         for task in inst['tasks']:
             # Stored template contains more info than tukio's (title...),
             # so we add it to the report.
             tasks[task['id']] = {**tasks[task['id']], **task}
+        self._exec_report = inst['exec']
+        self._tasks = tasks
 
-        return {
-            **self._template,
-            'exec': inst['exec'],
-            'tasks': [task for task in tasks.values()]
+    def _task_exec(self, task_exec_id):
+        """
+        Return the exec report of a running task, or None if not found.
+        """
+        task = self._running_tasks.get(task_exec_id)
+        if task is None:
+            self._running_tasks = {
+                task.uid: task for task in self._instance.tasks
+            }
+            task = self._running_tasks.get(task_exec_id)
+            if task is None:
+                return None
+        report = task.as_dict()
+        # If the task is linked to a task holder, use its own report
+        try:
+            report['reporting'] = task.holder.report()
+        except AttributeError:
+            pass
+        return report
+
+    def update(self, source):
+        """
+        Update the report from an exec event source, only the task that
+        sent it if any.
+        """
+        self._report = self._dump = None
+        if self._tasks is None:
+            return
+        task_id = source.get('task_template_id')
+        task_exec = None
+        if task_id in self._tasks and source.get('task_exec_id'):
+            task_exec = self._task_exec(source['task_exec_id'])
+        if task_exec is None:
+            # Workflow state changed, rebuild everything
+            self._tasks = self._shared = None
+            return
+        self._tasks[task_id] = {**self._tasks[task_id], 'exec': task_exec}
+        if self._shared is not None:
+            self._shared.add(task_id)
+
+    def _cached_report(self):
+        """
+        Return the cached merged report, not to be modified.
+        """
+        if self._report is None:
+            if self._tasks is None:
+                self._merge_report()
+            self._report = {
+                **self._template,
+                'exec': self._exec_report,
+                'tasks': list(self._tasks.values())
+            }
+        return self._report
+
+    def report(self):
+        """
+        Return a copy of the merged workflow exec report and template.
+        """
+        return _copy_report(self._cached_report())
+
+    def dump(self):
+        """
+        Return the pickled report (cached).
+        """
+        if self._dump is None:
+            self._dump = pickle.dumps(self._cached_report())
+        return self._dump
+
+    def shared_changes(self):
+        """
+        Return the report changes since the last call as redis hash fields:
+        either the full pickled report or the pickled updated tasks, along
+        with a boolean telling if the fields replace the whole hash.
+        """
+        # Build the report first, if needed
+        self._cached_report()
+        if self._shared is None or (
+                self._shared_updates >= self.SHARED_COMPACTION):
+            self._shared = set()
+            self._shared_updates = 0
+            return {'report': self.dump()}, True
+
+        fields = {
+            'task:{}'.format(task_id): pickle.dumps(self._tasks[task_id])
+            for task_id in self._shared
         }
+        self._shared = set()
+        self._shared_updates += len(fields)
+        return fields, False
+
+
+def _merge_shared_report(fields):
+    """
+    Rebuild a full report from its shared memory hash fields.
+    """
+    report = pickle.loads(fields.pop(b'report'))
+    tasks = OrderedDict((task['id'], task) for task in report['tasks'])
+    for field, value in fields.items():
+        if field.startswith(b'task:'):
+            task = pickle.loads(value)
+            tasks[task['id']] = task
+    report['tasks'] = list(tasks.values())
+    return report
 
 
 class GlobalExec(WebsocketResource):
@@ -170,6 +297,23 @@ class WorkflowNyuki(Nyuki):
             'topics': {
                 'type': 'array',
                 'items': {'type': 'string', 'minLength': 1}
+            },
+            'history': {
+                'type': 'object',
+                'properties': {
+                    'queue_size': {'type': 'integer', 'minimum': 1},
+                    'batch_size': {'type': 'integer', 'minimum': 1},
+                    'flush_interval': {'type': 'number', 'minimum': 0},
+                    'retry_interval': {'type': 'number', 'minimum': 0},
+                    'spill': {
+                        'type': 'object',
+                        'required': ['path'],
+                        'properties': {
+                            'path': {'type': 'string', 'minLength': 1},
+                            'max_bytes': {'type': 'integer', 'minimum': 1}
+                        }
+                    }
+                }
             }
         }
     }
@@ -180,9 +324,11 @@ class WorkflowNyuki(Nyuki):
         ApiTemplateDraft,  # /v1/workflows/templates/{uid}/draft
         ApiTemplateVersion,  # /v1/workflows/templates/{uid}/{version}
         ApiWorkflows,  # /v1/workflows
+        ApiWorkflowsRescue,  # /v1/workflows/rescue
         ApiWorkflow,  # /v1/workflows/{uid}
         ApiWorkflowsHistory,  # /v1/workflows/history
         ApiWorkflowHistory,  # /v1/workflows/history/{uid}
+        ApiWorkflowsHistoryMetrics,  # /v1/workflows/metrics/history
         ApiFactoryRegexes,  # /v1/workflows/regexes
         ApiFactoryRegex,  # /v1/workflows/regexes/{uid}
         ApiFactoryLookups,  # /v1/workflows/lookups
@@ -196,6 +342,11 @@ class WorkflowNyuki(Nyuki):
     ]
 
     DEFAULT_POLICY = None
+    # Workflows sent at once to a rescuer, and rescue requests in parallel
+    RESCUE_BATCH = 100
+    RESCUE_CONCURRENCY = 10
+    # Template changes are notified to the other workflow nyukis there
+    TEMPLATES_TOPIC = 'workflow_templates'
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -203,6 +354,9 @@ class WorkflowNyuki(Nyuki):
         self.migrate_config()
         self.engine = None
         self.storage = None
+        self._http_session = None
+        # Finished workflows are written into the history by batches
+        self._services.add('history', HistoryWriter(self))
 
         self.AVAILABLE_TASKS = {}
         for name, value in TaskRegistry.all().items():
@@ -231,6 +385,9 @@ class WorkflowNyuki(Nyuki):
             asyncio.ensure_future(self.bus.subscribe(
                 topic, self.workflow_event
             ))
+        asyncio.ensure_future(self.bus.subscribe(
+            self.TEMPLATES_TOPIC, self.template_event
+        ))
         # Enable workflow exec follow-up
         get_broker().register(self.report_workflow, topic=EXEC_TOPIC)
         # Handle distributed workflow's failures
@@ -244,6 +401,8 @@ class WorkflowNyuki(Nyuki):
         self.global_exec.end()
         if self.engine:
             await self.engine.stop()
+        if self._http_session is not None:
+            self._http_session.close()
 
     def new_workflow(self, template, instance, **kwargs):
         """
@@ -252,9 +411,7 @@ class WorkflowNyuki(Nyuki):
         wflow = WorkflowInstance(template, instance, **kwargs)
         self.running_workflows[instance.uid] = wflow
         if 'memory' in self._services and self.memory.available:
-            asyncio.ensure_future(
-                self.write_report(wflow.report(), False)
-            )
+            self.write_report(wflow)
         return wflow
 
     async def report_workflow(self, event):
@@ -264,6 +421,7 @@ class WorkflowNyuki(Nyuki):
         source = event.source.as_dict()
         exec_id = source['workflow_exec_id']
         wflow = self.running_workflows[exec_id]
+        wflow.update(source)
         source['workflow_exec_requester'] = wflow.exec.get('requester')
 
         payload = {
@@ -284,10 +442,9 @@ class WorkflowNyuki(Nyuki):
             WorkflowExecState.error.value
         ]:
             asyncio.ensure_future(self.global_exec.broadcast(payload))
-            # Sanitize objects to store the finished workflow instance
-            asyncio.ensure_future(self.storage.instances.insert(
-                sanitize_workflow_exec(wflow.report())
-            ))
+            # Sanitize objects to store the finished workflow instance,
+            # waiting if the history writer's queue is full
+            await self.history.write(sanitize_workflow_exec(wflow.report()))
             wflow.end()
             del self.running_workflows[exec_id]
             memwrite = False
@@ -301,10 +458,9 @@ class WorkflowNyuki(Nyuki):
         # Shared memory set/del
         if 'memory' in self._services and self.memory.available:
             if memwrite:
-                memjob = self.write_report(wflow.report())
+                self.write_report(wflow)
             else:
-                memjob = self.clear_report(exec_id)
-            asyncio.ensure_future(memjob)
+                self.clear_report(exec_id)
 
         await wflow.broadcast(payload)
 
@@ -313,25 +469,48 @@ class WorkflowNyuki(Nyuki):
         New bus event received, trigger workflows if needed.
         """
         templates = {}
-        # Retrieve full workflow templates
+        # Retrieve full workflow templates (cached)
         wf_templates = self.engine.selector.select(efrom)
         for wftmpl in wf_templates:
-            template = await self.storage.templates.get(
-                wftmpl.uid,
-                draft=False,
-                with_metadata=True
+            templates[wftmpl.uid] = await self.storage.templates.get_published(
+                wftmpl.uid
             )
-            templates[wftmpl.uid] = template[0]
         # Trigger workflows
         instances = await self.engine.data_received(data, efrom)
         for instance in instances:
             self.new_workflow(templates[instance.template.uid], instance)
 
+    def template_changed(self, tid):
+        """
+        Tell the other workflow nyukis to drop a template from their cache.
+        """
+        asyncio.ensure_future(self.bus.publish(
+            {'nyuki': self.id, 'tid': tid}, self.TEMPLATES_TOPIC
+        ))
+
+    async def template_event(self, efrom, data):
+        """
+        A template changed in another workflow nyuki (replicas share their
+        bus name, their process id tells them apart).
+        """
+        if data.get('nyuki') == self.id or self.storage is None:
+            return
+        log.debug("Template '%s' changed, dropping it from cache", data['tid'])
+        self.storage.templates.invalidate(data['tid'], notify=False)
+
     async def reload_from_storage(self):
         """
         Check mongo, retrieve and load all templates
         """
         self.storage = MongoStorage(**self.mongo_config)
+        self.storage.templates.on_change = self.template_changed
+        runtime.storage = self.storage
+        # Factory tasks resolve their regexes and lookups from this cache
+        # (lookups being read on first use), bus events their templates
+        await asyncio.gather(
+            self.storage.regexes.load(),
+            self.storage.templates.load()
+        )
 
         templates = await self.storage.templates.get_all(
             full=True,
@@ -346,6 +525,17 @@ class WorkflowNyuki(Nyuki):
                 # Means a bad workflow is in database, report it
                 reporting.exception(exc)
 
+    @property
+    def http_session(self):
+        """
+        HTTP client shared by the rescue requests, keeping connections open
+        """
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.RESCUE_CONCURRENCY)
+            )
+        return self._http_session
+
     @memsafe
     async def failure_handler(self, instances):
         """
@@ -362,82 +552,156 @@ class WorkflowNyuki(Nyuki):
 
         # Select eligible rescuers
         ntw = self.raft.network
-        rescuers = [ipv4 for ipv4, uid in ntw.items() if uid not in instances]
+        rescuers = {
+            ipv4: uid for ipv4, uid in ntw.items() if uid not in instances
+        }
+        if not rescuers:
+            log.error('No instance left to rescue workflows')
+            return
+        loads = await self.rescuer_loads(rescuers)
+        semaphore = asyncio.Semaphore(self.RESCUE_CONCURRENCY)
 
         # Iterate over all failing instances
+        rescues = []
         for ifrom in instances:
 
             # Fetch the list of workflows for a given failing instance.
             index = self.memory.key(ifrom, 'workflows', 'instances')
-            for wflow in await self.memory.store.smembers(index):
-                wflow = wflow.decode('utf-8')
+            uids = [
+                uid.decode('utf-8')
+                for uid in await self.memory.store.smembers(index)
+            ]
+
+            # Get the reports shared by the failing instance
+            reports = await self.read_reports(uids, ifrom)
+            for uid in uids:
+                if uid not in reports:
+                    log.error("Workflow %s memory has been wiped out", uid)
+            reports = list(reports.values())
+
+            for start in range(0, len(reports), self.RESCUE_BATCH):
+                rescues.append(self.rescue_batch(
+                    reports[start:start + self.RESCUE_BATCH],
+                    ifrom, loads, semaphore
+                ))
+
+        await asyncio.gather(*rescues)
+
+    async def rescuer_loads(self, rescuers):
+        """
+        Return the number of running workflows of each rescuer (by IP),
+        from their shared memory index.
+        """
+        pipe = self.memory.store.pipeline()
+        counts = [
+            pipe.scard(self.memory.key(uid, 'workflows', 'instances'))
+            for uid in rescuers.values()
+        ]
+        await pipe.execute()
+        return {
+            ipv4: count.result() for ipv4, count in zip(rescuers, counts)
+        }
 
-                # Get the report shared by the failing instance
+    async def rescue_batch(self, reports, ifrom, loads, semaphore):
+        """
+        Send a batch of reports to the least loaded rescuers, until all of
+        them are rescued.
+        """
+        async with semaphore:
+            for ito in sorted(loads, key=loads.get):
+                request = {
+                    'url': 'http://{}:{}/v1/workflow/rescue'.format(
+                        ito, self.api._port
+                    ),
+                    'headers': {'Content-Type': 'application/json'},
+                    'data': json.dumps(reports, default=serialize_object)
+                }
+                # Account for the batch while it is being sent
+                loads[ito] += len(reports)
                 try:
-                    report = await self.read_report(wflow, ifrom)
-                except KeyError:
-                    log.error("Workflow %s memory has been wiped out", wflow)
-                    break
-
-                shuffle(rescuers)
-                report = json.dumps(report, default=serialize_object)
-
-                # Send a failover request to a valid, not failing, instance.
-                for ito in rescuers:
-                    request = {
-                        'url': 'http://{}:{}/v1/workflow/instances'.format(
-                            ito, self.api._port
-                        ),
-                        'headers': {'Content-Type': 'application/json'},
-                        'data': report
-                    }
-                    async with aiohttp.ClientSession() as session:
-                        async with session.put(**request) as resp:
-                            if resp.status == 200:
-                                # `ito` rescuer has taken over the workflow
-                                break
-                else:
-                    log.error("Workflow %s hasn't be rescued properly", wflow)
+                    async with self.http_session.put(**request) as resp:
+                        if resp.status != 200:
+                            raise aiohttp.ClientError(
+                                'status {}'.format(resp.status)
+                            )
+                        result = await resp.json()
+                except (aiohttp.ClientError, ValueError) as exc:
+                    log.warning('Rescue request to %s failed: %s', ito, exc)
+                    loads[ito] -= len(reports)
                     continue
-                asyncio.ensure_future(self.clear_report(wflow, ifrom=ifrom))
 
-    @memsafe
-    async def clear_report(self, uid, ifrom=None):
+                rescued = set(result['rescued'])
+                failed = set(result['errors'])
+                loads[ito] -= len(reports) - len(rescued)
+                for uid in rescued:
+                    self.clear_report(uid, ifrom=ifrom)
+                # Reports the rescuer could not even read
+                for report in reports:
+                    uid = report['exec']['id']
+                    if uid not in rescued and uid not in failed:
+                        log.error(
+                            "Workflow %s hasn't be rescued properly", uid
+                        )
+                # Only the failed ones are tried with the next rescuer
+                reports = [
+                    report for report in reports
+                    if report['exec']['id'] in failed
+                ]
+                if not reports:
+                    return
+
+        for report in reports:
+            log.error(
+                "Workflow %s hasn't be rescued properly", report['exec']['id']
+            )
+
+    def clear_report(self, uid, ifrom=None):
         """
-        Remove a report from the shared memory.
+        Remove a report from the shared memory (after any pending write).
         """
         _iform = ifrom or self.id
-        await self.memory.store.delete(
-            key=self.memory.key(_iform, 'workflows', 'instances', uid)
-        )
-        await self.memory.store.srem(
-            key=self.memory.key(_iform, 'workflows', 'instances'),
-            member=uid
+        self.memory.write_behind.delete(
+            self.memory.key(_iform, 'workflows', 'instances', uid),
+            index=(self.memory.key(_iform, 'workflows', 'instances'), uid)
         )
 
-    @memsafe
-    async def write_report(self, report, replace=True, ito=None):
+    def write_report(self, wflow, ito=None):
         """
-        Store an instance report into shared memory.
-        A simple 'set' is used againts a 'hset' (hash storage), even though the
-        'hset' seems more appropriate, because a field in a hash can't have TTL
+        Store an instance report into shared memory, as a hash holding the
+        full report and the tasks updated since (merged by `read_report`).
+        Writes are coalesced and sent by the memory's write-behind layer.
         """
         _ito = ito or self.id
-        uid = report['exec']['id']
-        response = await self.memory.store.set(
-            key=self.memory.key(_ito, 'workflows', 'instances', uid),
-            value=pickle.dumps(report),
-            expire=86400,
-            exist=None if replace else False
+        uid = wflow.instance.uid
+        fields, replace = wflow.shared_changes()
+        self.memory.write_behind.hset(
+            self.memory.key(_ito, 'workflows', 'instances', uid),
+            fields,
+            replace=replace,
+            index=(self.memory.key(self.id, 'workflows', 'instances'), uid)
         )
 
-        if not response:
-            log.error("Can't share workflow id %s context in memory", uid)
-            return
+    async def read_reports(self, uids, ifrom=None):
+        """
+        Read and parse many reports from the shared memory at once, return
+        them by workflow id (missing ones being left out).
+        """
+        _iform = ifrom or self.id
+        pipe = self.memory.store.pipeline()
+        results = [
+            pipe.hgetall(
+                self.memory.key(_iform, 'workflows', 'instances', uid)
+            )
+            for uid in uids
+        ]
+        await pipe.execute()
 
-        keyspace = self.memory.key(self.id, 'workflows', 'instances')
-        await self.memory.store.sadd(key=keyspace, member=uid)
-        await self.memory.store.expire(key=keyspace, timeout=86400)
+        reports = {}
+        for uid, result in zip(uids, results):
+            fields = result.result()
+            if fields and b'report' in fields:
+                reports[uid] = _merge_shared_report(fields)
+        return reports
 
     @memsafe
     async def read_report(self, uid, ifrom=None):
@@ -445,9 +709,9 @@ class WorkflowNyuki(Nyuki):
         Read and parse a report from the shared memory.
         """
         _iform = ifrom or self.id
-        report = await self.memory.store.get(
-            key=self.memory.key(_iform, 'workflows', 'instances', uid)
+        fields = await self.memory.store.hgetall(
+            self.memory.key(_iform, 'workflows', 'instances', uid)
         )
-        if not report:
+        if not fields or b'report' not in fields:
             raise KeyError("Can't find workflow id context %s in memory", uid)
-        return pickle.loads(report)
+        return _merge_shared_report(fields)
@@ -0,0 +1,69 @@
+import asyncio
+from asynctest import TestCase, CoroutineMock
+from nose.tools import eq_, assert_raises
+
+from nyuki.bus.batch import PublishQueue
+
+
+class TestPublishQueue(TestCase):
+
+    def setUp(self):
+        self.publish_many = CoroutineMock()
+        self.queue = PublishQueue(
+            self.publish_many, size=3, delay=0.01, loop=self.loop
+        )
+
+    async def _put_all(self, *calls):
+        # Sequential ensure_future calls keep the enqueue order
+        # (asyncio.gather does not before python 3.7)
+        futures = [
+            asyncio.ensure_future(self.queue.put(event, topic))
+            for event, topic in calls
+        ]
+        for future in futures:
+            await future
+
+    async def test_001_flush_on_size(self):
+        await self._put_all(*[({'i': i}, 'topic') for i in range(3)])
+        self.publish_many.assert_called_once_with(
+            [{'i': 0}, {'i': 1}, {'i': 2}], 'topic'
+        )
+
+    async def test_002_flush_on_delay(self):
+        await self.queue.put({'i': 0}, 'topic')
+        self.publish_many.assert_called_once_with([{'i': 0}], 'topic')
+
+    async def test_003_batch_per_topic(self):
+        await self._put_all(
+            ({'i': 0}, 'one'), ({'i': 1}, 'two'), ({'i': 2}, 'one')
+        )
+        eq_(self.publish_many.call_count, 2)
+        self.publish_many.assert_any_call([{'i': 0}, {'i': 2}], 'one')
+        self.publish_many.assert_any_call([{'i': 1}], 'two')
+
+    async def test_004_ordered_batches(self):
+        published = list()
+
+        async def publish_many(events, topic):
+            # First batch is slower than the next ones
+            await asyncio.sleep(0.02 if events[0]['i'] == 0 else 0)
+            published.extend(event['i'] for event in events)
+
+        self.queue._publish_many = publish_many
+        await self._put_all(*[({'i': i}, 'topic') for i in range(7)])
+        eq_(published, list(range(7)))
+
+    async def test_005_error(self):
+        self.publish_many.side_effect = ValueError
+        with assert_raises(ValueError):
+            await self.queue.put({'i': 0}, 'topic')
+
+    async def test_006_close(self):
+        future = asyncio.ensure_future(self.queue.put({'i': 0}, 'topic'))
+        await asyncio.sleep(0)
+        eq_(len(self.queue), 1)
+        self.queue._delay = 10
+        await self.queue.close()
+        eq_(len(self.queue), 0)
+        await future
+        self.publish_many.assert_called_once_with([{'i': 0}], 'topic')
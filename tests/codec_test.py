@@ -0,0 +1,44 @@
+from datetime import datetime
+from unittest import TestCase
+
+from nyuki.bus.codec import Codec, JsonCodec
+
+
+class TestCodecs(TestCase):
+
+    def test_001_get(self):
+        self.assertIsInstance(Codec.get('json'), JsonCodec)
+        with self.assertRaises(ValueError):
+            Codec.get('yaml')
+
+    def test_002_roundtrip(self):
+        data = {'key': 'value', 'list': [1, 2.5, None, True]}
+        for name in Codec.names():
+            try:
+                codec = Codec.get(name)
+            except ValueError:
+                # Optional package not installed
+                continue
+            payload = codec.encode(data)
+            self.assertIsInstance(payload, bytes)
+            self.assertEqual(codec.decode(payload), data)
+
+    def test_003_serialize_objects(self):
+        now = datetime.utcnow()
+        for name in Codec.names():
+            try:
+                codec = Codec.get(name)
+            except ValueError:
+                # Optional package not installed
+                continue
+            decoded = codec.decode(
+                codec.encode({'date': now, 'obj': object()})
+            )
+            self.assertEqual(decoded['date'], now.isoformat())
+            self.assertTrue(decoded['obj'].startswith('Internal server data'))
+
+    def test_004_decode_error(self):
+        with self.assertRaises(ValueError):
+            Codec.get('json').decode(b'{not json')
+        # Events persisted as strings are still readable
+        self.assertEqual(Codec.get('json').decode('{"a": 1}'), {'a': 1})
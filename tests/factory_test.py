@@ -0,0 +1,263 @@
+import csv
+import unittest
+
+from asynctest import TestCase, CoroutineMock, Mock
+from nose.tools import eq_, assert_raises
+
+from nyuki.workflow.api.factory import CSVStreamParser
+from nyuki.workflow.storage import (
+    _DataProcessingCollection, _LookupCollection, _compile_regex
+)
+from nyuki.workflow.tasks.factory import FactoryTask
+from nyuki.workflow.tasks.utils import runtime
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key):
+        self._docs.sort(key=lambda doc: doc[key])
+        return self
+
+    async def to_list(self, length):
+        return list(self._docs)
+
+    @property
+    async def fetch_next(self):
+        return bool(self._docs)
+
+    def next_object(self):
+        return self._docs.pop(0) if self._docs else None
+
+
+def _match(doc, query):
+    for key, value in (query or {}).items():
+        if isinstance(value, dict):
+            if doc.get(key) == value['$ne']:
+                return False
+        elif doc.get(key) != value:
+            return False
+    return True
+
+
+class FakeCollection:
+
+    name = 'fake'
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.create_index = CoroutineMock()
+        self.find = Mock(side_effect=self._find)
+
+    def _find(self, query, projection):
+        return FakeCursor([
+            dict(doc) for doc in self.docs if _match(doc, query)
+        ])
+
+    async def update(self, query, data, upsert=False):
+        await self.remove(query)
+        self.docs.append(dict(data))
+
+    async def remove(self, query):
+        self.docs = [doc for doc in self.docs if not _match(doc, query)]
+
+    async def insert_many(self, docs):
+        self.docs.extend(dict(doc) for doc in docs)
+
+
+class TestFactoryRulesCache(TestCase):
+
+    async def setUp(self):
+        self.regexes = FakeCollection([
+            {'id': 'regex-1', 'title': 'digits', 'pattern': r'(?P<num>\d+)'}
+        ])
+        self.lookups = FakeCollection()
+        self.chunks = FakeCollection()
+        runtime.storage = Mock(
+            regexes=_DataProcessingCollection(self.regexes, _compile_regex),
+            lookups=_LookupCollection(self.lookups, self.chunks),
+        )
+        await runtime.storage.lookups.insert({
+            'id': 'lookup-1', 'title': 'colors', 'table': [
+                {'value': 'red', 'replace': 'rouge'}
+            ]
+        })
+        await runtime.storage.regexes.load()
+        await runtime.storage.lookups.load()
+        self.task = FactoryTask({'rules': [
+            {'type': 'extract', 'fieldname': 'msg', 'regex_id': 'regex-1'},
+            {'type': 'lookup', 'fieldname': 'color', 'lookup_id': 'lookup-1'},
+        ]})
+
+    def tearDown(self):
+        runtime.storage = None
+
+    async def test_001_resolve_from_cache(self):
+        self.regexes.find.reset_mock()
+        config, depends = await self.task.get_factory_rules(self.task.config)
+        eq_(config['rules'][0]['pattern'], r'(?P<num>\d+)')
+        eq_(config['rules'][1]['table'].table, {'red': 'rouge'})
+        eq_(set(depends), {'regex-1', 'lookup-1'})
+        # No database query, task config left untouched
+        eq_(self.regexes.find.call_count, 0)
+        eq_(self.task.config['rules'][0]['regex_id'], 'regex-1')
+
+    async def test_002_invalidate_on_write(self):
+        _, before = await self.task.get_factory_rules(self.task.config)
+        regex = {'id': 'regex-1', 'title': 'digits', 'pattern': r'(?P<n>\d)'}
+        await runtime.storage.regexes.insert(regex)
+        config, after = await self.task.get_factory_rules(self.task.config)
+        eq_(config['rules'][0]['pattern'], r'(?P<n>\d)')
+        eq_(before['lookup-1'], after['lookup-1'])
+        assert before['regex-1'] != after['regex-1']
+
+        await runtime.storage.lookups.delete('lookup-1')
+        eq_(self.chunks.docs, [])
+        with assert_raises(RuntimeError):
+            await self.task.get_factory_rules(self.task.config)
+
+    async def test_003_chunked_lookup(self):
+        lookups = runtime.storage.lookups
+        lookups.CHUNK_SIZE = 2
+        table = [
+            {'value': 'V{}'.format(i), 'replace': i} for i in range(5)
+        ]
+        await lookups.insert({'id': 'big', 'title': 'big', 'table': table})
+        eq_(len([c for c in self.chunks.docs if c['lookup_id'] == 'big']), 3)
+        eq_(await lookups.get('big'), {
+            'id': 'big', 'title': 'big', 'table': table
+        })
+
+        # A new version replaces the previous chunks
+        await lookups.insert({'id': 'big', 'title': 'big', 'table': table[:1]})
+        eq_(len([c for c in self.chunks.docs if c['lookup_id'] == 'big']), 1)
+
+        # Case-insensitive index built once, shared by the rules
+        digest, prepared = await lookups.resolve('big')
+        eq_(prepared.icase, {'v0': 0})
+        assert prepared.icase is prepared.icase
+
+        # Expired entry kept as long as the stored digest is the same
+        lookups._cache['big'] = (0, digest, prepared)
+        self.chunks.find.reset_mock()
+        eq_(await lookups.resolve('big'), (digest, prepared))
+        eq_(self.chunks.find.call_count, 0)
+
+    async def test_004_stream_writer(self):
+        lookups = runtime.storage.lookups
+        lookups.CHUNK_SIZE = 2
+        writer = lookups.writer({'id': 'streamed', 'title': 'streamed'})
+        await writer.write([{'value': 'a', 'replace': 1}])
+        await writer.write([
+            {'value': 'b', 'replace': 2}, {'value': 'c', 'replace': 3}
+        ])
+        # Not referenced until closed
+        eq_(await lookups.get('streamed'), None)
+        await writer.close()
+        eq_(writer.size, 3)
+
+        lookup = await lookups.get('streamed', table=False)
+        chunks = []
+        async for rows in lookups.iterate_rows(lookup):
+            chunks.append([row['value'] for row in rows])
+        eq_(chunks, [['a', 'b'], ['c']])
+
+        # Same digest as a table inserted at once
+        await lookups.insert({
+            'id': 'inserted', 'title': 'inserted',
+            'table': [row for row in (await lookups.get('streamed'))['table']]
+        })
+        eq_(
+            (await lookups.resolve('streamed'))[0],
+            (await lookups.resolve('inserted'))[0]
+        )
+
+        # Aborted write leaves nothing behind
+        writer = lookups.writer({'id': 'aborted', 'title': 'aborted'})
+        await writer.write([{'value': 'a', 'replace': 1}] * 3)
+        await writer.abort()
+        eq_([c for c in self.chunks.docs if c['lookup_id'] == 'aborted'], [])
+
+
+    async def test_005_lazy_lookups(self):
+        lookups = runtime.storage.lookups
+        self.chunks.find.reset_mock()
+        eq_(lookups._cache, {})
+        await lookups.resolve('lookup-1')
+        eq_(list(lookups._cache), ['lookup-1'])
+        eq_(self.chunks.find.call_count, 1)
+
+        # Dropped once unused for long enough
+        lookups._cache['lookup-1'] = (-lookups.CACHE_TTL - 1,) + (
+            lookups._cache['lookup-1'][1:]
+        )
+        lookups._next_eviction = 0
+        lookups._evict_unused()
+        eq_(lookups._cache, {})
+
+    async def test_006_invalid_regex(self):
+        self.regexes.docs.append(
+            {'id': 'regex-2', 'title': 'broken', 'pattern': r'(?P<num'}
+        )
+        await runtime.storage.regexes.load()
+        eq_(list(runtime.storage.regexes._cache), ['regex-1'])
+
+
+class TestCSVStreamParser(unittest.TestCase):
+
+    def parse(self, data, size):
+        parser = CSVStreamParser()
+        rows = []
+        for i in range(0, len(data), size):
+            rows.extend(parser.feed(data[i:i + size]))
+        rows.extend(parser.close())
+        return rows
+
+    def test_001_chunks(self):
+        lines = ['value;replace'] + [
+            'v{0};"{0}\nnext"'.format(i) if i == 500 else
+            'v{0};{0}'.format(i) for i in range(1000)
+        ]
+        data = '\n'.join(lines).encode()
+        rows = self.parse(data, 7)
+        eq_(rows, self.parse(data, len(data)))
+        eq_(len(rows), 1000)
+        eq_(rows[0], {'value': 'v0', 'replace': '0'})
+        eq_(rows[500]['replace'], '500\nnext')
+
+    def test_002_encoding(self):
+        data = '\n'.join(
+            'é{0},è{0}'.format(i) for i in range(200)
+        )
+        eq_(self.parse(data.encode(), 5)[0], {'value': 'é0', 'replace': 'è0'})
+        eq_(self.parse(data.encode('latin-1'), 5)[199], {
+            'value': 'é199', 'replace': 'è199'
+        })
+        with assert_raises(csv.Error):
+            self.parse(b'', 5)
+
+        # Encoding chosen on the first non-ASCII byte, however far
+        data = '\n'.join('v{0},r{0}'.format(i) for i in range(20000))
+        eq_(self.parse((data + '\né,è').encode('latin-1'), 4096)[-1], {
+            'value': 'é', 'replace': 'è'
+        })
+        eq_(self.parse((data + '\né,è').encode(), 4095)[-1], {
+            'value': 'é', 'replace': 'è'
+        })
+
+        # Invalid utf-8 after the first non-ASCII character
+        data = ('é,è\n' + data).encode() + '\nà,ù'.encode('latin-1')
+        with assert_raises(UnicodeDecodeError):
+            self.parse(data, 4096)
+
+    def test_003_quotechar(self):
+        lines = ["value|replace"] + [
+            "v{0}|'{0}\n\"next'".format(i) if i == 50 else
+            'v{0}|{0}'.format(i) for i in range(100)
+        ]
+        data = '\n'.join(lines).encode()
+        rows = self.parse(data, 7)
+        eq_(len(rows), 100)
+        eq_(rows[50]['replace'], '50\n"next')
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from asynctest import TestCase, CoroutineMock, Mock
+from nose.tools import eq_
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from nyuki.workflow.api.workflows import InstanceCollection
+from nyuki.workflow.history import HistoryWriter
+
+
+def report(uid):
+    return {'id': 'tmpl', 'exec': {'id': uid}}
+
+
+class TestHistoryWriter(TestCase):
+
+    def setUp(self):
+        self.nyuki = Mock()
+        self.insert_many = CoroutineMock()
+        self.nyuki.storage.instances.insert_many = self.insert_many
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.spill')
+        self.writer = self.new_writer()
+
+    def new_writer(self):
+        writer = HistoryWriter(self.nyuki)
+        writer.configure(
+            queue_size=10, batch_size=3, flush_interval=0, retry_interval=0,
+            spill={'path': self.path}
+        )
+        return writer
+
+    async def tearDown(self):
+        await self.writer.stop()
+        self.directory.cleanup()
+
+    async def test_001_batches(self):
+        for i in range(4):
+            await self.writer.write(report(str(i)))
+        await self.writer._write_batch()
+        await self.writer._write_batch()
+        eq_([len(c[0][0]) for c in self.insert_many.call_args_list], [3, 1])
+        status = self.writer.status()
+        eq_(status['written'], 4)
+        eq_(status['flushes'], 2)
+        eq_(status['queue'], {'size': 10, 'count': 0})
+
+    async def test_002_spill_and_retry(self):
+        self.insert_many.side_effect = AutoReconnect()
+        await self.writer.write(report('a'))
+        await self.writer._write_batch()
+        eq_(self.writer.status()['spill']['count'], 1)
+
+        # Spilled while the history is failing
+        await self.writer.write(report('b'))
+        await self.writer._write_batch()
+        eq_(self.insert_many.call_count, 1)
+
+        self.insert_many.side_effect = None
+        await self.writer._retry
+        eq_(self.writer.status()['spill']['count'], 0)
+        batch = self.insert_many.call_args[0][0]
+        eq_([r['exec']['id'] for r in batch], ['a', 'b'])
+        eq_(self.insert_many.call_args[1], {'retry': True})
+
+    async def test_003_stop_writes_held_batch(self):
+        self.writer.flush_interval = 0.1
+        await self.writer.start()
+        await self.writer.write(report('a'))
+        # Let the worker take the report and wait for a batch to fill up
+        await asyncio.sleep(0)
+        await self.writer.stop()
+        eq_(self.insert_many.call_count, 1)
+        eq_(self.insert_many.call_args[0][0], [report('a')])
+
+    async def test_004_spill_kept_on_restart(self):
+        self.insert_many.side_effect = AutoReconnect()
+        await self.writer.start()
+        await self.writer.write(report('a'))
+        await self.writer.stop()
+        assert os.path.exists(self.path)
+
+        self.insert_many.reset_mock()
+        self.insert_many.side_effect = None
+        self.writer = self.new_writer()
+        eq_(self.writer.status()['spill']['count'], 1)
+        await self.writer.start()
+        await self.writer._retry
+        eq_(self.insert_many.call_args[0][0], [report('a')])
+        eq_(self.writer.status()['spill']['count'], 0)
+
+    async def test_005_worker_survives_errors(self):
+        self.insert_many.side_effect = AutoReconnect()
+        self.writer._spill.append = Mock(side_effect=OSError('disk full'))
+        await self.writer.start()
+        await self.writer.write(report('a'))
+        await asyncio.sleep(0.01)
+        assert not self.writer._worker.done()
+        eq_(self.writer.status()['dropped'], 1)
+
+        del self.writer._spill.append
+        self.insert_many.side_effect = None
+        await self.writer.write(report('b'))
+        await self.writer.stop()
+        eq_(self.insert_many.call_args[0][0], [report('b')])
+
+    async def test_006_private_spill_written_on_stop(self):
+        self.nyuki.config = {'service': 'workflow-a'}
+        for written in (True, False):
+            writer = HistoryWriter(self.nyuki)
+            writer.configure(flush_interval=0, retry_interval=10)
+            self.insert_many.reset_mock()
+            self.insert_many.side_effect = AutoReconnect()
+            await writer.start()
+            await writer.write(report('a'))
+            await asyncio.sleep(0.01)
+            eq_(writer.status()['spill']['count'], 1)
+
+            # One last attempt, only what still fails is dropped
+            if written:
+                self.insert_many.side_effect = None
+            await writer.stop()
+            eq_(self.insert_many.call_args[0][0], [report('a')])
+            eq_(self.insert_many.call_args[1], {'retry': True})
+            eq_(writer.status()['dropped'], 0 if written else 1)
+            assert not os.path.exists(writer._spill.path)
+
+
+class TestHistoryDefaultSpill(unittest.TestCase):
+
+    def test_001_private_spill(self):
+        nyuki = Mock(config={'service': 'workflow-a'})
+        writer = HistoryWriter(nyuki)
+        writer.configure()
+        path = writer._spill.path
+        eq_(
+            os.path.basename(path),
+            'nyuki-history-workflow-a-{}.spill'.format(os.getpid())
+        )
+        assert not writer._spill.persistent
+        writer._spill.close()
+        assert not os.path.exists(path)
+
+
+class TestInstanceCollection(TestCase):
+
+    def setUp(self):
+        self.collection = Mock(
+            create_index=CoroutineMock(), insert_many=CoroutineMock()
+        )
+        self.instances = InstanceCollection(self.collection)
+
+    async def test_001_duplicates(self):
+        self.collection.insert_many.side_effect = [
+            BulkWriteError({'writeErrors': [{'index': 1, 'code': 11000}]}),
+            None,
+        ]
+        reports = [report('a'), report('b')]
+        await self.instances.insert_many(reports)
+        duplicates = self.collection.insert_many.call_args[0][0]
+        eq_(len(duplicates), 1)
+        eq_(duplicates[0]['exec']['duplicate'], 'b')
+        # Reports given by the caller are left untouched
+        eq_(reports[1], report('b'))
+
+        # Already stored on retry
+        self.collection.insert_many.reset_mock()
+        self.collection.insert_many.side_effect = BulkWriteError({
+            'writeErrors': [{'index': 0, 'code': 11000}]
+        })
+        await self.instances.insert_many([report('c')], retry=True)
+        eq_(self.collection.insert_many.call_count, 1)
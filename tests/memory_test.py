@@ -0,0 +1,90 @@
+import asyncio
+from asynctest import TestCase, CoroutineMock, Mock
+from nose.tools import eq_
+
+from nyuki.memory import WriteBehind
+
+
+class TestWriteBehind(TestCase):
+
+    def setUp(self):
+        self.transaction = Mock(execute=CoroutineMock(return_value=[]))
+        self.memory = Mock(loop=self.loop, available=True)
+        self.memory.store.multi_exec.return_value = self.transaction
+        self.writer = WriteBehind(self.memory, window=0.01)
+
+    async def test_001_coalesce(self):
+        index = ('instances', 'wf')
+        self.writer.hset('wf', {'report': b'0'}, replace=True, index=index)
+        self.writer.hset('wf', {'task:a': b'1'}, index=index)
+        self.writer.hset('wf', {'task:a': b'2', 'task:b': b'3'}, index=index)
+        await self.writer.flush()
+
+        eq_(self.memory.store.multi_exec.call_count, 1)
+        self.transaction.delete.assert_called_once_with('wf')
+        self.transaction.hmset_dict.assert_called_once_with('wf', {
+            'report': b'0', 'task:a': b'2', 'task:b': b'3'
+        })
+        self.transaction.sadd.assert_called_once_with('instances', 'wf')
+        eq_(self.transaction.execute.call_count, 1)
+
+    async def test_002_delete(self):
+        self.writer.hset('wf', {'task:a': b'1'})
+        self.writer.delete('wf', index=('instances', 'wf'))
+        await self.writer.flush()
+        eq_(self.transaction.hmset_dict.call_count, 0)
+        self.transaction.srem.assert_called_once_with('instances', 'wf')
+
+        # Flushed after the window
+        self.writer.hset('wf', {'task:a': b'1'})
+        await asyncio.sleep(0.05)
+        eq_(self.transaction.execute.call_count, 2)
+
+    async def test_003_failed_flush(self):
+        self.transaction.execute.side_effect = ConnectionRefusedError()
+        self.writer.hset('wf', {'report': b'0'}, replace=True)
+        self.writer.hset('gone', {'task:a': b'1'})
+        await self.writer.flush()
+
+        # Written meanwhile
+        self.writer.hset('wf', {'task:a': b'1'})
+        self.writer.delete('gone')
+        self.transaction.reset_mock()
+        self.transaction.execute.side_effect = None
+        self.transaction.execute.return_value = []
+        await self.writer.flush()
+        self.transaction.delete.assert_any_call('wf')
+        self.transaction.delete.assert_any_call('gone')
+        self.transaction.hmset_dict.assert_called_once_with('wf', {
+            'report': b'0', 'task:a': b'1'
+        })
+
+    async def test_004_failed_command(self):
+        # WRONGTYPE on the second key (hmset and expire of each key)
+        self.transaction.execute.return_value = [
+            True, True, Exception('WRONGTYPE'), True
+        ]
+        self.writer.hset('ok', {'task:a': b'1'})
+        self.writer.hset('bad', {'task:a': b'1'})
+        await self.writer.flush()
+        eq_(list(self.writer._pending), ['bad'])
+
+        # Retried once, then dropped
+        self.transaction.execute.return_value = [Exception('WRONGTYPE'), True]
+        await self.writer.flush()
+        eq_(self.writer._pending, {})
+
+    async def test_005_unexpected_error(self):
+        self.transaction.hmset_dict.side_effect = TypeError()
+        self.writer.hset('wf', {'report': b'0'})
+        await self.writer.flush()
+        eq_(list(self.writer._pending), ['wf'])
+
+        # Flushed again once available
+        self.memory.available = False
+        await self.writer.flush()
+        assert self.writer._handle is not None
+        self.transaction.hmset_dict.side_effect = None
+        self.memory.available = True
+        await asyncio.sleep(0.05)
+        eq_(self.writer._pending, {})
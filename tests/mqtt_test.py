@@ -0,0 +1,40 @@
+import asyncio
+from asynctest import TestCase, Mock, CoroutineMock, exhaust_callbacks
+from nose.tools import eq_
+
+from nyuki.bus.mqtt import MqttBus
+from nyuki.bus.persistence import EventStatus
+
+
+class TestMqttBus(TestCase):
+
+    def setUp(self):
+        self.bus = MqttBus(Mock(), loop=self.loop)
+        self.bus.configure('test', batch={'size': 10, 'delay': 10})
+        self.client = self.bus.client
+        self.client._connected_state.set()
+        self.client.client_tasks = []
+        self.client.publish = CoroutineMock()
+
+        def disconnect():
+            self.client._connected_state.clear()
+        self.client.disconnect = CoroutineMock(side_effect=disconnect)
+
+    async def test_001_stop_publishes_queue(self):
+        futures = [
+            asyncio.ensure_future(self.bus.publish({'i': i}))
+            for i in range(3)
+        ]
+        await exhaust_callbacks(self.loop)
+        eq_(self.client.publish.call_count, 0)
+
+        await self.bus.stop()
+        await asyncio.wait(futures)
+        eq_(self.client.publish.call_count, 3)
+        self.client.disconnect.assert_called_once_with()
+        events = await self.bus.persistence.retrieve()
+        eq_(len(events), 3)
+        eq_(
+            {event['status'] for event in events},
+            {EventStatus.SENT.value}
+        )
@@ -0,0 +1,377 @@
+import asyncio
+from datetime import datetime
+import os
+from operator import itemgetter
+import tempfile
+
+from asynctest import TestCase, Mock, CoroutineMock, patch, ignore_loop
+from nose.tools import eq_, assert_in, assert_not_in, assert_raises
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from nyuki.bus.persistence import BusPersistence, EventStatus
+from nyuki.bus.persistence.backend import PersistenceBackend
+from nyuki.bus.persistence.mongo_backend import (
+    MongoBackend, MongoNotConnectedError
+)
+from nyuki.bus.persistence.persistence import FIFOSizedQueue, _event_size
+from nyuki.bus.persistence.spill import SpillFile
+
+
+class TestFIFOSizedQueue(TestCase):
+
+    def setUp(self):
+        self.queue = FIFOSizedQueue(3, key=itemgetter('id'))
+
+    @ignore_loop
+    def test_001_put_pop(self):
+        for i in range(3):
+            self.queue.put({'id': i})
+        eq_(len(self.queue), 3)
+        assert self.queue.is_full
+        assert not self.queue.free_slot.is_set()
+        eq_(self.queue.pop(), {'id': 0})
+        assert self.queue.free_slot.is_set()
+        assert_not_in(0, self.queue)
+        eq_([item['id'] for item in self.queue.empty()], [1, 2])
+        eq_(len(self.queue), 0)
+
+    @ignore_loop
+    def test_002_eviction(self):
+        for i in range(5):
+            self.queue.put({'id': i})
+        eq_([item['id'] for item in self.queue.list], [2, 3, 4])
+        assert_not_in(1, self.queue)
+        eq_(self.queue.get(1), None)
+        eq_(self.queue.get(3), {'id': 3})
+
+    @ignore_loop
+    def test_003_duplicate_key(self):
+        old = {'id': 'a', 'v': 1}
+        new = {'id': 'a', 'v': 2}
+        self.queue.put(old)
+        self.queue.put(new)
+        self.queue.pop()
+        assert_in('a', self.queue)
+        eq_(self.queue.get('a'), new)
+
+
+class TestBusPersistence(TestCase):
+
+    async def test_001_update_many(self):
+        persistence = BusPersistence(memory_size=10)
+        await persistence.store_many([
+            {'id': str(i), 'status': EventStatus.PENDING.value}
+            for i in range(3)
+        ])
+        await persistence.update_many([
+            ('0', EventStatus.SENT), ('2', EventStatus.FAILED)
+        ])
+        eq_(
+            [event['status'] for event in persistence.memory_buffer.list],
+            ['SENT', 'PENDING', 'FAILED']
+        )
+
+    async def test_002_feed_chunks(self):
+        persistence = BusPersistence(memory_size=10)
+        persistence.FEED_CHUNK = 2
+        persistence.backend = Mock()
+        persistence.backend.ping = CoroutineMock(return_value=True)
+        persistence.backend.store_many = CoroutineMock(
+            side_effect=[None, Exception]
+        )
+        await persistence.store_many([
+            {'id': str(i), 'status': EventStatus.PENDING.value}
+            for i in range(5)
+        ])
+        with patch('nyuki.bus.persistence.persistence.reporting'):
+            await persistence._empty_last_events()
+        # Second chunk failed and is back in memory, in order
+        eq_(persistence.backend.store_many.call_count, 2)
+        eq_(
+            [event['id'] for event in persistence.memory_buffer.list],
+            ['2', '3', '4']
+        )
+        assert_in('2', persistence.memory_buffer)
+
+    async def test_003_update_while_flushing(self):
+        persistence = BusPersistence(memory_size=10)
+        persistence.backend = Mock()
+        persistence.backend.ping = CoroutineMock(return_value=True)
+        persistence.backend.update_many = CoroutineMock()
+
+        async def store_many(events):
+            await persistence.update('0', EventStatus.SENT)
+
+        persistence.backend.store_many = store_many
+        await persistence.store(
+            {'id': '0', 'status': EventStatus.PENDING.value}
+        )
+        await persistence._empty_last_events()
+        persistence.backend.update_many.assert_called_once_with(
+            [('0', EventStatus.SENT)]
+        )
+
+
+class FakeBackend(PersistenceBackend):
+
+    def __init__(self, events):
+        self.events = events
+        self.batches = list()
+
+    async def retrieve(self, since, status):
+        return self.events.copy()
+
+    async def retrieve_batch(self, since=None, status=None, after=None,
+                             limit=1000):
+        batch = await super().retrieve_batch(since, status, after, limit)
+        self.batches.append(len(batch))
+        return batch
+
+
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.persistence = BusPersistence(
+            memory_size=10, replay={'batch_size': 2}
+        )
+        self.persistence.backend = FakeBackend([
+            {'id': str(i), 'status': EventStatus.FAILED.value}
+            for i in range(5)
+        ])
+
+    async def test_001_iterate(self):
+        # Event '4' is both in memory and in the backend
+        await self.persistence.store_many([
+            {'id': '4', 'status': EventStatus.FAILED.value},
+            {'id': '5', 'status': EventStatus.SENT.value},
+            {'id': '6', 'status': EventStatus.FAILED.value},
+        ])
+        ids = list()
+        async for event in self.persistence.iterate(
+                status=EventStatus.FAILED):
+            ids.append(event['id'])
+        eq_(ids, ['0', '1', '2', '3', '4', '6'])
+        eq_(self.persistence.backend.batches, [2, 2, 1])
+
+    async def test_002_replay_concurrency(self):
+        self.persistence._replay['concurrency'] = 2
+        running = list()
+        replayed = list()
+
+        async def publish(event):
+            running.append(event['id'])
+            eq_(len(running) <= 2, True)
+            await asyncio.sleep(0.01)
+            running.remove(event['id'])
+            replayed.append(event['id'])
+
+        await self.persistence.replay(publish)
+        eq_(sorted(replayed), ['0', '1', '2', '3', '4'])
+
+    async def test_003_replay_rate(self):
+        self.persistence._replay['rate'] = 100
+        publish = CoroutineMock()
+        start = self.loop.time()
+        await self.persistence.replay(publish)
+        eq_(publish.call_count, 5)
+        assert self.loop.time() - start >= 0.04
+
+
+class TestMongoBackend(TestCase):
+
+    def setUp(self):
+        self.backend = MongoBackend('test')
+        self.backend.client = Mock()
+        self.backend.client.admin.command = CoroutineMock()
+        self.backend._collection = Mock()
+        self.backend._indexed = True
+
+    async def test_001_cached_health(self):
+        eq_(await self.backend.ping(), False)
+        with assert_raises(MongoNotConnectedError):
+            await self.backend.store({'id': '0'})
+        eq_(await self.backend._ping(), True)
+        eq_(await self.backend.ping(), True)
+        self.backend._collection.insert = CoroutineMock()
+        await self.backend.store({'id': '0'})
+        # Ping is not sent for each operation
+        eq_(self.backend.client.admin.command.call_count, 1)
+
+    async def test_002_driver_error(self):
+        await self.backend._ping()
+        self.backend._collection.insert_many = CoroutineMock(
+            side_effect=AutoReconnect
+        )
+        with assert_raises(MongoNotConnectedError):
+            await self.backend.store_many([{'id': '0'}])
+        eq_(await self.backend.ping(), False)
+
+    async def test_003_duplicates(self):
+        await self.backend._ping()
+        self.backend._collection.insert_many = CoroutineMock(
+            side_effect=BulkWriteError({'writeErrors': [{'code': 11000}]})
+        )
+        await self.backend.store_many([{'id': '0'}])
+        self.backend._collection.insert_many = CoroutineMock(
+            side_effect=BulkWriteError({'writeErrors': [{'code': 121}]})
+        )
+        with assert_raises(BulkWriteError):
+            await self.backend.store_many([{'id': '0'}])
+
+
+class TestSqliteBackend(TestCase):
+
+    async def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.persistence = BusPersistence(
+            name='test', backend='sqlite',
+            path=os.path.join(self.directory.name, 'test.sqlite3')
+        )
+        self.backend = self.persistence.backend
+        await self.persistence.init()
+
+    async def tearDown(self):
+        await self.persistence.close()
+        self.directory.cleanup()
+
+    async def test_001_discovery(self):
+        assert_in('sqlite', PersistenceBackend.names())
+        assert_in('mongo', PersistenceBackend.names())
+        eq_(self.backend.__class__.__name__, 'SqliteBackend')
+        with assert_raises(ValueError):
+            BusPersistence(name='test', backend='unknown')
+
+    async def test_002_store_update_retrieve(self):
+        now = datetime.utcnow()
+        events = [
+            {
+                'id': str(i),
+                'status': EventStatus.PENDING.value,
+                'topic': 'test',
+                'message': '{"i": %d}' % i,
+                'created_at': now,
+            }
+            for i in range(5)
+        ]
+        await self.backend.store_many(events)
+        # Retried events are not duplicated
+        await self.backend.store_many(events[:2])
+        await self.backend.update_many([
+            ('1', EventStatus.SENT), ('3', EventStatus.SENT)
+        ])
+        stored = await self.backend.retrieve()
+        eq_([event['id'] for event in stored], ['0', '1', '2', '3', '4'])
+        eq_(stored[0]['created_at'], now)
+
+        failed = await self.backend.retrieve(status=EventStatus.not_sent())
+        eq_([event['id'] for event in failed], ['0', '2', '4'])
+
+        batch = await self.backend.retrieve_batch(limit=2)
+        eq_([event['id'] for event in batch], ['0', '1'])
+        batch = await self.backend.retrieve_batch(after=batch[-1], limit=2)
+        eq_([event['id'] for event in batch], ['2', '3'])
+
+
+class TestSpill(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'spill')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def event(self, uid, size=100):
+        return {
+            'id': uid,
+            'status': EventStatus.PENDING.value,
+            'topic': 'test',
+            'message': 'x' * size,
+            'created_at': datetime.utcnow(),
+        }
+
+    @ignore_loop
+    def test_001_spill_file(self):
+        spill = SpillFile(self.path, max_bytes=1000)
+        for i in range(20):
+            spill.append(self.event(str(i)))
+        # Ring-like, oldest events are dropped
+        ids = [event['id'] for event in spill.iterate(chunk=3)]
+        eq_(ids, [str(i) for i in range(20 - len(spill), 20)])
+        eq_(spill.dropped, 20 - len(spill))
+        assert spill.bytes <= 1000
+
+        events, position = spill.peek(2)
+        spill.append(self.event('20'))
+        spill.discard(position)
+        eq_(
+            [event['id'] for event in spill.iterate()],
+            [str(i) for i in range(21 - len(spill), 21)]
+        )
+        spill.close()
+        assert not os.path.exists(self.path)
+
+    async def test_002_byte_budget(self):
+        persistence = BusPersistence(
+            memory_bytes=500, spill={'path': self.path}
+        )
+        for i in range(10):
+            await persistence.store(self.event(str(i)))
+        memory = persistence.memory_buffer
+        assert memory.weight <= 500
+        assert memory.is_full
+        assert not memory.free_slot.is_set()
+
+        # Updates reach spilled events
+        await persistence.update('0', EventStatus.SENT)
+        events = await persistence.retrieve()
+        eq_([event['id'] for event in events], [str(i) for i in range(10)])
+        eq_(events[0]['status'], EventStatus.SENT.value)
+
+        status = await persistence.status()
+        eq_(status['spill']['count'] + status['memory']['count'], 10)
+        eq_(status['dropped'], 0)
+        await persistence.close()
+
+    async def test_003_drain_spill(self):
+        persistence = BusPersistence(
+            memory_bytes=500, spill={'path': self.path}
+        )
+        persistence.backend = FakeBackend([])
+        persistence.backend.store_many = CoroutineMock()
+        for i in range(10):
+            await persistence.store(self.event(str(i)))
+        await persistence._empty_last_events()
+        stored = [
+            event['id']
+            for call in persistence.backend.store_many.call_args_list
+            for event in call[0][0]
+        ]
+        eq_(stored, [str(i) for i in range(10)])
+        eq_(len(persistence._spill), 0)
+        eq_(len(persistence.memory_buffer), 0)
+
+    @ignore_loop
+    def test_004_persistent_spill_file(self):
+        spill = SpillFile(self.path, persistent=True)
+        for i in range(4):
+            spill.append(self.event(str(i)))
+        events, position = spill.peek(1)
+        spill.discard(position)
+        spill.close()
+
+        # Partially written record
+        with open(self.path, 'ab') as file:
+            file.write(b'\x00\x00\x01\x00abc')
+        spill = SpillFile(self.path, persistent=True)
+        eq_([event['id'] for event in spill.iterate()], ['1', '2', '3'])
+        spill.append(self.event('4'))
+        eq_([event['id'] for event in spill.iterate()], ['1', '2', '3', '4'])
+        spill.close()
+
+    @ignore_loop
+    def test_005_event_size_in_bytes(self):
+        event = {'id': '1', 'topic': 'topic', 'message': 'é' * 10}
+        eq_(_event_size(event), 1 + 5 + 20)
+        event['message'] = b'\x00' * 10
+        eq_(_event_size(event), 1 + 5 + 10)
@@ -0,0 +1,72 @@
+import asyncio
+from asynctest import TestCase, CoroutineMock, Mock
+from nose.tools import eq_
+
+from nyuki.workflow.api.templates import TemplateCollection
+from nyuki.workflow.workflow import WorkflowNyuki
+
+
+class TestTemplateCache(TestCase):
+
+    def setUp(self):
+        self.templates = TemplateCollection(
+            Mock(create_index=CoroutineMock()),
+            Mock(create_index=CoroutineMock(), update=CoroutineMock())
+        )
+        self.templates.on_change = Mock()
+        self.templates.get = CoroutineMock(return_value=[
+            {'id': 'tmpl', 'version': 2, 'title': 'template'}
+        ])
+
+    async def test_001_get_published(self):
+        template = await self.templates.get_published('tmpl')
+        eq_(template['version'], 2)
+        eq_(await self.templates.get_published('tmpl'), template)
+        eq_(self.templates.get.call_count, 1)
+
+        # Copies are handed out
+        template['title'] = 'changed'
+        eq_((await self.templates.get_published('tmpl'))['title'], 'template')
+
+        # Expired entry
+        self.templates._cache[('tmpl', 2)] = (0, template)
+        await self.templates.get_published('tmpl')
+        eq_(self.templates.get.call_count, 2)
+
+        self.templates.get.return_value = []
+        self.templates.invalidate('tmpl', notify=False)
+        eq_(await self.templates.get_published('tmpl'), None)
+        eq_(self.templates.on_change.call_count, 0)
+
+    async def test_002_invalidate_on_write(self):
+        await self.templates.get_published('tmpl')
+        await self.templates.insert_metadata({'id': 'tmpl', 'title': 'new'})
+        eq_(self.templates._cache, {})
+        self.templates.on_change.assert_called_once_with('tmpl')
+        await self.templates.get_published('tmpl')
+        eq_(self.templates.get.call_count, 2)
+
+
+class TestTemplateNotifications(TestCase):
+
+    def nyuki(self, uid):
+        nyuki = Mock(id=uid, TEMPLATES_TOPIC='workflow_templates')
+        # Replicas share their bus name
+        nyuki.bus.name = 'workflow'
+        nyuki.bus.publish = CoroutineMock()
+        return nyuki
+
+    async def test_001_replica_invalidation(self):
+        first, second = self.nyuki('first'), self.nyuki('second')
+        WorkflowNyuki.template_changed(first, 'tmpl')
+        await asyncio.sleep(0)
+        data, topic = first.bus.publish.call_args[0]
+        eq_(topic, 'workflow_templates')
+
+        # Own echo ignored, peers drop the template
+        await WorkflowNyuki.template_event(first, 'workflow', data)
+        eq_(first.storage.templates.invalidate.call_count, 0)
+        await WorkflowNyuki.template_event(second, 'workflow', data)
+        second.storage.templates.invalidate.assert_called_once_with(
+            'tmpl', notify=False
+        )
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from nyuki.bus.topics import TopicTrie
+
+
+def cb1():
+    pass
+
+
+def cb2():
+    pass
+
+
+class TestTopicTrie(TestCase):
+
+    def setUp(self):
+        self.trie = TopicTrie()
+
+    def matched(self, topic):
+        return [cbs for cbs in self.trie.match(topic)]
+
+    def test_001_exact(self):
+        self.trie.add('a/b', cb1)
+        self.assertEqual(self.matched('a/b'), [{cb1}])
+        self.assertEqual(self.matched('a'), [])
+        self.assertEqual(self.matched('a/b/c'), [])
+
+    def test_002_single_level(self):
+        self.trie.add('+/async/+', cb1)
+        self.assertEqual(self.matched('wf/async/1234'), [{cb1}])
+        self.assertEqual(self.matched('wf/async'), [])
+        self.assertEqual(self.matched('wf/async/1234/more'), [])
+
+    def test_003_multi_level(self):
+        self.trie.add('a/#', cb1)
+        self.assertEqual(self.matched('a'), [{cb1}])
+        self.assertEqual(self.matched('a/b'), [{cb1}])
+        self.assertEqual(self.matched('a/b/c'), [{cb1}])
+        self.assertEqual(self.matched('b/a'), [])
+
+        self.trie.add('#', cb2)
+        self.assertEqual(len(self.matched('a/b')), 2)
+        self.assertEqual(self.matched('$SYS/load'), [])
+
+    def test_004_callbacks(self):
+        self.trie.add('+/monitoring', cb1)
+        self.trie.add('+/monitoring', cb2)
+        self.trie.add('nyuki/monitoring', cb2)
+        self.assertEqual(self.trie.callbacks('+/monitoring'), {cb1, cb2})
+        matches = self.matched('nyuki/monitoring')
+        self.assertEqual(len(matches), 2)
+        self.assertIn({cb1, cb2}, matches)
+        self.assertIn({cb2}, matches)
+
+    def test_005_remove(self):
+        self.trie.add('a/+/c', cb1)
+        self.trie.add('a/+/c', cb2)
+        self.trie.add('a/b', cb1)
+
+        self.assertFalse(self.trie.remove('a/+/c', cb1))
+        self.assertEqual(self.matched('a/b/c'), [{cb2}])
+        self.assertTrue(self.trie.remove('a/+/c', cb2))
+        self.assertEqual(self.matched('a/b/c'), [])
+        self.assertNotIn('a/+/c', self.trie)
+        self.assertEqual(self.trie.topics, ['a/b'])
+
+        self.assertTrue(self.trie.remove('a/b'))
+        self.assertFalse(self.trie.remove('a/b'))
+        self.assertEqual(len(self.trie), 0)
+        self.assertEqual(self.trie._root.children, {})
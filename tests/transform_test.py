@@ -2,7 +2,8 @@ from unittest import TestCase
 
 from nyuki.utils.transform import (
     Upper, Lower, Lookup, Unset, Set, Sub, Extract, Converter,
-    FactoryConditionBlock, Arithmetic, Union
+    FactoryConditionBlock, Arithmetic, Union, TraceableDict,
+    ConverterCache, TRACE_NONE, TRACE_SUMMARY, LookupTable
 )
 
 
@@ -128,6 +129,15 @@ class TestTransformCases(TestCase):
         rule.apply(data)
         self.assertIn('else', data)
 
+        # Conditions without rules are accepted
+        rule = FactoryConditionBlock([
+            {'type': 'if', 'condition': "(@test == 'test if')"},
+            {'type': 'else'}
+        ])
+        self.assertEqual(rule.apply({'test': 'test if'}), {
+            'type': 'condition-block', 'conditions': []
+        })
+
         with self.assertRaises(ValueError):
             FactoryConditionBlock([])
         with self.assertRaises(TypeError):
@@ -139,6 +149,29 @@ class TestTransformCases(TestCase):
         with self.assertRaises(TypeError):
             FactoryConditionBlock([{'type': 'if'}, {'type': 'if'}, {'type': 'elif'}])
 
+    def test_008b_condition_variables(self):
+        rule = FactoryConditionBlock([
+            {'type': 'if', 'condition': "(@test == 'quote') or (@other != None)", 'rules': [
+                {'type': 'set', 'fieldname': 'if', 'value': 'ok'}
+            ]},
+            {'type': 'else', 'rules': [
+                {'type': 'set', 'fieldname': 'else', 'value': 'ok'}
+            ]}
+        ])
+        # Values are read from the data, never substituted in the expression
+        data = {'test': "it's 'quoted'"}
+        rule.apply(data)
+        self.assertIn('else', data)
+        data = {'test': 'test', 'other': object()}
+        rule.apply(data)
+        self.assertIn('if', data)
+        # Forbidden expressions are still rejected when evaluated
+        rule = FactoryConditionBlock([
+            {'type': 'if', 'condition': "__import__('os')", 'rules': []}
+        ])
+        with self.assertRaises(TypeError):
+            rule.apply({})
+
     def test_009a_converter(self):
         rules = [
             Lookup('normal', table={'message': 'lookup'}),
@@ -172,6 +205,13 @@ class TestTransformCases(TestCase):
         diff = rule.apply(self.data)
         self.assertEqual(diff['error'], 'regexp_rule_error')
 
+    def test_010b_error_leaves_data_untouched(self):
+        data = {'regex': '123message456', 'result': 1}
+        rule = Arithmetic('result', '+', '@regex', 2)
+        diff = rule.apply(data)
+        self.assertEqual(diff['error'], 'arithmetic_rule_error')
+        self.assertEqual(data, {'regex': '123message456', 'result': 1})
+
     def test_011_arithmetic(self):
         data = {
             'string_field_1': 'some string',
@@ -224,3 +264,187 @@ class TestTransformCases(TestCase):
         self.assertEqual(data['result']['a'], 10)
         self.assertEqual(data['result']['b'], 2)
         self.assertEqual(data['result']['c'], 3)
+
+    def test_013_traceable_dict(self):
+        nested = {'a': 1}
+        data = {'kept': nested, 'updated': 1, 'removed': 2}
+        tracker = TraceableDict(data)
+        tracker['updated'] = 10
+        tracker['updated'] = 10
+        tracker['added'] = [1]
+        del tracker['removed']
+        self.assertNotIn('removed', tracker)
+        with self.assertRaises(KeyError):
+            del tracker['removed']
+        tracker.update({'removed': 3})
+        self.assertEqual(tracker.changes, [
+            {'action': 'update', 'key': 'updated', 'old_value': 1, 'new_value': 10},
+            {'action': 'add', 'key': 'added', 'value': [1]},
+            {'action': 'remove', 'key': 'removed', 'value': 2},
+            {'action': 'add', 'key': 'removed', 'value': 3},
+        ])
+        # Nothing is applied (nor copied) before the commit
+        self.assertEqual(data, {'kept': nested, 'updated': 1, 'removed': 2})
+        self.assertEqual(len(tracker), 4)
+        tracker.commit()
+        self.assertEqual(data, {
+            'kept': nested, 'updated': 10, 'removed': 3, 'added': [1]
+        })
+        self.assertIs(data['kept'], nested)
+
+    def test_014_converter_cache(self):
+        cache = ConverterCache(maxsize=2)
+        config = {'rules': [
+            {'type': 'sub', 'fieldname': 'regex', 'pattern': r'\d+', 'repl': ''}
+        ]}
+        converter = cache.get(config, ['regex-1'])
+        self.assertIs(cache.get({'rules': list(config['rules'])}), converter)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        converter.apply(self.data)
+        self.assertEqual(self.data['regex'], 'message')
+
+        # Least recently used entry is evicted
+        cache.get({'rules': [{'type': 'lower', 'fieldname': 'to_lower'}]})
+        cache.get(config)
+        cache.get({'rules': [{'type': 'upper', 'fieldname': 'to_upper'}]})
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(config), converter)
+
+        # Invalidated from a dependency
+        cache.invalidate('regex-1')
+        self.assertEqual(len(cache), 1)
+        self.assertIsNot(cache.get(config), converter)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_015_apply_many(self):
+        config = {'rules': [
+            {'type': 'lower', 'fieldname': 'name'},
+            {'type': 'upper', 'fieldname': 'code'},
+            {'type': 'set', 'fieldname': 'source', 'value': 'csv'},
+            {'type': 'copy', 'fieldname': 'name', 'copy': 'alias'},
+            {'type': 'lookup', 'fieldname': 'color', 'icase': True,
+             'table': {'red': 'rouge'}},
+            {'type': 'arithmetic', 'fieldname': 'total', 'operator': '*',
+             'operand1': '@price', 'operand2': 1.5},
+            {'type': 'extract', 'fieldname': 'ref', 'pattern': r'(?P<num>\d+)'},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': "(@source == 'csv')", 'rules': [
+                    {'type': 'unset', 'fieldname': 'code'}
+                ]},
+            ]},
+        ]}
+
+        def records():
+            return [
+                {'name': 'ALICE', 'code': 'ab', 'color': 'Red',
+                 'price': 2, 'ref': 'x12'},
+                {'name': 3, 'color': 'blue', 'ref': None},
+                {'name': 'Bob', 'color': 4, 'price': 'free'},
+            ]
+
+        expected = records()
+        converter = Converter.from_dict(config)
+        results = [converter.apply(record) for record in expected]
+
+        many = converter.apply_many(records())
+        self.assertEqual(many['records'], expected)
+        self.assertEqual(many['diffs'], results)
+        self.assertTrue(many['errors'])
+
+        for columnar in (False, True):
+            many = converter.apply_many(
+                iter(records()), diff=False, columnar=columnar
+            )
+            self.assertEqual(many['records'], expected)
+            self.assertIsNone(many['diffs'])
+            self.assertTrue(many['errors'])
+
+    def test_016_trace_levels(self):
+        converter = Converter.from_dict({'rules': [
+            {'type': 'upper', 'fieldname': 'to_upper'},
+            {'type': 'unset', 'fieldname': 'none'},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': "(@normal == 'message')", 'rules': [
+                    {'type': 'set', 'fieldname': 'new', 'value': 1}
+                ]},
+            ]},
+        ]})
+
+        data = dict(self.data)
+        diff = converter.apply(data, TRACE_SUMMARY)
+        self.assertEqual(diff['rules'], [
+            {'type': 'upper', 'changes': [
+                {'action': 'update', 'key': 'to_upper'}
+            ]},
+            {'type': 'unset', 'changes': [
+                {'action': 'remove', 'key': 'none'}
+            ]},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'set', 'changes': [{'action': 'add', 'key': 'new'}]}
+            ]},
+        ])
+
+        expected = data
+        data = dict(self.data)
+        self.assertEqual(converter.apply(data, TRACE_NONE), {'errors': False})
+        self.assertEqual(data, expected)
+
+    def test_017_union_dedup(self):
+        data = {
+            'tags': ['a', 'b', {'c': 1}, ['d']],
+            'other': ['b', {'c': 1}, 'e', ['d'], {'f': 2}, 'e'],
+        }
+        rule = Union('result', '@tags', '@other')
+        rule.apply(data)
+        # Order kept, only items already in the first list are skipped
+        self.assertEqual(
+            data['result'], ['a', 'b', {'c': 1}, ['d'], 'e', {'f': 2}, 'e']
+        )
+
+        data = {'many': list(range(50000)), 'more': list(range(25000, 75000))}
+        Union('result', '@many', '@more').apply(data)
+        self.assertEqual(data['result'], list(range(75000)))
+
+    def test_018_regex_prefilter(self):
+        rules = [
+            {'type': 'extract', 'fieldname': 'msg',
+             'pattern': r'(?P<level>[A-Z]+) (?P<code>\d+) on (?P<host>\w+)'},
+            {'type': 'extract', 'fieldname': 'msg',
+             'pattern': r'user=(?P<user>\w+)', 'pos': 10},
+            {'type': 'extract', 'fieldname': 'msg',
+             'pattern': r'(?P<msg>.*) #end'},
+            {'type': 'sub', 'fieldname': 'msg',
+             'pattern': r'secret=\w+', 'repl': 'secret=***'},
+            {'type': 'extract', 'fieldname': 'msg',
+             'pattern': r'(?i)warn(?P<warn>ing)?'},
+        ]
+        messages = [
+            'ERROR 42 on web1 user=bob secret=abc #end',
+            'user=alice secret=xyz',
+            'some user=carol WARNING',
+            'nothing here',
+        ]
+        optimized = Converter.from_dict({'rules': rules})
+        plain = Converter.from_dict({'rules': rules}, optimize=False)
+        self.assertEqual(optimized.rules[0].literals, (' on ', ' '))
+        self.assertEqual(optimized.rules[1].literals, ())
+        self.assertEqual(optimized.rules[4].literals, ())
+
+        for message in messages:
+            expected = {'msg': message}
+            expected_diff = plain.apply(expected)
+            data = {'msg': message}
+            self.assertEqual(optimized.apply(data), expected_diff)
+            self.assertEqual(data, expected)
+
+    def test_019_shared_lookup_table(self):
+        table = LookupTable.from_pairs([
+            {'value': 'UPPERCASE', 'replace': 'found'},
+        ])
+        first = Lookup('to_upper', table=table, icase=True)
+        second = Lookup('to_upper', table=table, icase=True)
+        self.assertIs(first.table, second.table)
+        first.apply(self.data)
+        self.assertEqual(self.data['to_upper'], 'found')
+        self.assertIs(Lookup('to_upper', table=table).table, table.table)
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import pickle
+import unittest
+
+from asynctest import TestCase, CoroutineMock, Mock
+from nose.tools import eq_
+
+from nyuki.workflow.api.workflows import ApiWorkflowsRescue
+from nyuki.workflow.workflow import (
+    WorkflowInstance, WorkflowNyuki, _merge_shared_report
+)
+
+
+class TestWorkflowInstanceReport(unittest.TestCase):
+
+    def setUp(self):
+        self.task = Mock(uid='exec-1', holder=None)
+        self.task.as_dict.return_value = {'id': 'exec-1', 'state': 'pending'}
+        self.instance = Mock(uid='wf-exec', tasks={self.task})
+        self.instance.report.return_value = {
+            'exec': {'id': 'wf-exec', 'state': 'pending'},
+            'tasks': [
+                {'id': 't1', 'exec': {'id': 'exec-1', 'state': 'pending'}},
+                {'id': 't2', 'exec': None},
+            ]
+        }
+        self.wflow = WorkflowInstance({
+            'id': 'tmpl', 'title': 'template', 'tasks': [
+                {'id': 't1', 'title': 'first'}, {'id': 't2', 'title': 'next'}
+            ]
+        }, self.instance, requester='me')
+
+    def test_001_cached_report(self):
+        report = self.wflow.report()
+        eq_(report['exec'], {
+            'id': 'wf-exec', 'state': 'pending', 'requester': 'me'
+        })
+        eq_(report['tasks'][0]['title'], 'first')
+        eq_(report['tasks'][1]['exec'], None)
+        eq_(pickle.loads(self.wflow.dump()), report)
+        eq_(self.instance.report.call_count, 1)
+
+        # Changing a report does not alter the cached one
+        report['exec']['state'] = 'changed'
+        del report['tasks']
+        eq_(self.wflow.report()['exec']['state'], 'pending')
+        eq_(len(self.wflow.report()['tasks']), 2)
+        eq_(self.instance.report.call_count, 1)
+
+    def test_002_task_update(self):
+        report = self.wflow.report()
+        self.task.as_dict.return_value = {'id': 'exec-1', 'state': 'done'}
+        self.wflow.update({
+            'workflow_exec_id': 'wf-exec',
+            'task_template_id': 't1',
+            'task_exec_id': 'exec-1'
+        })
+        updated = self.wflow.report()
+        eq_(updated['tasks'][0], {
+            'id': 't1', 'title': 'first',
+            'exec': {'id': 'exec-1', 'state': 'done'}
+        })
+        # Previous report untouched, no full rebuild
+        eq_(report['tasks'][0]['exec']['state'], 'pending')
+        eq_(self.instance.report.call_count, 1)
+
+        # Workflow event
+        self.wflow.update({'workflow_exec_id': 'wf-exec'})
+        self.wflow.report()
+        eq_(self.instance.report.call_count, 2)
+
+    def test_003_shared_changes(self):
+        fields, replace = self.wflow.shared_changes()
+        eq_(list(fields), ['report'])
+        eq_(replace, True)
+
+        self.task.as_dict.return_value = {'id': 'exec-1', 'state': 'done'}
+        self.wflow.update({
+            'workflow_exec_id': 'wf-exec',
+            'task_template_id': 't1',
+            'task_exec_id': 'exec-1'
+        })
+        deltas, replace = self.wflow.shared_changes()
+        eq_(list(deltas), ['task:t1'])
+        eq_(replace, False)
+        eq_(self.wflow.shared_changes(), ({}, False))
+
+        # Rebuilt as it would be by a rescuer
+        shared = {b'report': fields['report'], b'task:t1': deltas['task:t1']}
+        eq_(_merge_shared_report(shared), self.wflow.report())
+
+
+class FakeResponse:
+
+    def __init__(self, status, body):
+        self.status = status
+        self.json = CoroutineMock(return_value=body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class TestRescue(TestCase):
+
+    def setUp(self):
+        self.nyuki = Mock(RESCUE_BATCH=2, RESCUE_CONCURRENCY=2)
+        self.nyuki.api._port = 5558
+        self.reports = [
+            {'id': 'tmpl', 'exec': {'id': 'wf{}'.format(i)}} for i in range(3)
+        ]
+
+    async def test_001_least_loaded_first(self):
+        responses = {
+            '10.0.0.2': FakeResponse(200, {'rescued': ['wf0'], 'errors': {
+                'wf1': 'This workflow is already being rescued'
+            }}),
+            '10.0.0.1': FakeResponse(200, {'rescued': ['wf1'], 'errors': {}}),
+        }
+        self.nyuki.http_session.put = Mock(
+            side_effect=lambda url, **kwargs: responses[url.split(':')[1][2:]]
+        )
+        loads = {'10.0.0.1': 20, '10.0.0.2': 5}
+        await WorkflowNyuki.rescue_batch(
+            self.nyuki, self.reports[:2], 'failing', loads,
+            asyncio.Semaphore(1)
+        )
+        urls = [c[1]['url'] for c in self.nyuki.http_session.put.call_args_list]
+        eq_(urls, [
+            'http://10.0.0.2:5558/v1/workflow/rescue',
+            'http://10.0.0.1:5558/v1/workflow/rescue',
+        ])
+        eq_(loads, {'10.0.0.1': 21, '10.0.0.2': 6})
+        eq_(self.nyuki.clear_report.call_count, 2)
+
+    async def test_002_resend_failed_only(self):
+        self.nyuki.http_session.put = Mock(return_value=FakeResponse(200, {
+            'rescued': ['wf0'], 'errors': {'wf2': 'Unknown template'}
+        }))
+        loads = {'10.0.0.1': 0, '10.0.0.2': 0}
+        await WorkflowNyuki.rescue_batch(
+            self.nyuki, self.reports, 'failing', loads, asyncio.Semaphore(1)
+        )
+        calls = self.nyuki.http_session.put.call_args_list
+        eq_(len(calls), 2)
+        resent = json.loads(calls[1][1]['data'])
+        eq_([report['exec']['id'] for report in resent], ['wf2'])
+
+    async def test_003_rescue_errors(self):
+        resource = Mock()
+
+        async def rescue(report, **kwargs):
+            if report['exec']['id'] == 'wf1':
+                raise KeyError('tmpl')
+        resource.rescue = rescue
+        request = Mock(json=CoroutineMock(return_value=self.reports))
+        response = await ApiWorkflowsRescue.put(resource, request)
+        eq_(json.loads(response.body.decode()), {
+            'rescued': ['wf0', 'wf2'], 'errors': {'wf1': "'tmpl'"}
+        })
+
+    async def test_004_missing_from_results(self):
+        self.nyuki.http_session.put = Mock(return_value=FakeResponse(200, {
+            'rescued': ['wf0'], 'errors': {}
+        }))
+        loads = {'10.0.0.1': 0, '10.0.0.2': 0}
+        with self.assertLogs('nyuki.workflow.workflow', 'ERROR') as logs:
+            await WorkflowNyuki.rescue_batch(
+                self.nyuki, self.reports, 'failing', loads,
+                asyncio.Semaphore(1)
+            )
+        eq_(self.nyuki.http_session.put.call_count, 1)
+        eq_(len(logs.output), 2)
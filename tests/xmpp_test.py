@@ -7,6 +7,7 @@ from slixmpp import JID
 
 from nyuki.bus.xmpp import _XmppClient, XmppBus
 from nyuki.bus.persistence import EventStatus
+from nyuki.bus.persistence.backend import PersistenceBackend
 
 
 class TestBusClient(TestCase):
@@ -84,6 +85,86 @@ class TestXmppBus(TestCase):
             join_mock.assert_called_once_with('unknown.topic@mucs.localhost', 'test')
         eq_(send_mock.call_count, 1)
 
+    @patch('slixmpp.xmlstream.stanzabase.StanzaBase.send')
+    async def test_003e_publish_window(self, send_mock):
+        self.bus._connected.set()
+        self.bus._window = asyncio.Semaphore(2)
+        # Publications return without waiting for their echo
+        await self.bus.publish({'message': '1'})
+        await self.bus.publish({'message': '2'})
+        eq_(send_mock.call_count, 2)
+        eq_(len(self.bus._in_flight), 2)
+        # Window is full until an echo is received
+        future = asyncio.ensure_future(self.bus.publish({'message': '3'}))
+        await exhaust_callbacks(self.loop)
+        eq_(send_mock.call_count, 2)
+        uid = list(self.bus._publish_futures.keys())[1]
+        self.bus._publish_futures[uid].set_result(None)
+        await future
+        eq_(send_mock.call_count, 3)
+        for future in self.bus._publish_futures.values():
+            future.cancel()
+        await asyncio.wait(self.bus._in_flight)
+        eq_(len(self.bus._publish_futures), 0)
+
+    @patch('slixmpp.xmlstream.stanzabase.StanzaBase.send')
+    async def test_003f_publish_window_timeout(self, send_mock):
+        self.bus._connected.set()
+        self.bus._window = asyncio.Semaphore(3)
+        with patch('asyncio.wait_for', side_effect=asyncio.TimeoutError), \
+                patch.object(self.bus.client, 'abort') as abort_mock:
+            for i in range(3):
+                await self.bus.publish({'message': str(i)})
+            await asyncio.wait(self.bus._in_flight)
+        # A single reconnection for the whole window
+        eq_(abort_mock.call_count, 1)
+        eq_(len(self.bus._publish_futures), 0)
+
+    @patch('slixmpp.xmlstream.stanzabase.StanzaBase.send')
+    async def test_003g_publish_window_ack_error(self, send_mock):
+        self.bus._connected.set()
+        self.bus._window = asyncio.Semaphore(1)
+        self.bus._persistence = Mock(
+            store_many=CoroutineMock(),
+            update=CoroutineMock(side_effect=RuntimeError()),
+            memory_buffer=Mock(is_full=False)
+        )
+        await self.bus.publish({'message': '1'})
+        for future in self.bus._publish_futures.values():
+            future.set_result(None)
+        with patch('nyuki.bus.xmpp.log') as log_mock:
+            await asyncio.wait(self.bus._in_flight)
+            await exhaust_callbacks(self.loop)
+        # Logged, and the window is released
+        eq_(log_mock.error.call_count, 1)
+        assert not self.bus._window.locked()
+
+    @patch('slixmpp.xmlstream.stanzabase.StanzaBase.send')
+    async def test_003h_publish_window_cancelled(self, send_mock):
+        self.bus._connected.set()
+        self.bus._window = asyncio.Semaphore(1)
+        self.bus._persistence = Mock(
+            store_many=CoroutineMock(),
+            update=CoroutineMock(),
+            update_many=CoroutineMock(),
+            memory_buffer=Mock(is_full=False)
+        )
+        future = asyncio.ensure_future(self.bus.publish_many(
+            [{'message': '1'}, {'message': '2'}, {'message': '3'}]
+        ))
+        await exhaust_callbacks(self.loop)
+        eq_(send_mock.call_count, 1)
+        future.cancel()
+        await asyncio.wait([future])
+        # Only the sent event is still waiting for its echo
+        eq_(len(self.bus._publish_futures), 1)
+        updates = self.bus._persistence.update_many.call_args[0][0]
+        eq_(len(updates), 2)
+        assert all(status == EventStatus.FAILED for _, status in updates)
+        for pending in self.bus._publish_futures.values():
+            pending.cancel()
+        await asyncio.wait(self.bus._in_flight)
+
     async def test_004_on_register_callback(self):
         with patch('slixmpp.stanza.Iq.send', new=CoroutineMock()) as send_mock:
             await self.bus._on_register(None)
@@ -148,7 +229,7 @@ class TestXmppBus(TestCase):
         submock.assert_called_once_with('test', None)
 
 
-class FakePersistenceBackend(object):
+class FakePersistenceBackend(PersistenceBackend):
 
     def __init__(self):
         self.events = list()